@@ -0,0 +1,96 @@
+# ----------
+# Benchmark the fast exponential of the fused (numba) likelihood kernel
+# against the exact exponential, on a 100 x 100 stamp with several galaxies
+# and a 6 component PSF.  Reports the time per likelihood call and the
+# resulting deviation in chi^2 and its gradients.
+# ----------
+
+import time
+import numpy as np
+
+from forcepho.gaussmodel import Galaxy
+from forcepho.data import PostageStamp
+from forcepho.psf import PointSpreadFunction
+from forcepho.likelihood import make_workplans
+from forcepho import kernels
+
+
+class Scene(object):
+
+    use_gradients = slice(0, 7)
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def param_indices(self, sourceid, filterid):
+        return list(range(7 * sourceid, 7 * sourceid + 7))
+
+    def set_source_params(self, theta, source, filterid=None):
+        (source.flux, source.ra, source.dec, source.q, source.pa,
+         source.sersic, source.rh) = theta
+
+
+def standard_stamp(size=100, ngal=10, seed=42):
+    rng = np.random.RandomState(seed)
+    stamp = PostageStamp()
+    stamp.nx, stamp.ny = size, size
+    stamp.npix = size * size
+    stamp.ypix, stamp.xpix = np.meshgrid(np.arange(size), np.arange(size))
+    stamp.scale = np.eye(2)
+    stamp.crval, stamp.crpix = np.zeros(2), np.zeros(2)
+
+    psf = PointSpreadFunction()
+    psf.ngauss = 6
+    sig = np.array([0.6, 1.0, 1.5, 2.5, 4.0, 7.0])
+    psf.covariances = sig[:, None, None]**2 * np.eye(2)
+    psf.means = np.zeros([6, 2])
+    psf.amplitudes = np.array([0.3, 0.3, 0.2, 0.1, 0.07, 0.03])
+    stamp.psf = psf
+
+    sources, theta = [], []
+    for i in range(ngal):
+        gal = Galaxy()
+        gal.id = i
+        gal.radii = np.arange(gal.ngauss) * 0.3
+        sources.append(gal)
+        theta += [rng.uniform(50, 500), rng.uniform(10, size - 10),
+                  rng.uniform(10, size - 10), rng.uniform(0.6, 1.0),
+                  rng.uniform(0, np.pi), 0., 0.]
+    scene = Scene(sources)
+    theta = np.array(theta)
+
+    stamp.ierr = np.ones(stamp.npix)
+    stamp.pixel_values = np.zeros([size, size])
+    wp = make_workplans(theta, scene, [stamp])[0][0]
+    wp.backend = "numba"
+    wp.lnlike()
+    stamp.pixel_values = (-wp.residual.reshape(size, size) +
+                          rng.normal(0, 1, (size, size)))
+    return scene, stamp, theta * rng.normal(1, 0.01, len(theta))
+
+
+def time_lnlike(theta, scene, stamp, fast_exp=False, ntry=10):
+    wp = make_workplans(theta, scene, [stamp])[0][0]
+    wp.backend = "numba"
+    wp.fast_exp = fast_exp
+    wp.lnlike()  # compile
+    t = time.time()
+    for i in range(ntry):
+        lnp, grad = wp.lnlike()
+    return (time.time() - t) / ntry, lnp, grad
+
+
+if __name__ == "__main__":
+
+    if kernels.numba is None:
+        raise ImportError("The fused kernel benchmark requires numba")
+    scene, stamp, theta = standard_stamp()
+    dt, lnp, grad = time_lnlike(theta, scene, stamp, fast_exp=False)
+    dt_fast, lnp_fast, grad_fast = time_lnlike(theta, scene, stamp, fast_exp=True)
+
+    print("exact exp: {:8.2f} ms per call".format(dt * 1e3))
+    print("fast exp:  {:8.2f} ms per call ({:4.2f}x)".format(dt_fast * 1e3, dt / dt_fast))
+    print("stated max relative error of fast_exp: {:.1e}".format(kernels.FASTEXP_RTOL))
+    print("chi^2: {:.10e}, relative deviation {:.2e}".format(-2 * lnp, np.abs(lnp_fast / lnp - 1)))
+    print("max relative gradient deviation: {:.2e}".format(
+          np.abs(grad_fast - grad).max() / np.abs(grad).max()))
@@ -14,8 +14,8 @@ from astropy import wcs as apy_wcs
 from forcepho import paths
 from forcepho.data import PostageStamp
 from forcepho import psf as pointspread
-from forcepho.gaussmodel import Star, convert_to_gaussians, get_gaussian_gradients, compute_gaussian
-from forcepho.likelihood import WorkPlan
+from forcepho.gaussmodel import Star
+from forcepho.likelihood import negative_lnlike_multistamp
 
 # ------
 # The setup here is that we are pulling the source parameters from the total
@@ -87,32 +87,6 @@ class Scene(object):
             self.set_source_params(Theta[inds], source, filterid)
 
 
-def negative_lnlike_multistamp(Theta, scene=None, stamps=None):
-
-    lnp = 0.0
-    lnp_grad = np.zeros(len(Theta))
-    for k, stamp in enumerate(stamps):
-        # Create the workplan
-        active = []
-        inds = []
-        for source in scene.sources:
-            sourceinds = scene.param_indices(source.id, stamp.filter)
-            scene.set_source_params(Theta[sourceinds], source, stamp.filter)
-            gig = convert_to_gaussians(source, stamp)
-            gig = get_gaussian_gradients(source, stamp, gig)
-            active.append(gig)
-            inds += sourceinds
-        # TODO: don't reintialize the workplan every call
-        wp = WorkPlan(stamp, active)
-        lnp_stamp, lnp_stamp_grad = wp.lnlike(active)
-        print(k, inds, lnp_stamp, lnp_stamp_grad)
-        lnp += lnp_stamp
-        # TODO: test that flatten does the right thing here
-        lnp_grad[inds] += lnp_stamp_grad[:, scene.use_gradients].flatten()
-
-    return -lnp, -lnp_grad
-
-
 def make_stamp(imname, center=(None, None), size=(None, None),
                center_type='pixels', psfname=None, fwhm=1.0):
     """Make a postage stamp around the given position using the given image name
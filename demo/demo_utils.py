@@ -78,8 +78,8 @@ def negative_lnlike_stamp(theta, scene=None, stamp=None):
 
 
 def negative_lnlike_nograd(theta, scene=None, stamp=None):
-    nll, nll_grad = negative_lnlike_multistamp(theta, scene=scene, stamps=[stamp])
-    return nll
+    return negative_lnlike_multistamp(theta, scene=scene, stamps=[stamp],
+                                      compute_gradient=False)
 
 
 def chi_vector(theta, scene=None, stamp=None):
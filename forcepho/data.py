@@ -42,15 +42,132 @@ class PostageStamp(object):
     residuals = np.zeros([nx * ny])
     ierr = np.zeros_like(residuals)
 
+    def set_dtype(self, dtype):
+        """Set the storage precision of the pixel data, uncertainties, and
+        pixel coordinates, e.g. to np.float32 to halve the memory use.  This
+        should match `WorkPlan.dtype` to avoid conversions on every call.
+        """
+        for attr in ["pixel_values", "ierr", "xpix", "ypix"]:
+            if hasattr(self, attr):
+                setattr(self, attr, np.asarray(getattr(self, attr), dtype=dtype))
+
+    # The cached image gaussians of the sources, a gaussmodel.BatchCache that
+    # is shared by the stamps passed together to `make_workplans`.  Set to None to force
+    # reconversion, e.g. after changing the PSF in place.
+    batch_cache = None
+
+    # The likelihood.WorkPlan of this stamp, kept by `make_workplans` between
+    # calls.  Set to None to make a new plan with the default options.
+    workplan = None
+
+    # The image (flattened) index of each stored pixel, if the pixels are not
+    # stored in image order.  See `set_layout`.
+    pixel_order = None
+
+    @property
+    def pixel_index(self):
+        """The position of each pixel of the (nx, ny) image in the flattened
+        pixel arrays.
+        """
+        if self.pixel_order is None:
+            return np.arange(self.npix).reshape(self.nx, self.ny)
+        index = np.zeros(self.npix, dtype=int)
+        index[self.pixel_order] = np.arange(self.npix)
+        return index.reshape(self.nx, self.ny)
+
+    def set_layout(self, layout="image", tile=(8, 8)):
+        """Set the order in which the pixel values, uncertainties, and pixel
+        coordinates are stored.  In the "superpixel" layout the image is cut
+        into tiles of shape `tile` (like the SuperPixels of the C++ code), which
+        are stored one after the other, each in row-major order.  In the
+        "morton" layout the pixels are stored in Z-order.  In both cases the
+        pixels near each other on the image, and hence the pixels within the
+        footprint of each gaussian, are near each other in memory.  The
+        "image" layout restores the (nx, ny) image arrays.
+
+        :param layout: (optional, default: "image")
+            One of "image", "superpixel" or "morton"
+
+        :param tile: (optional, default: (8, 8))
+            The size of the superpixels in x and y.
+        """
+        attrs = [a for a in ["pixel_values", "ierr", "xpix", "ypix"]
+                 if hasattr(self, a)]
+        images = [self.to_image(getattr(self, a)) for a in attrs]
+        i, j = np.indices((self.nx, self.ny)).reshape(2, -1)
+        if layout == "image":
+            order = None
+        elif layout == "superpixel":
+            sx, sy = tile
+            order = np.lexsort((j, i, j // sy, i // sx))
+        elif layout == "morton":
+            order = np.argsort(_morton_code(i, j), kind="stable")
+        else:
+            raise ValueError("Unknown pixel layout {}".format(layout))
+        self.pixel_order = order
+
+        for attr, image in zip(attrs, images):
+            if order is not None:
+                image = image.reshape(-1)[order]
+            elif attr == "ierr":
+                image = image.reshape(-1)
+            setattr(self, attr, image)
+
+    def to_image(self, values):
+        """Put an array of stored pixel values in image order.
+
+        :param values:
+            ndarray of shape (npix,)
+
+        :returns image:
+            ndarray of shape (nx, ny)
+        """
+        values = np.asarray(values)
+        if self.pixel_order is None:
+            return values.reshape(self.nx, self.ny)
+        image = np.zeros(self.npix, dtype=values.dtype)
+        image[self.pixel_order] = values.reshape(-1)
+        return image.reshape(self.nx, self.ny)
+
+    def from_image(self, image):
+        """Put an image in the pixel storage order.
+
+        :param image:
+            ndarray of shape (nx, ny)
+
+        :returns values:
+            ndarray of shape (npix,)
+        """
+        values = np.asarray(image).reshape(-1)
+        if self.pixel_order is None:
+            return values
+        return values[self.pixel_order]
+
     def sky_to_pix(self, sky):
-        pix = np.dot(self.scale, sky - self.crval) + self.crpix
+        """Works for a single position of shape (2,) or an array of positions
+        with shape (n, 2)
+        """
+        pix = np.dot(sky - self.crval, self.scale.T) + self.crpix
         return pix
 
     def pix_to_sky(self, pix):
-        sky = np.dot(np.linalg.inv(self.scale), pix - self.crpix) + self.crval
+        sky = np.dot(pix - self.crpix, np.linalg.inv(self.scale).T) + self.crval
         return sky
 
 
+def _morton_code(i, j):
+    """Interleave the bits of the integer pixel indices i and j to get their
+    position along the Z-order curve.
+    """
+    i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+    code = np.zeros_like(i)
+    nbits = int(max(i.max(), j.max(), 1)).bit_length()
+    for b in range(nbits):
+        code |= ((i >> b) & 1) << (2 * b + 1)
+        code |= ((j >> b) & 1) << (2 * b)
+    return code
+
+
 class SimpleWCS(object):
     """Class to make various transformations between coordinate systems for a
     simple TAN WCS projection.
@@ -0,0 +1,344 @@
+# Render GaussianBatches in Fourier space.  The analytic Fourier transforms of
+# all the image gaussians, multiplied by the transform of the pixel response
+# (a unit box), are summed on a frequency grid and inverse transformed once.
+# The gradients of the likelihood with respect to the gaussian parameters are
+# computed from the same transforms using Parseval's theorem, so that no
+# per-gaussian images are ever made.
+
+import numpy as np
+from .gaussmodel import NPARAM, source_gradients
+
+__all__ = ["fourier_image", "fourier_lnlike", "render_costs", "fft_size"]
+
+
+# Rough relative costs of the operations, per gaussian per pixel for the
+# pixel kernel, per gaussian per frequency for the Fourier renderer, and per
+# (N log2 N) for one real FFT of size N.
+PIXEL_COST = 1.0
+FREQ_COST = 0.6
+FFT_COST = 0.02
+
+# Aliased frequencies are included where the transform of a gaussian is
+# larger than this fraction of its total flux.
+ALIAS_TOL = 1e-10
+
+
+def fft_size(n):
+    """The smallest integer >= n with no prime factors larger than 5.
+    """
+    n = int(n)
+    best = 2**int(np.ceil(np.log2(max(n, 1))))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def fourier_grid(batch, nx, ny, pad=None, nsigma=5.):
+    """Get the shape of the padded grid used for Fourier rendering.  The
+    padding keeps the flux of the gaussians that spills over one edge of the
+    stamp from wrapping around onto the other edge.
+
+    :param pad: (optional)
+        The number of pixels to pad each dimension by.  If not given, this is
+        `nsigma` times the largest dispersion of any gaussian in the batch.
+
+    :returns shape:
+        2-tuple of the padded (nx, ny)
+    """
+    if pad is None:
+        fxx, fyy, fxy = batch.fxx, batch.fyy, batch.fxy
+        lmin = 0.5 * (fxx + fyy) - np.hypot(0.5 * (fxx - fyy), fxy)
+        pad = int(np.ceil(nsigma / np.sqrt(lmin.min())))
+    return fft_size(nx + pad), fft_size(ny + pad)
+
+
+def render_costs(batch, stamp, pad=None, ktol=1e-8):
+    """Estimate the relative cost of rendering a batch of gaussians in pixel
+    space and in Fourier space.
+
+    :param batch:
+        A GaussianBatch.  If it has bounding boxes in its `bbox` attribute
+        these are used for the pixel cost.
+
+    :param stamp:
+        The PostageStamp to render on.
+
+    :returns pixel_cost, fourier_cost:
+        The estimated costs in arbitrary (but common) units.
+    """
+    if batch.bbox is not None:
+        box = batch.bbox
+        area = ((box[:, 1] - box[:, 0]).clip(0) * (box[:, 3] - box[:, 2]).clip(0))
+        pixel_cost = PIXEL_COST * area.sum()
+    else:
+        pixel_cost = PIXEL_COST * len(batch) * stamp.npix
+
+    shape = fourier_grid(batch, stamp.nx, stamp.ny, pad=pad)
+    nkx, nky = _frequency_footprints(batch, shape, ktol)
+    mx, my = _alias_number(batch.fxx, batch.fyy)
+    nalias = (2 * mx + 1) * (2 * my + 1)
+    ngrid = shape[0] * shape[1]
+    fourier_cost = (FREQ_COST * (nkx * nky * nalias).sum() +
+                    FFT_COST * 2 * ngrid * np.log2(ngrid))
+    return pixel_cost, fourier_cost
+
+
+def fourier_image(batch, xpix, ypix, use_det=False, pad=None, ktol=1e-8,
+                  gauss_block=32, **extras):
+    """Render the gaussians of a batch on a regular grid of pixels by summing
+    their Fourier transforms.  The gaussians are integrated exactly over the
+    (unit) pixels, rather than with the second order approximation of the
+    pixel kernels.
+
+    :param batch:
+        A GaussianBatch instance.
+
+    :param xpix:
+        The x coordinates of the pixels, ndarray of shape (nx, ny), with x
+        increasing by one along the first axis.
+
+    :param ypix:
+        The y coordinates of the pixels, ndarray of shape (nx, ny), with y
+        increasing by one along the second axis.
+
+    :param use_det: (otional, default: False)
+        Whether to include the determinant of the covariance matrix when
+        normalizing the counts.
+
+    :param pad: (optional)
+        The number of pixels by which to pad the grid.  See `fourier_grid`.
+
+    :param ktol: (optional, default: 1e-8)
+        The transform of each gaussian is only evaluated where it is larger
+        than this fraction of its total flux.
+
+    :returns image:
+        The model image, ndarray of shape (nx, ny)
+    """
+    nx, ny = xpix.shape
+    shape = fourier_grid(batch, nx, ny, pad=pad)
+    origin = xpix[0, 0], ypix[0, 0]
+    spectrum = np.zeros([shape[0], shape[1] // 2 + 1], dtype=np.complex128)
+    for gs, ix, iy, kx, ky in _frequency_blocks(batch, shape, ktol, gauss_block):
+        B = _transform(batch, gs, kx, ky, origin, use_det)
+        spectrum[np.ix_(ix, iy)] += (batch.amp[gs, None, None] * B).sum(axis=0)
+    image = np.fft.irfftn(spectrum, s=shape, axes=(0, 1))
+    return image[:nx, :ny]
+
+
+def fourier_lnlike(batch, xpix, ypix, data, ierr, use_det=False, pad=None,
+                   ktol=1e-8, gauss_block=32, compute_deriv=True, **extras):
+    """Compute the residual, chi^2 and gradients of ln(likelihood) for a batch
+    of gaussians rendered in Fourier space.  The model image is made with a
+    single inverse FFT, and the gradients with respect to the 6 parameters of
+    each gaussian are sums over frequencies of the derivatives of its
+    transform times the transform of the chi-weighted residual image.
+
+    :param batch:
+        A GaussianBatch instance with compact Jacobians in the `derivs`
+        attribute.
+
+    :param xpix:
+        The x coordinates of the pixels, ndarray of shape (nx, ny), with x
+        increasing by one along the first axis.
+
+    :param ypix:
+        The y coordinates of the pixels, ndarray of shape (nx, ny), with y
+        increasing by one along the second axis.
+
+    :param data:
+        The pixel values, ndarray of shape (nx, ny) or (npix,)
+
+    :param ierr:
+        The inverse uncertainties of the pixels, ndarray of shape (nx, ny) or
+        (npix,)
+
+    :param use_det, pad, ktol, gauss_block: (optional)
+        See `fourier_image`.
+
+    :param compute_deriv: (optional, default: True)
+        If False, only the chi^2 and residual are computed, and lnp_grad is
+        all zeros.
+
+    :returns chisq:
+        The chi^2 summed over pixels.
+
+    :returns lnp_grad:
+        The gradient of -chi^2/2 with respect to the scene parameters of each
+        source in the batch, ndarray of shape (nsource, NPARAM)
+
+    :returns residual:
+        The data minus the model, ndarray of shape (npix,)
+    """
+    nx, ny = xpix.shape
+    shape = fourier_grid(batch, nx, ny, pad=pad)
+    origin = xpix[0, 0], ypix[0, 0]
+    model = fourier_image(batch, xpix, ypix, use_det=use_det, pad=pad,
+                          ktol=ktol, gauss_block=gauss_block)
+    ierr = np.reshape(ierr, (nx, ny))
+    residual = np.reshape(data, (nx, ny)) - model
+    chi = residual * ierr
+    chisq = np.sum(chi * chi)
+    lnp_grad = np.zeros([batch.nsource, NPARAM])
+    if not compute_deriv:
+        return chisq, lnp_grad, residual.reshape(-1)
+
+    # Transform of the chi-weighted residual on the padded grid, conjugated,
+    # and weighted for the half-plane of frequencies (with normalization) so
+    # that sum(w * I) = Re(sum(W * I_k)).
+    w = np.zeros(shape)
+    w[:nx, :ny] = chi * ierr
+    W = np.conj(np.fft.rfftn(w)) * _halfplane_weights(shape)
+    sums = np.zeros([len(batch), 6])
+    for gs, ix, iy, kx, ky in _frequency_blocks(batch, shape, ktol, gauss_block):
+        sums[gs] = _transform_sums(batch, gs, kx, ky, origin, use_det,
+                                   W[np.ix_(ix, iy)])
+
+    lnp_grad = source_gradients(batch, sums)
+    return chisq, lnp_grad, residual.reshape(-1)
+
+
+def _halfplane_weights(shape):
+    """Weights of the frequencies of a real FFT such that for real images a
+    and b, sum(a * b) = Re(sum(conj(A) * B * weights)).
+    """
+    nky = shape[1] // 2 + 1
+    c = np.full(nky, 2.0)
+    c[0] = 1.0
+    if shape[1] % 2 == 0:
+        c[-1] = 1.0
+    return c[None, :] / (shape[0] * shape[1])
+
+
+def _frequency_footprints(batch, shape, ktol):
+    """The number of frequencies along each axis within which the transform of
+    each gaussian exceeds `ktol` of its total flux.
+    """
+    k2 = 2 * np.log(1. / ktol)
+    dkx, dky = 2 * np.pi / shape[0], 2 * np.pi / shape[1]
+    nkx = 2 * np.floor(np.sqrt(k2 * batch.fxx) / dkx) + 1
+    nky = np.floor(np.sqrt(k2 * batch.fyy) / dky) + 1
+    nkx = np.minimum(nkx, shape[0]).astype(int)
+    nky = np.minimum(nky, shape[1] // 2 + 1).astype(int)
+    return nkx, nky
+
+
+def _frequency_blocks(batch, shape, ktol, gauss_block):
+    """Generate blocks of gaussians with similar frequency footprints, with the
+    indices and values of the frequencies needed for each block.
+
+    :returns gs, ix, iy, kx, ky:
+        The indices of the gaussians in the block, the indices of the
+        frequencies into the (shape[0], shape[1]//2 + 1) grid, and the angular
+        frequencies themselves.
+    """
+    k2 = 2 * np.log(1. / ktol)
+    kx_all = 2 * np.pi * np.fft.fftfreq(shape[0])
+    ky_all = 2 * np.pi * np.fft.rfftfreq(shape[1])
+    wx, wy = np.sqrt(k2 * batch.fxx), np.sqrt(k2 * batch.fyy)
+    order = np.argsort(wx * wy)
+    for g0 in range(0, len(order), gauss_block):
+        gs = order[g0:g0 + gauss_block]
+        ix = np.flatnonzero(np.abs(kx_all) <= wx[gs].max())
+        iy = np.flatnonzero(ky_all <= wy[gs].max())
+        yield gs, ix, iy, kx_all[ix], ky_all[iy]
+
+
+def _alias_terms(batch, gs, kx, ky, origin, use_det):
+    """Generate the Fourier transforms of unit amplitude gaussians, times the
+    transform of the unit pixel, at the frequencies k + 2 pi m for each alias
+    m.  The sum over aliases is the transform of the sampled image; aliases
+    are only included where some gaussian of the block is not band-limited
+    (to `ALIAS_TOL`) by the sampling.
+
+    :returns kxa, kya:
+        The aliased angular frequencies, of shape (1, nkx, 1) and (1, 1, nky)
+
+    :returns ux, uy:
+        The vector Sigma * k for each gaussian, of shape (ngauss, nkx, nky)
+
+    :returns Ba:
+        The transforms, complex ndarray of shape (ngauss, nkx, nky)
+    """
+    fxx, fyy, fxy = [getattr(batch, a)[gs, None, None] for a in ["fxx", "fyy", "fxy"]]
+    det = fxx * fyy - fxy * fxy
+    # covariance matrix
+    sxx, syy, sxy = fyy / det, fxx / det, -fxy / det
+    norm = 2 * np.pi * (1.0 if use_det else 1.0 / np.sqrt(det))
+    dx = batch.xcen[gs, None, None] - origin[0]
+    dy = batch.ycen[gs, None, None] - origin[1]
+
+    # number of aliases needed along each axis
+    mx, my = _alias_number(batch.fxx[gs].max(), batch.fyy[gs].max())
+    for ax in range(-mx, mx + 1):
+        kxa = kx[None, :, None] + 2 * np.pi * ax
+        px = np.sinc(kxa / (2 * np.pi)) * np.exp(-1j * kxa * dx)
+        for ay in range(-my, my + 1):
+            kya = ky[None, None, :] + 2 * np.pi * ay
+            py = np.sinc(kya / (2 * np.pi)) * np.exp(-1j * kya * dy)
+            ux = sxx * kxa + sxy * kya
+            uy = sxy * kxa + syy * kya
+            Ba = (norm * np.exp(-0.5 * (kxa * ux + kya * uy))) * (px * py)
+            yield kxa, kya, ux, uy, Ba
+
+
+def _alias_number(fxx, fyy):
+    """The number of aliases needed on each side along each axis, for a
+    gaussian with the given precision matrix diagonal.
+    """
+    k2 = 2 * np.log(1. / ALIAS_TOL)
+    wx, wy = np.sqrt(k2 * fxx), np.sqrt(k2 * fyy)
+    mx = np.ceil(np.maximum(wx - np.pi, 0) / (2 * np.pi)).astype(int)
+    my = np.ceil(np.maximum(wy - np.pi, 0) / (2 * np.pi)).astype(int)
+    return mx, my
+
+
+def _transform(batch, gs, kx, ky, origin, use_det):
+    """The transform of the sampled image of unit amplitude gaussians.
+
+    :returns B:
+        Complex ndarray of shape (ngauss, nkx, nky)
+    """
+    B = 0.
+    for kxa, kya, ux, uy, Ba in _alias_terms(batch, gs, kx, ky, origin, use_det):
+        B = B + Ba
+    return B
+
+
+def _transform_sums(batch, gs, kx, ky, origin, use_det, Wk):
+    """Sum the product of the weighted residual transform `Wk` with the
+    derivatives of the transform of each gaussian with respect to its amp,
+    xcen, ycen, fxx, fyy, and fxy.  By Parseval's theorem these are the sums
+    over pixels of chi * ierr * dI/dphi.
+
+    :returns sums:
+        ndarray of shape (ngauss, 6)
+    """
+    fxx, fyy, fxy = batch.fxx[gs], batch.fyy[gs], batch.fxy[gs]
+    det = fxx * fyy - fxy * fxy
+    sums = np.zeros([len(gs), 6])
+    for kxa, kya, ux, uy, Ba in _alias_terms(batch, gs, kx, ky, origin, use_det):
+        Z = Wk * Ba
+        zr, zi = Z.real, Z.imag
+        # d/dxcen of exp(-i k.x) is -i kx, and Re(-i z) = Im(z)
+        sums[:, 0] += zr.sum(axis=(1, 2))
+        sums[:, 1] += (zi * kxa).sum(axis=(1, 2))
+        sums[:, 2] += (zi * kya).sum(axis=(1, 2))
+        sums[:, 3] += 0.5 * (zr * ux * ux).sum(axis=(1, 2))
+        sums[:, 4] += 0.5 * (zr * uy * uy).sum(axis=(1, 2))
+        sums[:, 5] += (zr * ux * uy).sum(axis=(1, 2))
+    if not use_det:
+        # derivatives of the 1/sqrt(det) normalization
+        sums[:, 3] -= 0.5 * fyy / det * sums[:, 0]
+        sums[:, 4] -= 0.5 * fxx / det * sums[:, 0]
+        sums[:, 5] += fxy / det * sums[:, 0]
+    sums[:, 1:] *= batch.amp[gs, None]
+    return sums
@@ -5,8 +5,19 @@ import numpy as np
 
 
 __all__ = ["ImageGaussian", "Star", "Galaxy", "GaussianImageGalaxy",
-           "convert_to_gaussians", "get_gaussian_gradients",
-           "compute_gaussian"]
+           "GaussianBatch", "convert_to_gaussians", "get_gaussian_gradients",
+           "convert_to_gaussian_batch", "get_gaussian_batch_gradients",
+           "BatchCache", "psf_terms", "lookup_profiles", "free_parameters",
+           "set_footprints", "compress_batch", "apply_jacobian", "source_gradients",
+           "expand_jacobian", "compute_gaussian", "subpixel_offsets", "undersampled"]
+
+
+# The number of Scene parameters for one source and one filter
+NPARAM = 7
+# The number of nonzero elements of the dGaussian_dScene Jacobian, stored as
+# [dA_dflux, dA_dq, dA_dpa, dA_dsersic, dA_drh, D.flatten(),
+#  dFxx_dq, dFyy_dq, dFxy_dq, dFxx_dpa, dFyy_dpa, dFxy_dpa]
+NDERIV = 15
 
 
 class ImageGaussian(object):
@@ -19,7 +30,8 @@ class ImageGaussian(object):
     * center xcen, ycen
 
     In the Scene space there are 7 parameters, so the dgauss_dscene matrix is 6
-    x 7 (mostly zeros)
+    x 7 (mostly zeros).  Only the NDERIV nonzero elements are stored, see
+    `expand_jacobian` for the full matrix.
     """
     amp = 0.
     xcen = 0.
@@ -29,11 +41,64 @@ class ImageGaussian(object):
     fyy = 0.
 
     # derivs = [dA_dflux, dA_dq, dA_dpa, dA_dsersic, dA_drh, D.flatten(), dF_dq.flat[inds], dF_dpa.flat[inds]]
-    derivs = None  # this is the dGaussian_dScene Jacobian matrix, possibly in a sparse format
+    derivs = None  # this is the dGaussian_dScene Jacobian matrix, in compact format
     #float dGaussian_dScene[NDERIV];
 
 
-class Star(object):
+class Source(object):
+    """Base class for sources, which keeps track of changes to the parameters.
+    Whenever the value of one of the `parameter_names` (or the number or radii
+    of the gaussian components) changes, `version` is incremented.  The
+    `shape_version` is only incremented when something other than the flux or
+    position changes, since the shapes of the image gaussians do not depend
+    on them, and the flux is set separately for the stamps of each band.
+    Derived quantities that only depend on the shape of the profile
+    (amplitudes, covariances, and amplitude derivatives) are memoized until
+    the `sersic`, `rh`, `ngauss`, `radii` or `amplitude_table` attributes
+    change.
+    """
+
+    parameter_names = ["flux", "ra", "dec", "q", "pa", "sersic", "rh"]
+    profile_names = ["sersic", "rh", "ngauss", "radii", "amplitude_table"]
+    version = 0
+    shape_version = 0
+    profile_version = 0
+
+    def __setattr__(self, name, value):
+        if name in self.parameter_names or name in self.profile_names:
+            if not np.array_equal(getattr(self, name, None), value):
+                object.__setattr__(self, "version", self.version + 1)
+                if name not in ["flux", "ra", "dec"]:
+                    object.__setattr__(self, "shape_version", self.shape_version + 1)
+                if name in self.profile_names:
+                    object.__setattr__(self, "profile_version", self.profile_version + 1)
+        object.__setattr__(self, name, value)
+
+    def _memoized(self, name, compute):
+        """Get the value of a derived quantity from the cache, or compute and
+        cache it (read-only) if the profile has changed since it was cached.
+        """
+        cache = self.__dict__.setdefault("_memo", {})
+        version, value = cache.get(name, (None, None))
+        if version != self.profile_version:
+            value = self._memoize(name, compute())
+        return value
+
+    def _memoize(self, name, value):
+        """Cache (read-only) the value of a derived quantity for the current
+        profile.
+        """
+        value = np.array(value)
+        value.setflags(write=False)
+        self.__dict__.setdefault("_memo", {})[name] = (self.profile_version, value)
+        return value
+
+    def _is_memoized(self, name):
+        cache = self.__dict__.get("_memo", {})
+        return cache.get(name, (None, None))[0] == self.profile_version
+
+
+class Star(Source):
     """This is a represenation of a point source in terms of Scene (on-sky)
     parameters
     """
@@ -61,13 +126,13 @@ class Star(object):
         """
         # ngauss x 2 x 2
         # this has no derivatives, since the radii are fixed.
-        return np.zeros([1, 2, 2])
+        return self._memoized("covariances", lambda: np.zeros([1, 2, 2]))
 
     @property
     def amplitudes(self):
         """
         """
-        return np.ones(1)
+        return self._memoized("amplitudes", lambda: np.ones(1))
 
     @property
     def damplitude_dsersic(self):
@@ -75,7 +140,7 @@ class Star(object):
         table (dependent on self.n and self.r)
         """
         # ngauss array of da/dn
-        return np.zeros(1)
+        return self._memoized("damplitude_dsersic", lambda: np.zeros(1))
 
     @property
     def damplitude_drh(self):
@@ -83,10 +148,10 @@ class Star(object):
         table (dependent on self.n and self.r)
         """
         # ngauss array of da/dr
-        return np.zeros(1)
+        return self._memoized("damplitude_drh", lambda: np.zeros(1))
 
 
-class Galaxy(object):
+class Galaxy(Source):
     """Parameters describing a gaussian galaxy in the celestial plane (i.e. the Scene parameters)
     For each galaxy there are 7 parameters:
       * flux: total flux
@@ -98,7 +163,8 @@ class Galaxy(object):
 
     Methods are provided to return the amplitudes and covariance matrices of
     the constituent gaussians, as well as derivatives of the amplitudes with
-    respect to sersic index and half light radius.
+    respect to sersic index and half light radius.  These are memoized, see
+    `Source`.
     """
     id = 0
     fixed = False
@@ -114,29 +180,46 @@ class Galaxy(object):
     sersic = 0.   # sersic index
     rh = 0.       # half light radius
 
+    # A sersic.AmplitudeTable giving the component amplitudes as a function of
+    # sersic index and half-light radius.  If None, all components have equal
+    # amplitudes.  The `ngauss` and `radii` of the galaxy must match the table.
+    amplitude_table = None
+
     @property
     def amplitudes(self):
-        """Code here for getting amplitudes from a splined look-up table
-        (dependent on self.n and self.r).  Placeholder code gives them all
-        equal amplitudes.
+        """The amplitudes of the components, interpolated from
+        `amplitude_table` (dependent on self.sersic and self.rh).  Without a
+        table all the components have equal amplitudes.
         """
-        return np.ones(self.ngauss) / (self.ngauss * 1.0)
+        if self.amplitude_table is not None:
+            return self._profile_lookup("amplitudes")
+        return self._memoized("amplitudes",
+                              lambda: np.ones(self.ngauss) / (self.ngauss * 1.0))
 
     @property
     def damplitude_dsersic(self):
-        """Code here for getting amplitude derivatives from a splined look-up
-        table (dependent on self.n and self.r)
+        """The derivatives of the component amplitudes with respect to the
+        sersic index, from `amplitude_table`.
         """
         # ngauss array of da/dsersic
-        return np.zeros(self.ngauss)
+        if self.amplitude_table is not None:
+            return self._profile_lookup("damplitude_dsersic")
+        return self._memoized("damplitude_dsersic", lambda: np.zeros(self.ngauss))
 
     @property
     def damplitude_drh(self):
-        """Code here for getting amplitude derivatives from a splined look-up
-        table (dependent on self.n and self.r)
+        """The derivatives of the component amplitudes with respect to the
+        half-light radius, from `amplitude_table`.
         """
         # ngauss array of da/drh
-        return np.zeros(self.ngauss)
+        if self.amplitude_table is not None:
+            return self._profile_lookup("damplitude_drh")
+        return self._memoized("damplitude_drh", lambda: np.zeros(self.ngauss))
+
+    def _profile_lookup(self, name):
+        if not self._is_memoized(name):
+            lookup_profiles([self])
+        return self._memoized(name, None)
 
     @property
     def covariances(self):
@@ -145,7 +228,36 @@ class Galaxy(object):
         """
         # ngauss x 2 x 2
         # this has no derivatives, since the radii are fixed.
-        return (self.radii**2)[:, None, None] * np.eye(2)
+        return self._memoized("covariances",
+                              lambda: (self.radii**2)[:, None, None] * np.eye(2))
+
+
+def lookup_profiles(sources):
+    """Interpolate the component amplitudes and their derivatives for all the
+    galaxies with an amplitude table whose profile has changed, at once for
+    each table, and memoize them.
+
+    :param sources:
+        A list of Galaxy() or Star() instances.
+    """
+    names = ["amplitudes", "damplitude_dsersic", "damplitude_drh"]
+    stale = {}
+    for s in sources:
+        table = getattr(s, "amplitude_table", None)
+        if (table is not None) and not s._is_memoized(names[0]):
+            stale.setdefault(id(table), (table, []))[1].append(s)
+    for table, galaxies in stale.values():
+        if any([g.ngauss != table.ngauss for g in galaxies]):
+            raise ValueError("Galaxy ngauss does not match the amplitude table")
+        # the amplitudes are only valid for the radii they were fit with
+        if not all([np.allclose(g.radii, table.radii) for g in galaxies]):
+            raise ValueError("Galaxy radii do not match the amplitude table")
+        nsersic = np.array([g.sersic for g in galaxies])
+        rh = np.array([g.rh for g in galaxies])
+        values = table.evaluate(nsersic, rh)
+        for i, g in enumerate(galaxies):
+            for name, v in zip(names, values):
+                g._memoize(name, v[i])
 
 
 class GaussianImageGalaxy(object):
@@ -160,6 +272,90 @@ class GaussianImageGalaxy(object):
         self.gaussians = np.zeros([ngalaxy, npsf], dtype=object)
 
 
+class GaussianBatch(object):
+    """A struct-of-arrays collection of ImageGaussians, e.g. all the image
+    gaussians of all the sources in one stamp.  Each gaussian parameter is
+    stored as a contiguous array of shape (ngauss,), ordered by source, then
+    by galaxy component, then by PSF component (i.e. the same order as
+    ``gig.gaussians.flat`` for each source).
+
+    The gaussians of the ith source are ``slice(offsets[i], offsets[i+1])``,
+    and ``source`` gives the index of the source for each gaussian.
+    """
+
+    def __init__(self, ngauss=0, nsource=0):
+        self.amp = np.zeros(ngauss)
+        self.xcen = np.zeros(ngauss)
+        self.ycen = np.zeros(ngauss)
+        self.fxx = np.zeros(ngauss)
+        self.fxy = np.zeros(ngauss)
+        self.fyy = np.zeros(ngauss)
+        self.source = np.zeros(ngauss, dtype=int)
+        self.offsets = np.zeros(nsource + 1, dtype=int)
+        self.ids = nsource * [None]
+        # nsource boolean array, True for point sources (Stars)
+        self.stars = np.zeros(nsource, dtype=bool)
+        # ngauss x NDERIV array of dGaussian_dScene Jacobians
+        self.derivs = None
+        # ngauss x 4 array of [x_lo, x_hi, y_lo, y_hi) pixel index ranges
+        # outside of which the gaussian is negligible, and the upper limit on
+        # the flux that is neglected.  See `set_footprints`.
+        self.bbox = None
+        self.flux_error = None
+
+    def __len__(self):
+        return len(self.amp)
+
+    def __getitem__(self, k):
+        """Get the kth gaussian as an ImageGaussian instance.
+        """
+        gauss = ImageGaussian()
+        gauss.amp = self.amp[k]
+        gauss.xcen, gauss.ycen = self.xcen[k], self.ycen[k]
+        gauss.fxx, gauss.fxy, gauss.fyy = self.fxx[k], self.fxy[k], self.fyy[k]
+        if self.derivs is not None:
+            gauss.derivs = self.derivs[k]
+        return gauss
+
+    @property
+    def ngauss(self):
+        return len(self.amp)
+
+    @property
+    def nsource(self):
+        return len(self.offsets) - 1
+
+    def select(self, sources):
+        """Get a new GaussianBatch containing only some of the sources.
+
+        :param sources:
+            Sequence of the indices of the sources to keep, in order.
+
+        :returns batch:
+            A GaussianBatch with copies of the gaussians of the given sources.
+            Footprints are not copied.
+        """
+        sources = np.atleast_1d(np.asarray(sources, dtype=int))
+        ncomp = np.diff(self.offsets)[sources]
+        inds = np.concatenate([np.arange(self.offsets[i], self.offsets[i+1])
+                               for i in sources] + [np.zeros(0, dtype=int)])
+        batch = GaussianBatch(len(inds), len(sources))
+        for attr in ["amp", "xcen", "ycen", "fxx", "fxy", "fyy"]:
+            setattr(batch, attr, getattr(self, attr)[inds])
+        if self.derivs is not None:
+            batch.derivs = self.derivs[inds]
+        batch.source = np.repeat(np.arange(len(sources)), ncomp)
+        batch.offsets[1:] = np.cumsum(ncomp)
+        batch.ids = [self.ids[i] for i in sources]
+        batch.stars = self.stars[sources]
+        return batch
+
+    def source_slice(self, i):
+        """The slice into the gaussian arrays for the ith source in the batch.
+        """
+        return slice(self.offsets[i], self.offsets[i+1])
+
+
 def convert_to_gaussians(galaxy, stamp):
     """Takes a set of source parameters into a set of ImagePlaneGaussians,
     including PSF, and keeping track of the dGaussian_dScene.
@@ -175,6 +371,9 @@ def convert_to_gaussians(galaxy, stamp):
        An instance of GaussianImageGalaxy, containing an array of
        ImageGaussians.
     """
+    if isinstance(galaxy, Star):
+        return _convert_star(galaxy, stamp)
+
     # Get the transformation matrix
     D = stamp.scale
     R = rotation_matrix(galaxy.pa)
@@ -220,7 +419,44 @@ def convert_to_gaussians(galaxy, stamp):
     return gig
 
 
-def get_gaussian_gradients(galaxy, stamp, gig):
+def _convert_star(star, stamp):
+    """Point source version of `convert_to_gaussians`, where each image
+    gaussian is a PSF component scaled by the flux.
+    """
+    psf = stamp.psf
+    fxx, fyy, fxy, norm = psf_terms(psf)
+    gmean = stamp.sky_to_pix([star.ra, star.dec])
+    gig = GaussianImageGalaxy(1, psf.ngauss, id=(star.id, stamp.id))
+    for j in range(psf.ngauss):
+        gauss = ImageGaussian()
+        gauss.id = (star.id, stamp.id, 0, j)
+        gauss.fxx, gauss.fxy, gauss.fyy = fxx[j], fxy[j], fyy[j]
+        gauss.xcen, gauss.ycen = gmean + psf.means[j]
+        gauss.amp = star.flux * norm[j]
+        gig.gaussians[0, j] = gauss
+
+    return gig
+
+
+def free_parameters(use_gradients=None):
+    """Make a boolean mask of the free Scene parameters of each source.
+
+    :param use_gradients: (optional)
+        A slice, list of indices or boolean mask of the parameters for which
+        gradients are wanted, as in `Scene.use_gradients`.  If None, all the
+        parameters are free.
+
+    :returns free:
+        Boolean ndarray of shape (NPARAM,)
+    """
+    free = np.zeros(NPARAM, dtype=bool)
+    if use_gradients is None:
+        use_gradients = slice(None)
+    free[use_gradients] = True
+    return free
+
+
+def get_gaussian_gradients(galaxy, stamp, gig, free=None):
     """Compute the Jacobian for dphi_i/dtheta_j where phi are the parameters of
     the Image Gaussian and theta are the parameters of the Source in the Scene.
 
@@ -237,74 +473,733 @@ def get_gaussian_gradients(galaxy, stamp, gig):
         the computed Jacobians will be assigned to the `deriv` attribute of
         each `ImageGaussian` in the `GaussianImageGalaxy`.
 
+    :param free: (optional)
+        Boolean mask of the free parameters, see `free_parameters`.  The
+        Jacobian elements for fixed parameters are not computed, and are zero.
+
     :returns gig:
-        The same as the input `gig`, but with the computed Jacobians assigned
-        to the `deriv` attribute of each of the consitituent `ImageGaussian`s
+        The same as the input `gig`, but with the computed Jacobians (in the
+        compact NDERIV format) assigned to the `deriv` attribute of each of the
+        consitituent `ImageGaussian`s
+    """
+    derivs = _compact_jacobians([galaxy], stamp, free=free)
+    for g, jac in zip(gig.gaussians.flat, derivs):
+        g.derivs = jac
+
+    return gig
+
+
+def psf_terms(psf):
+    """The inverse covariance matrix elements and normalizations of each
+    component of a PSF, which are the image gaussians of a unit flux point
+    source (up to the centers).
+
+    :param psf:
+        A PointSpreadFunction instance.
+
+    :returns fxx, fyy, fxy, norm:
+        ndarrays of shape (psf.ngauss,).  The amplitude of the image gaussian
+        of the jth PSF component for a point source of flux F is ``F * norm[j]``.
+    """
+    covar = psf.covariances
+    det = covar[:, 0, 0] * covar[:, 1, 1] - covar[:, 0, 1] * covar[:, 1, 0]
+    fxx, fyy, fxy = covar[:, 1, 1] / det, covar[:, 0, 0] / det, -covar[:, 1, 0] / det
+    norm = psf.amplitudes / (2 * np.pi * np.sqrt(det))
+    return fxx, fyy, fxy, norm
+
+
+def convert_to_gaussian_batch(sources, stamp, unit_flux=False):
+    """Convert a list of sources into a single GaussianBatch of image
+    gaussians for the given stamp, including the PSF.  This is a vectorized
+    version of `convert_to_gaussians` that treats all sources x galaxy
+    components x PSF components at once.
+
+    :param sources:
+        A list of Galaxy() or Star() instances, with the proper parameters.
+
+    :param stamp:
+        A PostageStamp() instance, with a valid PointSpreadFunction and
+        scale matrix.
+
+    :param unit_flux: (optional, default: False)
+        If True, the amplitudes are computed for sources of unit flux.
+
+    :returns batch:
+        An instance of GaussianBatch, with one entry for each pair of source
+        component and PSF component.
+    """
+    psf = stamp.psf
+    nsource, npsf = len(sources), psf.ngauss
+    ncomp = np.array([s.ngauss for s in sources], dtype=int)
+    csource = np.repeat(np.arange(nsource), ncomp)
+    lookup_profiles(sources)
+
+    # Source level quantities
+    flux, ra, dec = np.array([[s.flux, s.ra, s.dec] for s in sources]).T
+    if unit_flux:
+        flux = np.ones(nsource)
+    gmean = stamp.sky_to_pix(np.array([ra, dec]).T)
+
+    batch = GaussianBatch(ncomp.sum() * npsf, nsource)
+    batch.xcen = (gmean[csource, None, 0] + psf.means[None, :, 0]).flatten()
+    batch.ycen = (gmean[csource, None, 1] + psf.means[None, :, 1]).flatten()
+    batch.source = np.repeat(csource, npsf)
+    batch.offsets[1:] = np.cumsum(ncomp * npsf)
+    batch.ids = [s.id for s in sources]
+
+    # Point sources are just the PSF, scaled by the flux
+    isstar = np.array([isinstance(s, Star) for s in sources], dtype=bool)
+    batch.stars = isstar
+    star = isstar[batch.source]
+    if star.any():
+        fxx, fyy, fxy, norm = psf_terms(psf)
+        ipsf = np.arange(len(batch)) % npsf
+        ipsf = ipsf[star]
+        batch.fxx[star], batch.fyy[star], batch.fxy[star] = fxx[ipsf], fyy[ipsf], fxy[ipsf]
+        # TODO: Add gain/conversion from stamp to go from physical flux to counts.
+        batch.amp[star] = flux[batch.source[star]] * norm[ipsf]
+    if star.all():
+        return batch
+
+    # Extended sources, component level quantities
+    galaxies = [s for s, ps in zip(sources, isstar) if not ps]
+    gsource = np.repeat(np.arange(len(galaxies)), [g.ngauss for g in galaxies])
+    flux, q, pa = np.array([[g.flux, g.q, g.pa] for g in galaxies]).T
+    if unit_flux:
+        flux = np.ones(len(galaxies))
+    T = _transform_matrices(stamp.scale, q, pa)[0]
+    # TODO: Add gain/conversion from stamp to go from physical flux to counts.
+    gcovar = np.concatenate([g.covariances for g in galaxies])
+    gamps = np.concatenate([g.amplitudes for g in galaxies]) * flux[gsource]
+    Tc = T[gsource]
+    gcovar = np.matmul(Tc, np.matmul(gcovar, np.swapaxes(Tc, -1, -2)))
+
+    # Convolve with the PSF, yielding ncomp x npsf gaussians
+    covar = gcovar[:, None, :, :] + psf.covariances[None, :, :, :]
+    det = covar[..., 0, 0] * covar[..., 1, 1] - covar[..., 0, 1] * covar[..., 1, 0]
+
+    extended = ~star
+    batch.fxx[extended] = (covar[..., 1, 1] / det).flatten()
+    batch.fyy[extended] = (covar[..., 0, 0] / det).flatten()
+    batch.fxy[extended] = (-covar[..., 1, 0] / det).flatten()
+    batch.amp[extended] = (gamps[:, None] * psf.amplitudes[None, :] /
+                           (2 * np.pi * np.sqrt(det))).flatten()
+
+    return batch
+
+
+def set_footprints(batch, stamp, tolerance=1e-2):
+    """Determine the pixel bounding box of each gaussian in a batch, outside
+    of which the gaussian is below `tolerance` times the smallest pixel
+    uncertainty in the stamp.  The boxes bound the ellipse where
+    ``amp * exp(-0.5 * d^T F d)`` equals the threshold, and are clipped to the
+    stamp.  It is assumed that the pixel coordinates of the stamp are the pixel
+    indices, i.e. ``stamp.xpix[i, j] = i`` and ``stamp.ypix[i, j] = j``.
+
+    :param batch:
+        A GaussianBatch instance.
+
+    :param stamp:
+        A PostageStamp instance with valid `ierr`.  If all `ierr` are zero the
+        gaussians are not truncated.
+
+    :param tolerance: (optional, default: 0.01)
+        The threshold for truncation, in units of the smallest pixel
+        uncertainty.
+
+    :returns batch:
+        The input batch with the `bbox` and `flux_error` attributes set.
+        `flux_error` is the upper limit on the (absolute) flux of each gaussian
+        that falls outside its bounding box, ignoring the second order pixel
+        integration term.
+    """
+    ierr = np.max(stamp.ierr)
+    threshold = tolerance / ierr if ierr > 0 else 0.
+    amp = np.abs(batch.amp)
+    detF = batch.fxx * batch.fyy - batch.fxy * batch.fxy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k2 = 2 * np.log(amp / threshold)
+    keep = k2 > 0
+    k2 = np.where(keep, k2, 0.)
+    # half widths of the bounding box of the ellipse d^T F d = k2
+    wx = np.sqrt(k2 * batch.fyy / detF)
+    wy = np.sqrt(k2 * batch.fxx / detF)
+
+    bbox = np.zeros([len(batch), 4], dtype=int)
+    with np.errstate(invalid="ignore"):
+        bbox[:, 0] = np.clip(np.ceil(batch.xcen - wx), 0, stamp.nx)
+        bbox[:, 1] = np.clip(np.floor(batch.xcen + wx) + 1, 0, stamp.nx)
+        bbox[:, 2] = np.clip(np.ceil(batch.ycen - wy), 0, stamp.ny)
+        bbox[:, 3] = np.clip(np.floor(batch.ycen + wy) + 1, 0, stamp.ny)
+    bbox[~keep, 1] = bbox[~keep, 0]
+    bbox[~keep, 3] = bbox[~keep, 2]
+    batch.bbox = bbox
+    # the fraction of the flux outside the ellipse is exp(-k2/2)
+    batch.flux_error = 2 * np.pi / np.sqrt(detF) * np.minimum(amp, threshold)
+
+    return batch
+
+
+def compress_batch(batch, npsf, tolerance=1e-4):
+    """Reduce the number of gaussians of each (non point) source in a batch by
+    pruning or moment-merging the products of each source component with the
+    PSF components, subject to a tolerance on the integrated squared error
+    (ISE) of the image of each source.
+
+    The products of a source component with the PSF components are sorted by
+    size, and for each source component either all are kept, the largest
+    ones are merged into the single gaussian with the same flux, mean and
+    covariance, or all are dropped.  Each source component may use an equal
+    share of the error budget of the source, and takes the option that
+    removes the most gaussians within that share.  Only PSF components are
+    merged, since their relative weights do not depend on the source
+    parameters, so the merged Jacobians are exact in the compact NDERIV
+    format and the gradients are those of the compressed model.
+
+    :param batch:
+        A GaussianBatch as made by `convert_to_gaussian_batch` (and
+        `get_gaussian_batch_gradients`), with `npsf` consecutive gaussians for
+        each source component.  If it has no `derivs`, neither does the
+        compressed batch.
+
+    :param npsf:
+        The number of PSF components used to make the batch.
+
+    :param tolerance: (optional, default: 1e-4)
+        The largest allowed ISE between the original and the compressed image
+        of each source, relative to the integral of the square of the original
+        image.  Scalar or ndarray of shape (nsource,).
+
+    :returns batch:
+        A new GaussianBatch, with fewer gaussians.
+
+    :returns error:
+        ndarray of shape (nsource,) giving the achieved relative ISE of each
+        source, or rather the upper limit on it given by the triangle
+        inequality.
+    """
+    nsource = batch.nsource
+    tolerance = np.zeros(nsource) + tolerance
+    ngroup = len(batch) // npsf
+    # Flux, mean and covariance of each gaussian, ngroup x npsf, with the PSF
+    # components sorted by size (which is the same for every group)
+    detF = batch.fxx * batch.fyy - batch.fxy * batch.fxy
+    members = (2 * np.pi * batch.amp / np.sqrt(detF), batch.xcen, batch.ycen,
+               batch.fyy / detF, batch.fxx / detF, -batch.fxy / detF)
+    members = tuple(a.reshape(ngroup, npsf) for a in members)
+    order = np.argsort(members[3][0] + members[4][0]) if ngroup else np.arange(npsf)
+    members = tuple(a[:, order] for a in members)
+    w, x, y, sxx, syy, sxy = members
+    gsource = batch.source[::npsf]
+
+    # The squared norm of each source image, from all pairs of groups in it
+    ncomp = np.bincount(gsource, minlength=nsource)
+    npair = ncomp * ncomp
+    psource = np.repeat(np.arange(nsource), npair)
+    p = np.arange(npair.sum()) - (np.cumsum(npair) - npair)[psource]
+    gstart = np.cumsum(ncomp) - ncomp
+    gi = gstart[psource] + p // ncomp[psource]
+    gj = gstart[psource] + p % ncomp[psource]
+    cross = _overlap(tuple(a[gi] for a in members), tuple(a[gj] for a in members))
+    snorm2 = np.bincount(psource, weights=cross, minlength=nsource)
+
+    # ISE of each option: keep (0), merge the members from j on (j + 1), or
+    # drop (npsf + 1), and the number of gaussians removed.
+    ise = np.zeros([ngroup, npsf + 2])
+    moments = []
+    for j in range(npsf):
+        tail = tuple(a[:, j:] for a in members)
+        W = tail[0].sum(axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            f = np.where(W[:, None] != 0, tail[0] / W[:, None], 1. / (npsf - j))
+        mx, my = (f * tail[1]).sum(-1), (f * tail[2]).sum(-1)
+        dx, dy = tail[1] - mx[:, None], tail[2] - my[:, None]
+        mxx = (f * (tail[3] + dx * dx)).sum(-1)
+        myy = (f * (tail[4] + dy * dy)).sum(-1)
+        mxy = (f * (tail[5] + dx * dy)).sum(-1)
+        merged = tuple(a[:, None] for a in (W, mx, my, mxx, myy, mxy))
+        ise[:, j + 1] = (_overlap(tail, tail) - 2 * _overlap(tail, merged) +
+                         _overlap(merged, merged))
+        # do not merge components of opposite sign
+        ise[np.any(f < 0, axis=-1), j + 1] = np.inf
+        moments.append((W, mx, my, mxx, myy, mxy))
+    ise[:, -1] = _overlap(members, members)
+    ise = np.maximum(ise, 0)
+    removed = np.array([0] + [npsf - 1 - j for j in range(npsf)] + [npsf])
+
+    # Choose the option removing the most gaussians within the budget share
+    share = np.sqrt(tolerance * snorm2)[gsource] / ncomp[gsource]
+    cost = np.sqrt(ise)
+    ok = (cost <= share[:, None]) & (share[:, None] > 0)
+    ok[:, 0] = True
+    ok[batch.stars[gsource], 1:] = False
+    choice = np.argmax(np.where(ok, removed, -1), axis=-1)
+    spent = cost[np.arange(ngroup), choice]
+    error = np.bincount(gsource, weights=spent, minlength=nsource)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        error = np.where(snorm2 > 0, error**2 / snorm2, 0.)
+
+    # Assemble the new batch.  The merged gaussian replaces the first member
+    # of the merged tail, in the sorted order.
+    start = np.where(choice == npsf + 1, 0, np.where(choice == 0, npsf, choice - 1))
+    rank = np.arange(npsf)[None, :]
+    where = np.zeros([ngroup, npsf], dtype=bool)
+    where[:, order] = (rank <= start[:, None]) & (choice != npsf + 1)[:, None]
+    where[choice == 0, :] = True
+    where = where.flatten()
+    new = GaussianBatch(where.sum(), nsource)
+    for attr in ["amp", "xcen", "ycen", "fxx", "fxy", "fyy"]:
+        setattr(new, attr, getattr(batch, attr)[where].copy())
+    if batch.derivs is not None:
+        new.derivs = batch.derivs[where].copy()
+    new.source = batch.source[where]
+    new.offsets[1:] = np.cumsum(np.bincount(new.source, minlength=nsource))
+    new.ids = list(batch.ids)
+    new.stars = batch.stars
+
+    index = np.full(len(batch), -1)
+    index[where] = np.arange(where.sum())
+    index = index.reshape(ngroup, npsf)[:, order]
+    if batch.derivs is not None:
+        J = batch.derivs.reshape(ngroup, npsf, NDERIV)[:, order]
+    detF = detF.reshape(ngroup, npsf)[:, order]
+    for j in range(npsf - 1):
+        merge = choice == j + 1
+        if not merge.any():
+            continue
+        W, mx, my, mxx, myy, mxy = [m[merge] for m in moments[j]]
+        det = mxx * myy - mxy * mxy
+        Fxx, Fyy, Fxy = myy / det, mxx / det, -mxy / det
+        Amp = W * np.sqrt(1. / det) / (2 * np.pi)
+        ind = index[merge, j]
+        new.amp[ind], new.xcen[ind], new.ycen[ind] = Amp, mx, my
+        new.fxx[ind], new.fyy[ind], new.fxy[ind] = Fxx, Fyy, Fxy
+        if batch.derivs is None:
+            continue
+        Jt = J[merge, j:]
+        D = J[merge, j].copy()
+        # flux, sersic and rh only change the member amplitudes
+        scale = np.sqrt(1. / (det[:, None] * detF[merge, j:]))
+        for k in [0, 3, 4]:
+            D[:, k] = (Jt[..., k] * scale).sum(-1)
+        # q and pa change the covariance of the source component, which is the
+        # same for all members: dSigma = -Sigma dF Sigma of any member
+        s0 = (sxx[merge, j], syy[merge, j], sxy[merge, j])
+        for k, i in [(1, 9), (2, 12)]:
+            dS = _sandwich(s0, (Jt[:, 0, i], Jt[:, 0, i + 1], Jt[:, 0, i + 2]))
+            dS = [-d for d in dS]
+            D[:, k] = -0.5 * Amp * (Fxx * dS[0] + 2 * Fxy * dS[2] + Fyy * dS[1])
+            D[:, i:i + 3] = -np.array(_sandwich((Fxx, Fyy, Fxy), dS)).T
+        new.derivs[ind] = D
+
+    return new, error
+
+
+def _sandwich(a, b):
+    """The elements (xx, yy, xy) of the product A B A of symmetric 2 x 2
+    matrices given by their (xx, yy, xy) elements.
+    """
+    axx, ayy, axy = a
+    bxx, byy, bxy = b
+    cxx = axx * axx * bxx + 2 * axx * axy * bxy + axy * axy * byy
+    cyy = axy * axy * bxx + 2 * axy * ayy * bxy + ayy * ayy * byy
+    cxy = axx * axy * bxx + (axx * ayy + axy * axy) * bxy + axy * ayy * byy
+    return cxx, cyy, cxy
+
+
+def _overlap(g1, g2):
+    """The integral of the product of two sets of normalized gaussians times
+    their weights, summed over the last axis of each.
+
+    :param g1, g2:
+        Tuples of (weight, x, y, sigma_xx, sigma_yy, sigma_xy) arrays.  If the
+        arrays have shape (n, m1) and (n, m2) the integrals of all m1 x m2
+        pairs are summed, otherwise they are elementwise.
+    """
+    if np.ndim(g1[0]) == 2:
+        g1 = tuple(a[:, :, None] for a in g1)
+        g2 = tuple(a[:, None, :] for a in g2)
+    w1, x1, y1, a1, b1, c1 = g1
+    w2, x2, y2, a2, b2, c2 = g2
+    sxx, syy, sxy = a1 + a2, b1 + b2, c1 + c2
+    det = sxx * syy - sxy * sxy
+    dx, dy = x1 - x2, y1 - y2
+    chi2 = (syy * dx * dx - 2 * sxy * dx * dy + sxx * dy * dy) / det
+    o = w1 * w2 * np.exp(-0.5 * chi2) / (2 * np.pi * np.sqrt(det))
+    if o.ndim == 3:
+        return o.sum(axis=(-2, -1))
+    return o
+
+
+def get_gaussian_batch_gradients(sources, stamp, batch, free=None, unit_flux=False):
+    """Compute the Jacobians dphi_i/dtheta_j for every gaussian in a
+    GaussianBatch, where phi are the parameters of the Image Gaussian and theta
+    are the parameters of the Source in the Scene.  This is a vectorized
+    version of `get_gaussian_gradients`.
+
+    :param sources:
+        The list of sources that was used to construct the batch.
+
+    :param stamp:
+        An instance of PostageStamp with scale matrix and valid
+        PointSpreadFunction.
+
+    :param batch:
+        The `GaussianBatch` instance that resulted from
+        `convert_to_gaussian_batch(sources, stamp)`.
+
+    :param free: (optional)
+        Boolean mask of the free parameters, see `free_parameters`.  The
+        Jacobian elements for fixed parameters are not computed, and are zero.
+
+    :param unit_flux: (optional, default: False)
+        If True, the Jacobians are computed for sources of unit flux, as for
+        `convert_to_gaussian_batch(sources, stamp, unit_flux=True)`.
+
+    :returns batch:
+        The same as the input `batch`, but with the ngauss x NDERIV compact
+        Jacobians assigned to the `derivs` attribute.
+    """
+    batch.derivs = _compact_jacobians(sources, stamp, free=free, unit_flux=unit_flux)
+    return batch
+
+
+class BatchCache(object):
+    """Keeps the image gaussians (with Jacobians) of a list of sources between
+    calls, and only reconverts the sources whose parameters other than the
+    flux and position have changed, as tracked by their `shape_version`
+    attribute.
+
+    Apart from the centers and the fluxes, the image gaussians and their
+    Jacobians depend on the stamp only through the scale matrix and the PSF.
+    The shape data (the amplitudes and Jacobians for unit flux, and the
+    inverse covariances) are therefore cached once for each distinct (PSF,
+    scale) pair, and shared by the batches of all the stamps with that pair,
+    e.g. dithered exposures, or bands with the same PSF.  The centers are
+    computed for each stamp, and the amplitudes and Jacobians are scaled by
+    the flux the sources have when the batch of each stamp is made, so stamps
+    in different bands do not overwrite each other's fluxes.  Everything is
+    reconverted if the list of sources or their numbers of components change.
+    """
+
+    def __init__(self):
+        # dictionaries keyed by `shape_signature`
+        self.shapes = {}
+        # indices of the sources that were converted in the last call
+        self.last_converted = []
+
+    def get_batch(self, sources, stamp, free=None):
+        """Get the GaussianBatch for the sources in the stamp, with Jacobians.
+        The inverse covariance arrays of the returned batch are shared with
+        other stamps and updated in place by later calls.  The amplitudes and
+        Jacobians are copies for this stamp, with the current source fluxes.
+
+        :param sources:
+            A list of Galaxy() or Star() instances, with the proper parameters.
+
+        :param stamp:
+            A PostageStamp() instance, with a valid PointSpreadFunction and
+            scale matrix.
+
+        :param free: (optional)
+            Boolean mask of the free parameters, see `free_parameters`.  If no
+            parameters are free (e.g. for likelihood only calls during a line
+            search) no Jacobians are computed.  The cached Jacobians of the
+            sources that are reconverted are then marked as stale, and
+            recomputed by the next call with free parameters.
+
+        :returns batch:
+            A GaussianBatch with `derivs` set, or None if no parameters are
+            free.
+        """
+        psf = stamp.psf
+        free = free_parameters() if free is None else np.asarray(free, dtype=bool)
+        jacobians = free.any()
+        versions = [getattr(s, "shape_version", None) for s in sources]
+        key = shape_signature(stamp)
+        entry = self.shapes.get(key, None)
+        if (entry is not None) and (not jacobians):
+            # keep the cached Jacobians for the free parameters
+            free = entry["free"]
+        same = ((entry is not None) and (entry["psf"] is psf) and
+                np.all(entry["free"] == free) and
+                (len(sources) == len(entry["sources"])) and
+                all([a is b for a, b in zip(sources, entry["sources"])]) and
+                np.all(np.diff(entry["batch"].offsets) ==
+                       np.array([s.ngauss for s in sources]) * psf.ngauss))
+        if same:
+            stale = entry["stale"]
+            dirty = [i for i, (v, old) in enumerate(zip(versions, entry["versions"]))
+                     if (v is None) or (v != old) or (jacobians and stale[i])]
+        else:
+            dirty = list(range(len(sources)))
+
+        if not same:
+            shape = convert_to_gaussian_batch(sources, stamp, unit_flux=True)
+            if jacobians:
+                shape = get_gaussian_batch_gradients(sources, stamp, shape, free=free,
+                                                     unit_flux=True)
+            # The PSF component of each gaussian
+            ipsf = np.tile(np.arange(psf.ngauss), len(shape) // psf.ngauss)
+            # Hold on to the PSF so that its id is not reused
+            entry = dict(batch=shape, psf=psf, ipsf=ipsf, free=free,
+                         stale=np.zeros(len(sources), dtype=bool))
+            self.shapes[key] = entry
+        elif len(dirty) > 0:
+            update = [sources[i] for i in dirty]
+            sub = convert_to_gaussian_batch(update, stamp, unit_flux=True)
+            attrs = ["amp", "fxx", "fxy", "fyy"]
+            if jacobians:
+                sub = get_gaussian_batch_gradients(update, stamp, sub, free=free,
+                                                   unit_flux=True)
+                attrs += ["derivs"]
+            shape = entry["batch"]
+            inds = np.concatenate([np.arange(shape.offsets[i], shape.offsets[i+1])
+                                   for i in dirty])
+            for attr in attrs:
+                if getattr(shape, attr) is not None:
+                    getattr(shape, attr)[inds] = getattr(sub, attr)
+            entry["stale"][dirty] = not jacobians
+        entry["sources"] = list(sources)
+        entry["versions"] = versions
+        self.last_converted = dirty
+
+        # Now a batch with the shared shape data, and the fluxes and centers
+        # for this stamp
+        shape = entry["batch"]
+        batch = GaussianBatch()
+        for attr in ["fxx", "fxy", "fyy", "source", "offsets", "ids", "stars"]:
+            setattr(batch, attr, getattr(shape, attr))
+        flux = np.array([s.flux for s in sources], dtype=float)[batch.source]
+        batch.amp = shape.amp * flux
+        if jacobians and (shape.derivs is not None):
+            batch.derivs = shape.derivs.copy()
+            batch.derivs[:, 1:5] *= flux[:, None]
+        radec = np.array([[s.ra, s.dec] for s in sources])
+        gmean = stamp.sky_to_pix(radec)
+        pmean = psf.means[entry["ipsf"]]
+        batch.xcen = gmean[batch.source, 0] + pmean[:, 0]
+        batch.ycen = gmean[batch.source, 1] + pmean[:, 1]
+        return batch
+
+
+def shape_signature(stamp):
+    """A hashable summary of the properties of a stamp that, together with the
+    source parameters, determine the shapes of the image gaussians: the
+    identity of the PSF and the scale matrix.
+    """
+    return (id(stamp.psf), np.asarray(stamp.scale, dtype=float).tobytes())
+
+
+def _compact_jacobians(sources, stamp, free=None, unit_flux=False):
+    """Closed form computation of the nonzero elements of the dGaussian_dScene
+    Jacobians for all source components x PSF components.  This exploits the
+    fact that the source component covariances are ``r_i**2 * I``, such that
+    the covariance in the image is ``r_i**2 * T T^T + Sigma_psf``, and all
+    2 x 2 matrix algebra can be written out explicitly.
+
+    If `free` is given, only the elements for the free parameters are
+    computed, and the others are zero.  In particular the inverse covariance
+    derivatives are all zero when q and pa are fixed, so the pixel kernels can
+    skip them.
+
+    If `unit_flux` is True the sources are taken to have unit flux.  Only the
+    amplitude derivatives with respect to q, pa, sersic and rh (elements 1 to
+    4) are proportional to the flux.
+
+    :returns derivs:
+        ndarray of shape (ngauss, NDERIV), in the same order as
+        `convert_to_gaussian_batch`.
     """
-    # Get the transformation matrix
     D = stamp.scale
-    R = rotation_matrix(galaxy.pa)
-    S = scale_matrix(galaxy.q)
-    T = np.dot(D, np.dot(R, S))
+    psf = stamp.psf
+    free = free_parameters() if free is None else np.asarray(free, dtype=bool)
+    # D.flatten() = [dx/dra, dx/ddec, dy/dra, dy/ddec]
+    dpos = np.asarray(D, dtype=float).flatten() * np.tile(free[1:3], 2)
+    isstar = np.array([isinstance(s, Star) for s in sources], dtype=bool)
+    if isstar.any():
+        # Point sources only have flux and position derivatives
+        ncomp = np.array([s.ngauss for s in sources], dtype=int)
+        star = np.repeat(isstar, ncomp * psf.ngauss)
+        norm = psf_terms(psf)[-1]
+        derivs = np.zeros([len(star), NDERIV])
+        if free[0]:
+            derivs[star, 0] = np.tile(norm, isstar.sum())
+        derivs[star, 5:9] = dpos
+        if not isstar.all():
+            galaxies = [s for s, ps in zip(sources, isstar) if not ps]
+            derivs[~star] = _compact_jacobians(galaxies, stamp, free=free,
+                                               unit_flux=unit_flux)
+        return derivs
+
+    nsource = len(sources)
+    ncomp = np.array([s.ngauss for s in sources], dtype=int)
+    csource = np.repeat(np.arange(nsource), ncomp)
+    lookup_profiles(sources)
+
+    flux, q, pa = np.array([[s.flux, s.q, s.pa] for s in sources]).T
+    if unit_flux:
+        flux = np.ones(nsource)
+    T, dT_dq, dT_dpa = _transform_matrices(D, q, pa)
+    # M = T T^T and the derivatives for free q and pa, nsource x 2 x 2
+    Tt = np.swapaxes(T, -1, -2)
+    M = np.matmul(T, Tt)
+    dM = []
+    for k, dT in [(1, dT_dq), (2, dT_dpa)]:
+        if free[k + 2]:
+            dMk = np.matmul(dT, Tt)
+            dM.append((k, dMk + np.swapaxes(dMk, -1, -2)))
+
+    # Component quantities, all ncomp x 1 so they broadcast against the PSF
+    r2 = np.concatenate([s.covariances[:, 0, 0] for s in sources])[:, None]
+    am = np.concatenate([s.amplitudes for s in sources])[:, None]
+    cflux = flux[csource][:, None]
+    M = M[csource]
+    dM = [(k, dMk[csource]) for k, dMk in dM]
+
+    # Convolved covariance and its inverse, ncomp x npsf
+    pcov = psf.covariances
+    sxx = r2 * M[:, 0, 0][:, None] + pcov[None, :, 0, 0]
+    syy = r2 * M[:, 1, 1][:, None] + pcov[None, :, 1, 1]
+    sxy = r2 * M[:, 0, 1][:, None] + pcov[None, :, 0, 1]
+    det = sxx * syy - sxy * sxy
+    fxx, fyy, fxy = syy / det, sxx / det, -sxy / det
+
+    # TODO: Add gain/conversion from stamp to go from physical flux to counts
+    norm = psf.amplitudes[None, :] / (2 * np.pi * np.sqrt(det))
+    K = cflux * am * norm
+
+    derivs = np.zeros(det.shape + (NDERIV,))
+    if free[0]:
+        derivs[..., 0] = am * norm
+    if free[5]:
+        da_dsersic = np.concatenate([s.damplitude_dsersic for s in sources])[:, None]
+        derivs[..., 3] = cflux * da_dsersic * norm
+    if free[6]:
+        da_drh = np.concatenate([s.damplitude_drh for s in sources])[:, None]
+        derivs[..., 4] = cflux * da_drh * norm
+    derivs[..., 5:9] = dpos
+    for k, dMk in dM:
+        # dSigma = r**2 dM
+        p = r2 * dMk[:, 0, 0][:, None]
+        s = r2 * dMk[:, 1, 1][:, None]
+        r = r2 * dMk[:, 0, 1][:, None]
+        # dA = K/2 tr(Sigma dF) = -K/2 tr(F dSigma)
+        derivs[..., k] = -0.5 * K * (fxx * p + 2 * fxy * r + fyy * s)
+        # dF = -F dSigma F
+        i = 9 + 3 * (k - 1)
+        derivs[..., i] = -(fxx * fxx * p + 2 * fxx * fxy * r + fxy * fxy * s)
+        derivs[..., i + 1] = -(fxy * fxy * p + 2 * fxy * fyy * r + fyy * fyy * s)
+        derivs[..., i + 2] = -(fxx * fxy * p + (fxx * fyy + fxy * fxy) * r + fxy * fyy * s)
+
+    return derivs.reshape(-1, NDERIV)
+
+
+def expand_jacobian(derivs):
+    """Expand compact dGaussian_dScene Jacobians into full NPARAM x 6 matrices.
+    Each row is a different theta and has dA/dtheta, dx/dtheta, dy/dtheta,
+    dFxx/dtheta, dFyy/dtheta, dFxy/dtheta
+
+    :param derivs:
+        ndarray of shape (..., NDERIV)
+
+    :returns jac:
+        ndarray of shape (..., NPARAM, 6)
+    """
+    derivs = np.asarray(derivs)
+    jac = np.zeros(derivs.shape[:-1] + (NPARAM, 6))
+    jac[..., 0, 0] = derivs[..., 0]  # d/dFlux
+    jac[..., 1, 1] = derivs[..., 5]  # d/dAlpha
+    jac[..., 1, 2] = derivs[..., 7]
+    jac[..., 2, 1] = derivs[..., 6]  # d/dDelta
+    jac[..., 2, 2] = derivs[..., 8]
+    jac[..., 3, 0] = derivs[..., 1]  # d/dQ
+    jac[..., 3, 3:] = derivs[..., 9:12]
+    jac[..., 4, 0] = derivs[..., 2]  # d/dPA
+    jac[..., 4, 3:] = derivs[..., 12:15]
+    jac[..., 5, 0] = derivs[..., 3]  # d/dSersic
+    jac[..., 6, 0] = derivs[..., 4]  # d/dRh
+    return jac
+
+
+def apply_jacobian(derivs, dI_dphi):
+    """Multiply image gaussian derivatives by compact dGaussian_dScene
+    Jacobians, skipping all the zero elements of the full Jacobian.
+
+    :param derivs:
+        ndarray of shape (NDERIV,) or (ngauss, NDERIV)
+
+    :param dI_dphi:
+        ndarray of shape (6, ...) or (ngauss, 6, ...), the derivatives of the
+        counts with respect to the gaussian parameters as returned by
+        `compute_gaussian`
+
+    :returns dI_dtheta:
+        ndarray of shape (NPARAM, ...) or (ngauss, NPARAM, ...)
+    """
+    derivs, dI_dphi = np.asarray(derivs), np.asarray(dI_dphi)
+    axis = derivs.ndim - 1
+    extra = (1,) * (dI_dphi.ndim - derivs.ndim)
+    J = [derivs[..., k].reshape(derivs.shape[:-1] + extra) for k in range(NDERIV)]
+    dA, dx, dy, dfx, dfy, dfxy = [np.take(dI_dphi, k, axis=axis) for k in range(6)]
+    dI_dtheta = [J[0] * dA,
+                 J[5] * dx + J[7] * dy,
+                 J[6] * dx + J[8] * dy,
+                 J[1] * dA + J[9] * dfx + J[10] * dfy + J[11] * dfxy,
+                 J[2] * dA + J[12] * dfx + J[13] * dfy + J[14] * dfxy,
+                 J[3] * dA,
+                 J[4] * dA]
+    return np.stack(dI_dtheta, axis=axis)
+
+
+def source_gradients(batch, sums):
+    """Multiply the pixel-summed derivatives of each gaussian in a batch by its
+    compact Jacobian and sum over the gaussians of each source.
+
+    :param batch:
+        A GaussianBatch with compact Jacobians in the `derivs` attribute.
+
+    :param sums:
+        ndarray of shape (ngauss, 6), e.g. the sums over pixels of chi * ierr
+        times the derivatives of the counts with respect to the 6 gaussian
+        parameters.
 
-    # And its deriatives with respect to scene parameters
-    dS_dq = scale_matrix_deriv(galaxy.q)
-    dR_dpa = rotation_matrix_deriv(galaxy.pa)
-    dT_dq = np.dot(D, np.dot(R, dS_dq))
-    dT_dpa = np.dot(D, np.dot(dR_dpa, S))
+    :returns grad:
+        ndarray of shape (nsource, NPARAM)
+    """
+    grad = np.zeros([batch.nsource, NPARAM])
+    np.add.at(grad, batch.source, apply_jacobian(batch.derivs, sums))
+    return grad
 
-    for i in range(galaxy.ngauss):
-        gcovar = galaxy.covariances[i]
-        gcovar_im = np.matmul(T, np.matmul(gcovar, T.T))
-        for j in range(stamp.psf.ngauss):
-            #gaussid = (galaxy.id, stamp.id, i, j)
 
-            # convolve the jth Galaxy component with the ith PSF component
-            Sigma = gcovar_im + stamp.psf.covariances[j]
-            F = np.linalg.inv(Sigma)
-            detF = np.linalg.det(F)
-            am, al = galaxy.amplitudes[i], stamp.psf.amplitudes[j]
-            K = galaxy.flux * am * al * detF**(0.5) / (2 * np.pi)
-
-            # Now get derivatives
-            # Of F
-            dSigma_dq = (np.matmul(T, np.matmul(gcovar, dT_dq.T)) +
-                         np.matmul(dT_dq, np.matmul(gcovar, T.T)))
-            dSigma_dpa = (np.matmul(T, np.matmul(gcovar, dT_dpa.T)) +
-                          np.matmul(dT_dpa, np.matmul(gcovar, T.T)))
-            dF_dq = -np.matmul(F, np.matmul(dSigma_dq, F))  # 3
-            dF_dpa = -np.matmul(F, np.matmul(dSigma_dpa, F))  # 3
-            ddetF_dq = detF * np.trace(np.matmul(Sigma, dF_dq))
-            ddetF_dpa = detF * np.trace(np.matmul(Sigma, dF_dpa))
-            # of Amplitude
-            # TODO: Add gain/conversion from stamp to go from physical flux to counts
-            dA_dq = K / (2 * detF) * ddetF_dq  # 1
-            dA_dpa = K / (2 * detF) * ddetF_dpa  # 1
-            dA_dflux = K / galaxy.flux # 1
-            dA_dsersic = K / am * galaxy.damplitude_dsersic[i] # 1
-            dA_drh = K / am * galaxy.damplitude_drh[i] # 1
-
-            # Add derivatives to gaussians
-            # As a list of just nonzero
-            inds = [0, 3, 1] # slice into a flattened symmetric matrix to get unique components
-            derivs = ([dA_dflux, dA_dq, dA_dpa, dA_dsersic, dA_drh] +
-                      D.flatten().tolist() +
-                      dF_dq.flat[inds].tolist() +
-                      dF_dpa.flat[inds].tolist())
-            # as the 7 x 6 jacobian matrix
-            # each row is a different theta and has
-            # dA/dtheta, dx/dtheta, dy/dtheta, dFxx/dtheta, dFyy/dtheta, dFxy/dtheta
-            jac = [[dA_dflux, 0, 0, 0, 0, 0],  # d/dFlux
-                   [0, D[0, 0], D[1, 0], 0, 0, 0],  # d/dAlpha
-                   [0, D[0, 1], D[1, 1], 0, 0, 0],  # d/dDelta
-                   [dA_dq, 0, 0, dF_dq[0,0], dF_dq[1,1], dF_dq[1,0]],  # d/dQ
-                   [dA_dpa, 0, 0, dF_dpa[0,0], dF_dpa[1,1], dF_dpa[1,0]],  # d/dPA
-                   [dA_dsersic, 0, 0, 0, 0, 0],  # d/dSersic
-                   [dA_drh, 0, 0, 0, 0, 0]]  # d/dRh
-            derivs = np.array(jac)
-            gig.gaussians[i, j].derivs = derivs
+def _transform_matrices(D, q, pa):
+    """Get the transformation matrices T = D R S for a set of sources, and
+    their derivatives with respect to q and pa.
 
-    return gig
+    :param D:
+        The 2 x 2 scale matrix of the stamp.
+
+    :param q:
+        ndarray of shape (nsource,) giving the axis ratio parameter
+
+    :param pa:
+        ndarray of shape (nsource,) giving the position angle in radians
+
+    :returns T, dT_dq, dT_dpa:
+        ndarrays each of shape (nsource, 2, 2)
+    """
+    q, pa = np.atleast_1d(q), np.atleast_1d(pa)
+    c, s = np.cos(pa), np.sin(pa)
+    zero = np.zeros_like(q)
+    R = np.array([[c, -s], [s, c]])
+    dR_dpa = np.array([[-s, -c], [c, -s]])
+    S = np.array([[1. / q, zero], [zero, q]])
+    dS_dq = np.array([[-1. / q**2, zero], [zero, zero + 1]])
+    R, dR_dpa, S, dS_dq = [np.moveaxis(m, -1, 0) for m in (R, dR_dpa, S, dS_dq)]
+    T = np.matmul(D, np.matmul(R, S))
+    dT_dq = np.matmul(D, np.matmul(R, dS_dq))
+    dT_dpa = np.matmul(D, np.matmul(dR_dpa, S))
+    return T, dT_dq, dT_dpa
 
 
 def compute_gaussian(g, xpix, ypix, second_order=True, compute_deriv=True,
@@ -339,11 +1234,11 @@ def compute_gaussian(g, xpix, ypix, second_order=True, compute_deriv=True,
         normalizing the counts and calculating derivatives.
 
     :param oversample: (optional, default: False)
-        If this flag is set, the counts (and derivatives) will be calculated on
-        a grid oversampled by a factor of two in each dimension (assuming the
-        input xpix and ypix are integers), and then summed at the end to
-        produce a more precise measure of the counts in a pixel.
-        Not actually working yet.
+        If this is an integer N > 1 (or True, meaning N=2), the counts (and
+        derivatives) will be calculated on a grid of N x N sub-pixels
+        centered on each pixel, with the second order correction (if used)
+        computed for the sub-pixel size, and then averaged to produce a more
+        precise measure of the counts in a pixel.
 
     :returns counts:
         The counts in each pixel due to this gaussian, same shape as `xpix` and
@@ -360,20 +1255,93 @@ def compute_gaussian(g, xpix, ypix, second_order=True, compute_deriv=True,
     # inv_det = fxx*fyy + 2*fxy
     # norm = np.sqrt((inv_det / 2*np.pi))
 
-    if oversample:
-        xoff = np.array([0.25, -0.25, -0.25, 0.25])
-        yoff = np.array([0.25, 0.25, -0.25, -0.25])
-        xp = np.array(xpix)[..., None] + xoff[..., :]
-        yp = np.array(ypix)[..., None] + yoff[..., :]
+    nsub = 2 if oversample is True else int(oversample)
+    if nsub > 1:
+        xoff, yoff = subpixel_offsets(nsub)
+        xp = np.array(xpix)[..., None] + xoff
+        yp = np.array(ypix)[..., None] + yoff
     else:
         xp = xpix
         yp = ypix
 
+    C, dC = _gaussian_terms(g.amp, g.xcen, g.ycen, g.fxx, g.fxy, g.fyy, xp, yp,
+                            second_order=second_order, compute_deriv=compute_deriv,
+                            use_det=use_det, pixel_scale=1.0 / max(nsub, 1))
+    C = np.array(C)
+    gradients = np.zeros(1)
+    if compute_deriv:
+        gradients = np.array(dC)
+
+    if nsub > 1:
+        C = C.mean(axis=-1)
+        gradients = gradients.mean(axis=-1)
+
+    if compute_deriv:
+        return C, gradients
+    else:
+        return C
+
+
+def subpixel_offsets(nsub):
+    """The offsets of the centers of an nsub x nsub grid of sub-pixels from the
+    center of the pixel.
+
+    :returns xoff, yoff:
+        ndarrays of shape (nsub**2,)
+    """
+    off = (np.arange(nsub) + 0.5) / nsub - 0.5
+    xoff, yoff = np.meshgrid(off, off, indexing="ij")
+    return xoff.reshape(-1), yoff.reshape(-1)
+
+
+def undersampled(g, sigma):
+    """Determine which gaussians have a minor axis dispersion smaller than
+    `sigma` pixels, i.e. where the largest eigenvalue of the inverse covariance
+    matrix is larger than 1/sigma**2.
+
+    :param g:
+        An ImageGaussian or GaussianBatch instance.
+
+    :returns under:
+        Boolean (array) that is True for the undersampled gaussians.
+    """
+    fxx, fyy, fxy = np.asarray(g.fxx), np.asarray(g.fyy), np.asarray(g.fxy)
+    lmax = 0.5 * (fxx + fyy) + np.hypot(0.5 * (fxx - fyy), fxy)
+    return lmax * sigma**2 > 1
+
+
+def _gaussian_terms(amp, xcen, ycen, fxx, fxy, fyy, xp, yp,
+                    second_order=True, compute_deriv=True, use_det=False,
+                    pixel_scale=1.0, shape=True):
+    """The counts and derivatives of gaussian(s) at pixel location(s).  The
+    gaussian parameters and pixel locations can be anything that broadcasts,
+    e.g. gaussian parameters of shape (ngauss, 1) and pixel locations of shape
+    (npix,).  This is shared by `compute_gaussian` and the batched kernels so
+    that they give identical results.
+
+    :returns C:
+        The counts
+
+    :param pixel_scale: (optional, default: 1.0)
+        The linear size of the pixels, in units of the pixel coordinates.  This
+        is used for the second order term when evaluating sub-pixels.
+
+    :param shape: (optional, default: True)
+        If False, the derivatives with respect to the precision matrix are not
+        computed, and are None in the returned list.
+
+    :returns dC:
+        None if `compute_deriv` is False, otherwise a list of the 6
+        derivatives [dC_dA, dC_dx, dC_dy, dC_dfx, dC_dfy, dC_dfxy]
+    """
+    # second order term denominators, for the pixel size
+    q24, q12 = 24. / pixel_scale**2, 12. / pixel_scale**2
+
     # --- Calculate useful variables ---
-    dx = xp - g.xcen
-    dy = yp - g.ycen
-    vx = g.fxx * dx + g.fxy * dy
-    vy = g.fyy * dy + g.fxy * dx
+    dx = xp - xcen
+    dy = yp - ycen
+    vx = fxx * dx + fxy * dy
+    vy = fyy * dy + fxy * dx
     Gp = np.exp(-0.5 * (dx*vx + dy*vy))
     # G = np.exp(-0.5 * (dx*dx*fxx + 2*dx*dy*fxy + dy*dy*fyy))
     H = 1.0
@@ -381,47 +1349,43 @@ def compute_gaussian(g, xpix, ypix, second_order=True, compute_deriv=True,
 
     # --- Calculate counts ---
     if second_order:
-        H = 1 + (vx*vx + vy*vy - g.fxx - g.fyy) / 24.
+        H = 1 + (vx*vx + vy*vy - fxx - fyy) / q24
     if use_det:
-        root_det = np.sqrt(g.fxx * g.fyy - g.fxy * g.fxy)
-    C = g.amp * Gp * H * root_det
+        root_det = np.sqrt(fxx * fyy - fxy * fxy)
+    C = amp * Gp * H * root_det
+
+    if not compute_deriv:
+        return C, None
 
     # --- Calculate derivatives ---
-    if compute_deriv:
-        dC_dA = C / g.amp
-        dC_dx = C*vx
-        dC_dy = C*vy
-        dC_dfx = -0.5*C*dx*dx
-        dC_dfy = -0.5*C*dy*dy
-        dC_dfxy = -1.0*C*dx*dy
-
-    if compute_deriv and second_order:
+    dC_dA = C / amp
+    dC_dx = C*vx
+    dC_dy = C*vy
+
+    if second_order:
         c_h = C / H
-        dC_dx -= c_h * (g.fxx*vx + g.fxy*vy) / 12.
-        dC_dy -= c_h * (g.fyy*vy + g.fxy*vx) / 12.
-        dC_dfx -= c_h * (1. - 2.*dx*vx) / 24.
-        dC_dfy -= c_h * (1. - 2.*dy*vy) / 24.
-        dC_dfxy += c_h * (dy*vx + dx*vy) / 12.
+        dC_dx -= c_h * (fxx*vx + fxy*vy) / q12
+        dC_dy -= c_h * (fyy*vy + fxy*vx) / q12
 
-    if compute_deriv and use_det:
-        c_d = C / (root_det * root_det)
-        dC_dfx += 0.5 * c_d * g.fyy
-        dC_dfy += 0.5 * c_d * g.fxx
-        dC_dfxy -= c_d * g.fxy
+    if not shape:
+        return C, [dC_dA, dC_dx, dC_dy, None, None, None]
 
-    C = np.array(C)
-    gradients = np.zeros(1)
-    if compute_deriv:
-        gradients = np.array([dC_dA, dC_dx, dC_dy, dC_dfx, dC_dfy, dC_dfxy])
+    dC_dfx = -0.5*C*dx*dx
+    dC_dfy = -0.5*C*dy*dy
+    dC_dfxy = -1.0*C*dx*dy
 
-    if oversample:
-        C = C.sum(axis=-1) / 4.0
-        gradients = gradients.sum(axis=-1) / 4.0
+    if second_order:
+        dC_dfx -= c_h * (1. - 2.*dx*vx) / q24
+        dC_dfy -= c_h * (1. - 2.*dy*vy) / q24
+        dC_dfxy += c_h * (dy*vx + dx*vy) / q12
 
-    if compute_deriv:
-        return C, gradients
-    else:
-        return C
+    if use_det:
+        c_d = C / (root_det * root_det)
+        dC_dfx += 0.5 * c_d * fyy
+        dC_dfy += 0.5 * c_d * fxx
+        dC_dfxy -= c_d * fxy
+
+    return C, [dC_dA, dC_dx, dC_dy, dC_dfx, dC_dfy, dC_dfxy]
 
 
 def scale_matrix(q):
@@ -0,0 +1,934 @@
+# Batched pixel kernels, evaluating many ImageGaussians over many pixels at
+# once.  Like `ProcessPixel` in the C++ code, but vectorized over blocks of
+# gaussians and pixels instead of threads.
+
+import numpy as np
+from .gaussmodel import _gaussian_terms, NPARAM, NDERIV
+from .gaussmodel import subpixel_offsets, undersampled, apply_jacobian
+
+try:
+    import numba
+except(ImportError):
+    numba = None
+
+
+__all__ = ["compute_gaussian_batch", "compute_gaussian_sums", "compute_source_fisher",
+           "fused_lnlike",
+           "fast_exp", "FASTEXP_RTOL"]
+
+
+# --- Tables for fast_exp ---
+# exp(x) = 2**(-m) * 2**(j/N) * exp(r), with |r| <= ln(2)/(2N)
+_EXP_N = 32
+_EXP_TABLE = 2.0**(np.arange(_EXP_N) / _EXP_N)
+_EXP_POW2 = 2.0**(-np.arange(1024.))
+_EXP_MIN = -700.
+_EXP_SCALE = _EXP_N / np.log(2.)
+# The maximum relative error of fast_exp, from the r**4/24 truncation of the
+# cubic polynomial for exp(r)
+FASTEXP_RTOL = 6e-10
+
+# For the row recurrence.  Below this the exponential is always computed
+# exactly, so that the recurrence ratio can not overflow.
+_RECURRENCE_MIN = 1e-100
+
+
+def compute_gaussian_batch(batch, xpix, ypix, second_order=True,
+                           compute_deriv=True, use_det=False, offsets=None,
+                           bbox=None, pixel_index=None, dtype=np.float64,
+                           oversample=1, oversample_sigma=1.0,
+                           block_size=1024, gauss_block=32, out=None):
+    """Calculate the counts and gradients for many gaussians and many pixels.
+    The gaussians are evaluated in blocks of `gauss_block` gaussians by
+    `block_size` pixels, so that the temporary arrays stay small enough to be
+    cache resident.  The per-gaussian counts and derivatives are identical to
+    those from `compute_gaussian`.
+
+    If bounding boxes are supplied each block of gaussians is only evaluated
+    on the pixels within the union of their boxes, and the counts and
+    derivatives of each gaussian are zero outside its own box.
+
+    If `oversample` is larger than one, the gaussians with minor axis
+    dispersions smaller than `oversample_sigma` pixels are integrated over an
+    `oversample` x `oversample` grid of sub-pixels in each pixel, while the
+    others use the usual single evaluation per pixel.
+
+    :param batch:
+        A GaussianBatch instance, or an object with attributes `amp`, `xcen`,
+        `ycen`, `fxx`, `fxy` and `fyy` that are ndarrays of shape (ngauss,)
+
+    :param xpix:
+        The x coordinate of the pixels, ndarray of shape (npix,)
+
+    :param ypix:
+        The y coordinate of the pixels, ndarray of shape (npix,)
+
+    :param second_order: (optional, default: True)
+        Whether to use the 2nd order correction to the integral of the gaussian
+        within a pixel.
+
+    :param compute_deriv: (optional, default: True)
+        Whether to compute the derivatives of the counts with respect to the
+        gaussian parameters.
+
+    :param use_det: (otional, default: False)
+        Whether to include the determinant of the covariance matrix when
+        normalizing the counts and calculating derivatives.
+
+    :param offsets: (optional)
+        If given, an integer array of length nseg+1 such that the gaussians of
+        segment i are ``slice(offsets[i], offsets[i+1])``, e.g.
+        `batch.offsets`.  The counts will then be summed separately for each
+        segment.
+
+    :param bbox: (optional)
+        Integer array of shape (ngauss, 4) giving the [x_lo, x_hi, y_lo, y_hi)
+        pixel index ranges of each gaussian, e.g. `batch.bbox`.
+
+    :param pixel_index: (optional)
+        Integer array of shape (nx, ny) giving the position in `xpix` and
+        `ypix` of each pixel in the image.  Required if `bbox` is given.
+
+    :param dtype: (optional, default: np.float64)
+        The floating point type in which the gaussians are evaluated and the
+        outputs are stored, e.g. np.float32 for single precision.
+
+    :param oversample: (optional, default: 1)
+        The number of sub-pixels along each axis for undersampled gaussians.
+
+    :param oversample_sigma: (optional, default: 1.0)
+        Gaussians with minor axis dispersion smaller than this (in pixels) are
+        considered undersampled.  With the second order correction the peak
+        pixel error of a single evaluation is ~0.5% for a dispersion of 1
+        pixel, but ~15% for a dispersion of 0.4 pixels (FWHM ~ 1 pixel).
+
+    :param block_size: (optional, default: 1024)
+        The number of pixels in each block.
+
+    :param gauss_block: (optional, default: 32)
+        The number of gaussians in each block.
+
+    :param out: (optional)
+        A contiguous ndarray of shape (npix,), or (nseg, npix) if `offsets` is
+        given, and of type `dtype` in which to store the image.  It is
+        overwritten.
+
+    :returns image:
+        The counts summed over all gaussians, ndarray of shape (npix,), or the
+        counts summed over the gaussians in each segment, of shape (nseg, npix)
+        if `offsets` is given.
+
+    :returns gradients:
+        The gradients of the counts with respect to the 6 parameters of each
+        gaussian in image coordinates, ndarray of shape (ngauss, 6, npix).
+        Only returned if `compute_deriv` is True.
+    """
+    xpix = np.asarray(xpix, dtype=dtype).reshape(-1)
+    ypix = np.asarray(ypix, dtype=dtype).reshape(-1)
+    npix, ngauss = len(xpix), len(batch.amp)
+
+    if offsets is None:
+        segment = np.zeros(ngauss, dtype=int)
+        nseg = 1
+    else:
+        segment = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        nseg = len(offsets) - 1
+    if out is None:
+        image = np.zeros([nseg, npix], dtype=dtype)
+    else:
+        image = out.reshape(nseg, npix)
+        image[:] = 0
+    if compute_deriv:
+        gradients = np.zeros([ngauss, 6, npix], dtype=dtype)
+
+    blocks = _block_terms(batch, xpix, ypix, second_order=second_order,
+                          compute_deriv=compute_deriv, use_det=use_det,
+                          bbox=bbox, pixel_index=pixel_index, dtype=dtype,
+                          oversample=oversample, oversample_sigma=oversample_sigma,
+                          block_size=block_size, gauss_block=gauss_block)
+    last = None
+    for gs, ps, C, dC in blocks:
+        if gs is not last:
+            # segments of the gaussians in this block, for the sums
+            segs, starts = np.unique(segment[gs], return_index=True)
+            last = gs
+        if isinstance(ps, slice):
+            rows, cols = (segs, ps), (gs, ps)
+        else:
+            rows, cols = np.ix_(segs, ps), (np.arange(ngauss)[gs][:, None], ps)
+        image[rows] += np.add.reduceat(C, starts, axis=0)
+        if compute_deriv:
+            for k, d in enumerate(dC):
+                gradients[cols[0], k, cols[1]] = d
+
+    if out is not None:
+        image = out
+    elif offsets is None:
+        image = image[0]
+    if compute_deriv:
+        return image, gradients
+    else:
+        return image
+
+
+def compute_gaussian_sums(batch, xpix, ypix, weights, second_order=True,
+                          use_det=False, bbox=None, pixel_index=None,
+                          dtype=np.float64, oversample=1, oversample_sigma=1.0,
+                          block_size=1024, gauss_block=32, out=None):
+    """Calculate the weighted sums over pixels of the derivatives of the
+    counts of each gaussian with respect to its 6 parameters.  With `weights`
+    of chi * ierr these are the gradients of -chi^2/2 with respect to the
+    gaussian parameters, which only need to be multiplied by the (constant)
+    Jacobian of each gaussian to get the gradients with respect to the scene
+    parameters (see `gaussmodel.source_gradients`).  No derivative images are
+    stored.
+
+    :param batch:
+        A GaussianBatch instance.
+
+    :param xpix:
+        The x coordinate of the pixels, ndarray of shape (npix,)
+
+    :param ypix:
+        The y coordinate of the pixels, ndarray of shape (npix,)
+
+    :param weights:
+        The weight of each pixel, ndarray of shape (npix,)
+
+    :param out: (optional)
+        A float64 ndarray of shape (ngauss, 6) in which to store the sums.  It
+        is overwritten.
+
+    :returns sums:
+        The sums over pixels of weights * dI/dphi for each gaussian,
+        ndarray of shape (ngauss, 6).  These are always accumulated in double
+        precision.
+
+    See `compute_gaussian_batch` for the other parameters.
+    """
+    xpix = np.asarray(xpix, dtype=dtype).reshape(-1)
+    ypix = np.asarray(ypix, dtype=dtype).reshape(-1)
+    weights = np.asarray(weights, dtype=dtype).reshape(-1)
+    if out is None:
+        sums = np.zeros([len(batch.amp), 6])
+    else:
+        sums = out
+        sums[:] = 0
+
+    blocks = _block_terms(batch, xpix, ypix, second_order=second_order,
+                          compute_deriv=True, use_det=use_det,
+                          bbox=bbox, pixel_index=pixel_index, dtype=dtype,
+                          oversample=oversample, oversample_sigma=oversample_sigma,
+                          block_size=block_size, gauss_block=gauss_block,
+                          skip_shape=True)
+    for gs, ps, C, dC in blocks:
+        w = weights[ps]
+        for k, d in enumerate(dC):
+            if d is not None:
+                sums[gs, k] += np.sum(d * w, axis=-1, dtype=np.float64)
+
+    return sums
+
+
+def compute_source_fisher(batch, xpix, ypix, weights, ivar, second_order=True,
+                          use_det=False, bbox=None, pixel_index=None,
+                          dtype=np.float64, oversample=1, oversample_sigma=1.0,
+                          block_size=1024, **extras):
+    """Calculate, in a single pass over blocks of pixels, the weighted sums
+    over pixels of the derivatives of the counts of each source with respect
+    to its scene parameters, and the Fisher (Gauss-Newton) matrix of the
+    sources, ``sum(ivar * dI/dtheta_i * dI/dtheta_j)``.  The cross terms of
+    different sources are nonzero only where they overlap.  Like
+    `OutputGalaxyDeriv` in the C++ code.
+
+    Each block of pixels is evaluated for all the gaussians that overlap it
+    (according to `bbox`, if given), so that the derivative images of the
+    sources are only ever held for one block of pixels.
+
+    :param batch:
+        A GaussianBatch instance with compact Jacobians in the `derivs`
+        attribute.
+
+    :param weights:
+        The weight of each pixel for the gradients, ndarray of shape (npix,),
+        e.g. chi * ierr
+
+    :param ivar:
+        The inverse variance of each pixel, ndarray of shape (npix,)
+
+    :returns grad:
+        The sums over pixels of weights * dI/dtheta for each source, ndarray
+        of shape (nsource, NPARAM)
+
+    :returns fisher:
+        ndarray of shape (nsource, NPARAM, nsource, NPARAM).  Both outputs are
+        accumulated in double precision.
+
+    See `compute_gaussian_batch` for the other parameters.
+    """
+    xpix = np.asarray(xpix, dtype=dtype).reshape(-1)
+    ypix = np.asarray(ypix, dtype=dtype).reshape(-1)
+    weights = np.asarray(weights, dtype=dtype).reshape(-1)
+    ivar = np.asarray(ivar, dtype=dtype).reshape(-1)
+    npix, nsource = len(xpix), batch.nsource
+    grad = np.zeros([nsource, NPARAM])
+    fisher = np.zeros([nsource * NPARAM, nsource * NPARAM])
+
+    params = [np.asarray(p, dtype=dtype) for p in
+              [batch.amp, batch.xcen, batch.ycen, batch.fxx, batch.fxy, batch.fyy]]
+    derivs = np.asarray(batch.derivs, dtype=dtype)
+    source = batch.source
+    if bbox is not None:
+        # the image indices of the stored pixels
+        ix, iy = np.zeros(npix, dtype=int), np.zeros(npix, dtype=int)
+        ix[pixel_index], iy[pixel_index] = np.indices(pixel_index.shape)
+        valid = (bbox[:, 1] > bbox[:, 0]) & (bbox[:, 3] > bbox[:, 2])
+    if oversample > 1:
+        under = undersampled(batch, oversample_sigma)
+    else:
+        under = np.zeros(len(batch), dtype=bool)
+    allg = np.arange(len(batch))
+
+    for p0 in range(0, npix, block_size):
+        ps = slice(p0, min(p0 + block_size, npix))
+        box, bx, by = None, None, None
+        if bbox is None:
+            gs = allg
+        else:
+            bx, by = ix[ps], iy[ps]
+            gs = allg[valid & (bbox[:, 0] <= bx.max()) & (bbox[:, 1] > bx.min()) &
+                      (bbox[:, 2] <= by.max()) & (bbox[:, 3] > by.min())]
+        if len(gs) == 0:
+            continue
+        srcs = np.unique(source[gs])
+        # derivative images of the sources on this block
+        dI = np.zeros([len(srcs), NPARAM, len(xpix[ps])], dtype=dtype)
+        for g, nsub in [(gs[~under[gs]], 1), (gs[under[gs]], oversample)]:
+            if len(g) == 0:
+                continue
+            if bbox is not None:
+                box = bbox[g]
+            C, dC = _gaussian_block([p[g, None] for p in params], xpix[ps], ypix[ps],
+                                    nsub=nsub, box=box, bx=bx, by=by,
+                                    second_order=second_order, use_det=use_det,
+                                    dtype=dtype)
+            dI_dtheta = apply_jacobian(derivs[g], np.stack(dC, axis=1))
+            # the gaussians of each source are contiguous
+            first = np.concatenate([[0], np.where(np.diff(source[g]))[0] + 1])
+            dI[np.searchsorted(srcs, source[g][first])] += np.add.reduceat(dI_dtheta, first,
+                                                                           axis=0)
+        grad[srcs] += np.dot(dI, weights[ps].astype(np.float64))
+        M = dI.reshape(-1, dI.shape[-1]).astype(np.float64)
+        rows = (srcs[:, None] * NPARAM + np.arange(NPARAM)).reshape(-1)
+        fisher[np.ix_(rows, rows)] += np.dot(M * ivar[ps], M.T)
+
+    return grad, fisher.reshape(nsource, NPARAM, nsource, NPARAM)
+
+
+def _block_terms(batch, xpix, ypix, second_order=True, compute_deriv=True,
+                 use_det=False, bbox=None, pixel_index=None, dtype=np.float64,
+                 oversample=1, oversample_sigma=1.0, block_size=1024,
+                 gauss_block=32, skip_shape=False):
+    """Generate the counts and derivatives of blocks of gaussians on blocks of
+    pixels, for `compute_gaussian_batch` and `compute_gaussian_sums`.  If
+    `skip_shape` is True, the precision matrix derivatives are not computed
+    for blocks in which all the gaussians have zero Jacobians for them (e.g.
+    stars, or when q and pa are fixed).
+
+    :returns gs:
+        The slice or index array of the gaussians in the block.  The same
+        object is yielded for every pixel block of a given gaussian block.
+
+    :returns ps:
+        The slice or index array of the pixels in the block.
+
+    :returns C:
+        The counts, ndarray of shape (ngauss_block, npix_block)
+
+    :returns dC:
+        List of the 6 derivatives of the counts, each of shape
+        (ngauss_block, npix_block) or None if not computed, or None
+    """
+    npix = len(xpix)
+    params = [batch.amp, batch.xcen, batch.ycen, batch.fxx, batch.fxy, batch.fyy]
+    for gs, nsub in _gauss_blocks(batch, gauss_block, oversample, oversample_sigma):
+        gpars = [np.asarray(p, dtype=dtype)[gs, None] for p in params]
+        ng = len(gpars[0])
+        shape = True
+        if skip_shape and (getattr(batch, "derivs", None) is not None):
+            shape = bool(np.any(batch.derivs[gs, 9:] != 0))
+        if bbox is None:
+            pixels, nblock = None, npix
+        else:
+            box = bbox[gs]
+            pixels, ix, iy = _box_pixels(box, pixel_index)
+            nblock = len(pixels)
+        # keep the size of the temporary arrays the same when oversampling
+        bsize = max(block_size // nsub**2, 1)
+
+        for p0 in range(0, nblock, bsize):
+            if pixels is None:
+                ps = slice(p0, min(p0 + bsize, npix))
+                bx = by = None
+            else:
+                ps = slice(p0, p0 + bsize)
+                ps, bx, by = pixels[ps], ix[ps], iy[ps]
+            C, dC = _gaussian_block(gpars, xpix[ps], ypix[ps], nsub=nsub,
+                                    box=None if pixels is None else box, bx=bx, by=by,
+                                    second_order=second_order,
+                                    compute_deriv=compute_deriv, use_det=use_det,
+                                    shape=shape, dtype=dtype)
+            C = np.broadcast_to(C, (ng, len(xpix[ps])))
+            yield gs, ps, C, dC
+
+
+def _gaussian_block(gpars, xp, yp, nsub=1, box=None, bx=None, by=None,
+                    second_order=True, compute_deriv=True, use_det=False,
+                    shape=True, dtype=np.float64):
+    """Compute the counts and derivatives of a block of gaussians on a block of
+    pixels, integrating over `nsub` x `nsub` sub-pixels.
+
+    :param gpars:
+        List of the amp, xcen, ycen, fxx, fxy, fyy ndarrays of the gaussians,
+        each of shape (ng, 1)
+
+    :param xp, yp:
+        The pixel coordinates, ndarrays of shape (npix_block,)
+
+    :param box: (optional)
+        Integer ndarray of shape (ng, 4) giving the bounding box of each
+        gaussian, outside of which it is zero.  If given, `bx` and `by` must
+        be the image indices of the pixels.
+
+    :returns C, dC:
+        See `_block_terms`
+    """
+    ng = len(gpars[0])
+    if nsub > 1:
+        xoff, yoff = subpixel_offsets(nsub)
+        xp = (xp[:, None] + xoff.astype(dtype)).reshape(-1)
+        yp = (yp[:, None] + yoff.astype(dtype)).reshape(-1)
+    C, dC = _gaussian_terms(*gpars, xp=xp, yp=yp, second_order=second_order,
+                            compute_deriv=compute_deriv, use_det=use_det,
+                            pixel_scale=1.0 / nsub, shape=shape)
+    if nsub > 1:
+        C = C.reshape(ng, -1, nsub**2).mean(axis=-1)
+        if compute_deriv:
+            dC = [None if d is None else d.reshape(ng, -1, nsub**2).mean(axis=-1)
+                  for d in dC]
+    if box is not None:
+        # zero each gaussian outside its own box
+        inbox = ((bx >= box[:, 0:1]) & (bx < box[:, 1:2]) &
+                 (by >= box[:, 2:3]) & (by < box[:, 3:4]))
+        C = C * inbox
+        if compute_deriv:
+            dC = [None if d is None else d * inbox for d in dC]
+    return C, dC
+
+
+def _gauss_blocks(batch, gauss_block, oversample=1, oversample_sigma=1.0):
+    """Generate the blocks of gaussians to evaluate together.  If oversampling,
+    the undersampled gaussians are split off into their own blocks.
+
+    :returns gs, nsub:
+        The slice or index array of the gaussians in each block, and the
+        number of sub-pixels per axis to use for them.
+    """
+    ngauss = len(batch.amp)
+    if oversample > 1:
+        under = undersampled(batch, oversample_sigma)
+    if (oversample <= 1) or (not np.any(under)):
+        for g0 in range(0, ngauss, gauss_block):
+            yield slice(g0, min(g0 + gauss_block, ngauss)), 1
+        return
+    for inds, nsub in [(np.where(~under)[0], 1), (np.where(under)[0], oversample)]:
+        for g0 in range(0, len(inds), gauss_block):
+            yield inds[g0:g0 + gauss_block], nsub
+
+
+def _box_pixels(bbox, pixel_index):
+    """Get the pixels within the union of a set of bounding boxes.
+
+    :returns pixels:
+        The positions of the pixels in the flattened pixel arrays, sorted.
+
+    :returns ix, iy:
+        The image indices of each of these pixels.
+    """
+    valid = (bbox[:, 1] > bbox[:, 0]) & (bbox[:, 3] > bbox[:, 2])
+    if not np.any(valid):
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, empty
+    lo = bbox[valid][:, [0, 2]].min(axis=0)
+    hi = bbox[valid][:, [1, 3]].max(axis=0)
+    ix, iy = np.meshgrid(np.arange(lo[0], hi[0]), np.arange(lo[1], hi[1]),
+                         indexing="ij")
+    ix, iy = ix.reshape(-1), iy.reshape(-1)
+    pixels = pixel_index[ix, iy]
+    order = np.argsort(pixels)
+    return pixels[order], ix[order], iy[order]
+
+
+def fast_exp(x):
+    """A fast exponential for non-positive scalar arguments, using a table of
+    2**(j/32) and a cubic polynomial, with maximum relative error
+    `FASTEXP_RTOL`.  Arguments below -700 return zero, and positive arguments
+    use the exact exponential.  This is only faster than `math.exp` in
+    compiled code; in numpy use `np.exp`, which is already vectorized.
+    """
+    if x > 0:
+        return np.exp(x)
+    if x < _EXP_MIN:
+        return 0.0
+    n = np.floor(x * _EXP_SCALE + 0.5)
+    r = x - n / _EXP_SCALE
+    k = -int(n)
+    m = (k + _EXP_N - 1) // _EXP_N
+    j = m * _EXP_N - k
+    return _EXP_POW2[m] * _EXP_TABLE[j] * (1 + r * (1 + r * (0.5 + r * (1. / 6.))))
+
+
+def fused_lnlike(batch, xpix, ypix, data, ierr, second_order=True,
+                 use_det=False, fast_exp=False, dtype=np.float64,
+                 oversample=1, oversample_sigma=1.0, recurrence=0, jit=True,
+                 out=None, compute_gradient=True, **extras):
+    """Compute the residual, chi^2 and gradients of ln(likelihood) for a batch
+    of gaussians in a single fused loop over pixels, without storing any
+    per-gaussian or per-source images.  Like `WorkPlan::ProcessPixel` in the
+    C++ code.  This is compiled with numba if it is available, and the compiled
+    code is cached to disk.
+
+    :param batch:
+        A GaussianBatch instance with compact Jacobians in the `derivs`
+        attribute, and optionally bounding boxes in the `bbox` attribute.
+
+    :param xpix:
+        The x coordinate of the pixels, ndarray of shape (npix,)
+
+    :param ypix:
+        The y coordinate of the pixels, ndarray of shape (npix,)
+
+    :param data:
+        The pixel values, ndarray of shape (npix,)
+
+    :param ierr:
+        The inverse uncertainties of the pixels, ndarray of shape (npix,)
+
+    :param second_order: (optional, default: True)
+        Whether to use the 2nd order correction to the integral of the gaussian
+        within a pixel.
+
+    :param use_det: (otional, default: False)
+        Whether to include the determinant of the covariance matrix when
+        normalizing the counts and calculating derivatives.
+
+    :param fast_exp: (optional, default: False)
+        If True, use `fast_exp` instead of the exact exponential for both the
+        counts and the derivatives of each gaussian.  The relative error of
+        each gaussian is then at most `FASTEXP_RTOL`.
+
+    :param dtype: (optional, default: np.float64)
+        The floating point type of the pixel and gaussian computations.  The
+        sums over pixels are always accumulated in double precision.
+
+    :param oversample: (optional, default: 1)
+        The number of sub-pixels along each axis for undersampled gaussians.
+        See `compute_gaussian_batch`.
+
+    :param oversample_sigma: (optional, default: 1.0)
+        Gaussians with minor axis dispersion smaller than this (in pixels) are
+        considered undersampled.
+
+    :param recurrence: (optional, default: 0)
+        If > 1 and the pixels are ordered in complete rows of equal length
+        (constant x, and y increasing by one along each row) then the loop is
+        done row by row, and along each row the exponential of each gaussian
+        is computed with a recurrence using only multiplications.  The
+        exponential is re-evaluated exactly every `recurrence` pixels to bound
+        the accumulated rounding error.  The derivatives are computed from the
+        same values.
+
+    :param jit: (optional, default: True)
+        Whether to use the numba compiled version of the loop.  If numba is not
+        available the (very slow) pure python loop is used.
+
+    :param out: (optional)
+        A tuple of ndarrays (residual, lnp_grad) of shape (npix,) and type
+        `dtype`, and of shape (nsource, NPARAM) and type float64, in which to
+        store the outputs.  They are overwritten.  `lnp_grad` may be None,
+        e.g. if `compute_gradient` is False.
+
+    :param compute_gradient: (optional, default: True)
+        If False, only the residual and chi^2 are computed, the batch need
+        not have Jacobians, and `lnp_grad` is None.
+
+    :returns chisq:
+        The chi^2 summed over pixels.
+
+    :returns lnp_grad:
+        The gradient of -chi^2/2 with respect to the scene parameters of each
+        source in the batch, ndarray of shape (nsource, NPARAM), or None
+
+    :returns residual:
+        The data minus the model, ndarray of shape (npix,)
+    """
+    xpix = np.ascontiguousarray(np.asarray(xpix, dtype=dtype).reshape(-1))
+    ypix = np.ascontiguousarray(np.asarray(ypix, dtype=dtype).reshape(-1))
+    data = np.ascontiguousarray(np.asarray(data, dtype=dtype).reshape(-1))
+    ierr = np.ascontiguousarray(np.asarray(ierr, dtype=dtype).reshape(-1))
+    params = [np.ascontiguousarray(p, dtype=dtype) for p in
+              [batch.amp, batch.xcen, batch.ycen, batch.fxx, batch.fxy, batch.fyy]]
+    if compute_gradient:
+        derivs = np.ascontiguousarray(batch.derivs, dtype=dtype)
+    else:
+        derivs = np.zeros([len(batch), NDERIV], dtype=dtype)
+    if batch.bbox is None:
+        bbox = np.zeros([len(batch), 4], dtype=np.int64)
+        bbox[:, [0, 2]] = np.floor([xpix.min(), ypix.min()])
+        bbox[:, [1, 3]] = np.floor([xpix.max(), ypix.max()]) + 1
+    else:
+        bbox = np.ascontiguousarray(batch.bbox, dtype=np.int64)
+
+    if out is None:
+        residual = np.zeros(len(xpix), dtype=dtype)
+        lnp_grad = np.zeros([batch.nsource, NPARAM])
+    else:
+        residual, lnp_grad = out
+        residual[:] = 0
+        if lnp_grad is None:
+            lnp_grad = np.zeros([batch.nsource, NPARAM])
+        lnp_grad[:] = 0
+    scratch = np.zeros(len(batch), dtype=dtype)
+    source = np.ascontiguousarray(batch.source, dtype=np.int64)
+    nsub = np.ones(len(batch), dtype=np.int64)
+    if oversample > 1:
+        nsub[undersampled(batch, oversample_sigma)] = oversample
+    xoff, yoff = [o.astype(dtype) for o in subpixel_offsets(max(oversample, 1))]
+    # the precision matrix derivatives are only needed for gaussians with
+    # nonzero Jacobians for them, i.e. not for stars or when q and pa are fixed
+    shape = np.ascontiguousarray(np.any(derivs[:, 9:] != 0, axis=1))
+
+    ny = _row_length(xpix, ypix) if recurrence > 1 else 0
+    use_jit = jit and (numba is not None)
+    if ny > 0:
+        loop = _fused_rows_jit if use_jit else _fused_rows
+        gbuf = np.zeros([len(batch), ny], dtype=dtype)
+        wrow = np.zeros(ny, dtype=dtype)
+        chisq = loop(*params, derivs, source, bbox, nsub, shape, xoff, yoff,
+                     xpix, ypix, data, ierr,
+                     bool(second_order), bool(use_det), bool(fast_exp),
+                     bool(compute_gradient), int(recurrence), ny, residual,
+                     lnp_grad, gbuf, wrow)
+    else:
+        loop = _fused_loop_jit if use_jit else _fused_loop
+        chisq = loop(*params, derivs, source, bbox, nsub, shape, xoff, yoff,
+                     xpix, ypix, data, ierr,
+                     bool(second_order), bool(use_det), bool(fast_exp),
+                     bool(compute_gradient), residual, lnp_grad, scratch)
+
+    if not compute_gradient:
+        lnp_grad = None
+    return chisq, lnp_grad, residual
+
+
+def _fused_loop(amp, xcen, ycen, fxx, fxy, fyy, derivs, source, bbox, nsub,
+                shape, xoff, yoff, xpix, ypix, data, ierr, second_order, use_det,
+                use_fast_exp, compute_gradient, residual, lnp_grad, scratch):
+    """The per-pixel loop for `fused_lnlike`, written so that it can be
+    compiled by numba.  For each pixel the gaussians are first subtracted from
+    the data to get the residual and chi, and then the derivatives of each
+    gaussian are multiplied by the (compact) Jacobian and accumulated into
+    lnp_grad.  The exponential of each gaussian is kept in `scratch` between
+    the two passes, except for oversampled gaussians (`nsub` > 1), which are
+    averaged over the sub-pixels given by `xoff` and `yoff` in both passes.
+    The second pass is skipped if `compute_gradient` is False.
+    """
+    chisq = 0.0
+    npix, ngauss, nover = len(xpix), len(amp), len(xoff)
+    for p in range(npix):
+        x, y = xpix[p], ypix[p]
+
+        # --- Residual ---
+        r = data[p]
+        for g in range(ngauss):
+            if (x < bbox[g, 0]) or (x >= bbox[g, 1]) or (y < bbox[g, 2]) or (y >= bbox[g, 3]):
+                continue
+            if nsub[g] > 1:
+                q24 = 24. * nover
+                C = 0.0
+                for k in range(nover):
+                    dx = x + xoff[k] - xcen[g]
+                    dy = y + yoff[k] - ycen[g]
+                    Gp = _gauss_exp(dx, dy, fxx[g], fxy[g], fyy[g], use_fast_exp)
+                    C += _gauss_value(amp[g], dx, dy, fxx[g], fxy[g], fyy[g], Gp,
+                                      second_order, use_det, q24)
+                r -= C / nover
+            else:
+                dx = x - xcen[g]
+                dy = y - ycen[g]
+                Gp = _gauss_exp(dx, dy, fxx[g], fxy[g], fyy[g], use_fast_exp)
+                scratch[g] = Gp
+                r -= _gauss_value(amp[g], dx, dy, fxx[g], fxy[g], fyy[g], Gp,
+                                  second_order, use_det, 24.)
+        residual[p] = r
+        chi = r * ierr[p]
+        chisq += chi * chi
+        w = chi * ierr[p]
+        if (w == 0) or (not compute_gradient):
+            continue
+
+        # --- Derivatives ---
+        for g in range(ngauss):
+            if (x < bbox[g, 0]) or (x >= bbox[g, 1]) or (y < bbox[g, 2]) or (y >= bbox[g, 3]):
+                continue
+            if nsub[g] > 1:
+                q24 = 24. * nover
+                dC_dA, dC_dx, dC_dy, dC_dfx, dC_dfy, dC_dfxy = 0., 0., 0., 0., 0., 0.
+                for k in range(nover):
+                    dx = x + xoff[k] - xcen[g]
+                    dy = y + yoff[k] - ycen[g]
+                    Gp = _gauss_exp(dx, dy, fxx[g], fxy[g], fyy[g], use_fast_exp)
+                    d = _gauss_derivs(amp[g], dx, dy, fxx[g], fxy[g], fyy[g], Gp,
+                                      second_order, use_det, q24, shape[g])
+                    dC_dA += d[0]
+                    dC_dx += d[1]
+                    dC_dy += d[2]
+                    dC_dfx += d[3]
+                    dC_dfy += d[4]
+                    dC_dfxy += d[5]
+                wg = w / nover
+            else:
+                dx = x - xcen[g]
+                dy = y - ycen[g]
+                d = _gauss_derivs(amp[g], dx, dy, fxx[g], fxy[g], fyy[g], scratch[g],
+                                  second_order, use_det, 24., shape[g])
+                dC_dA, dC_dx, dC_dy, dC_dfx, dC_dfy, dC_dfxy = d
+                wg = w
+
+            # Multiply by the compact dGaussian_dScene and accumulate
+            J = derivs[g]
+            s = source[g]
+            lnp_grad[s, 0] += wg * (J[0] * dC_dA)
+            lnp_grad[s, 1] += wg * (J[5] * dC_dx + J[7] * dC_dy)
+            lnp_grad[s, 2] += wg * (J[6] * dC_dx + J[8] * dC_dy)
+            lnp_grad[s, 3] += wg * (J[1] * dC_dA + J[9] * dC_dfx + J[10] * dC_dfy + J[11] * dC_dfxy)
+            lnp_grad[s, 4] += wg * (J[2] * dC_dA + J[12] * dC_dfx + J[13] * dC_dfy + J[14] * dC_dfxy)
+            lnp_grad[s, 5] += wg * (J[3] * dC_dA)
+            lnp_grad[s, 6] += wg * (J[4] * dC_dA)
+
+    return chisq
+
+
+def _row_length(xpix, ypix):
+    """Find the length of the pixel rows, if the pixels are ordered in complete
+    rows of equal length with constant x and with y increasing by one along
+    each row.
+
+    :returns ny:
+        The row length, or 0 if the pixels are not ordered in rows.
+    """
+    npix = len(xpix)
+    ny = np.argmax(xpix != xpix[0]) if np.any(xpix != xpix[0]) else npix
+    if (ny == 0) or (npix % ny):
+        return 0
+    x, y = xpix.reshape(-1, ny), ypix.reshape(-1, ny)
+    if np.all(x == x[:, :1]) and np.all(np.diff(y, axis=1) == 1):
+        return int(ny)
+    return 0
+
+
+def _fused_rows(amp, xcen, ycen, fxx, fxy, fyy, derivs, source, bbox, nsub,
+                shape, xoff, yoff, xpix, ypix, data, ierr, second_order, use_det,
+                use_fast_exp, compute_gradient, recurrence, ny, residual, lnp_grad,
+                gbuf, wrow):
+    """The loop for `fused_lnlike` when the pixels are in rows of length `ny`.
+    Each row is processed gaussian by gaussian: first the counts of each
+    gaussian are subtracted along the row, then the chi-weighted image
+    derivatives of each gaussian are summed along the row and multiplied by
+    the (compact) Jacobian.
+
+    Along a row, G(y+1) = G(y) * R(y), with R(y+1) = R(y) * exp(-fyy), so
+    `exp` is called only once every `recurrence` pixels for each gaussian (or
+    when the exponential is so small that the ratio could overflow).  The
+    exponentials are kept in `gbuf` for the derivatives, and `wrow` holds the
+    chi * ierr of the current row.
+    """
+    chisq = 0.0
+    nrow, ngauss, nover = len(xpix) // ny, len(amp), len(xoff)
+    for i in range(nrow):
+        p0 = i * ny
+        x, y0 = xpix[p0], ypix[p0]
+        for j in range(ny):
+            residual[p0 + j] = data[p0 + j]
+
+        # --- Residual ---
+        for g in range(ngauss):
+            if (x < bbox[g, 0]) or (x >= bbox[g, 1]):
+                continue
+            j0 = max(int(np.ceil(bbox[g, 2] - y0)), 0)
+            j1 = min(int(np.ceil(bbox[g, 3] - y0)), ny)
+            dx = x - xcen[g]
+            if nsub[g] > 1:
+                q24 = 24. * nover
+                for j in range(j0, j1):
+                    C = 0.0
+                    for k in range(nover):
+                        ddx = dx + xoff[k]
+                        ddy = y0 + j + yoff[k] - ycen[g]
+                        Gp = _gauss_exp(ddx, ddy, fxx[g], fxy[g], fyy[g], use_fast_exp)
+                        C += _gauss_value(amp[g], ddx, ddy, fxx[g], fxy[g], fyy[g], Gp,
+                                          second_order, use_det, q24)
+                    residual[p0 + j] -= C / nover
+                continue
+            Q = np.exp(-fyy[g])
+            Gp, R = 0.0, 0.0
+            for j in range(j0, j1):
+                dy = y0 + j - ycen[g]
+                if ((j - j0) % recurrence == 0) or (Gp < _RECURRENCE_MIN):
+                    Gp = _gauss_exp(dx, dy, fxx[g], fxy[g], fyy[g], use_fast_exp)
+                    R = np.exp(-(fyy[g] * dy + fxy[g] * dx) - 0.5 * fyy[g])
+                else:
+                    Gp *= R
+                    R *= Q
+                gbuf[g, j] = Gp
+                residual[p0 + j] -= _gauss_value(amp[g], dx, dy, fxx[g], fxy[g], fyy[g],
+                                                 Gp, second_order, use_det, 24.)
+
+        # --- chi ---
+        for j in range(ny):
+            chi = residual[p0 + j] * ierr[p0 + j]
+            chisq += chi * chi
+            wrow[j] = chi * ierr[p0 + j]
+        if not compute_gradient:
+            continue
+
+        # --- Derivatives ---
+        for g in range(ngauss):
+            if (x < bbox[g, 0]) or (x >= bbox[g, 1]):
+                continue
+            j0 = max(int(np.ceil(bbox[g, 2] - y0)), 0)
+            j1 = min(int(np.ceil(bbox[g, 3] - y0)), ny)
+            dx = x - xcen[g]
+            sA, sx, sy, sfx, sfy, sfxy = 0., 0., 0., 0., 0., 0.
+            for j in range(j0, j1):
+                w = wrow[j]
+                if w == 0:
+                    continue
+                dy = y0 + j - ycen[g]
+                if nsub[g] > 1:
+                    q24 = 24. * nover
+                    w = w / nover
+                    for k in range(nover):
+                        ddx = dx + xoff[k]
+                        ddy = dy + yoff[k]
+                        Gp = _gauss_exp(ddx, ddy, fxx[g], fxy[g], fyy[g], use_fast_exp)
+                        d = _gauss_derivs(amp[g], ddx, ddy, fxx[g], fxy[g], fyy[g], Gp,
+                                          second_order, use_det, q24, shape[g])
+                        sA += w * d[0]
+                        sx += w * d[1]
+                        sy += w * d[2]
+                        sfx += w * d[3]
+                        sfy += w * d[4]
+                        sfxy += w * d[5]
+                else:
+                    d = _gauss_derivs(amp[g], dx, dy, fxx[g], fxy[g], fyy[g], gbuf[g, j],
+                                      second_order, use_det, 24., shape[g])
+                    sA += w * d[0]
+                    sx += w * d[1]
+                    sy += w * d[2]
+                    sfx += w * d[3]
+                    sfy += w * d[4]
+                    sfxy += w * d[5]
+
+            # Multiply the row sums by the compact dGaussian_dScene
+            J = derivs[g]
+            s = source[g]
+            lnp_grad[s, 0] += J[0] * sA
+            lnp_grad[s, 1] += J[5] * sx + J[7] * sy
+            lnp_grad[s, 2] += J[6] * sx + J[8] * sy
+            lnp_grad[s, 3] += J[1] * sA + J[9] * sfx + J[10] * sfy + J[11] * sfxy
+            lnp_grad[s, 4] += J[2] * sA + J[12] * sfx + J[13] * sfy + J[14] * sfxy
+            lnp_grad[s, 5] += J[3] * sA
+            lnp_grad[s, 6] += J[4] * sA
+
+    return chisq
+
+
+def _gauss_exp(dx, dy, fxx, fxy, fyy, use_fast_exp):
+    """The exponential of a single gaussian at offset (dx, dy) from its center.
+    """
+    vx = fxx * dx + fxy * dy
+    vy = fyy * dy + fxy * dx
+    if use_fast_exp:
+        return fast_exp(-0.5 * (dx*vx + dy*vy))
+    else:
+        return np.exp(-0.5 * (dx*vx + dy*vy))
+
+
+def _gauss_value(a, dx, dy, fxx, fxy, fyy, Gp, second_order, use_det, q24):
+    """The counts of a single gaussian at offset (dx, dy) from its center,
+    given the exponential `Gp`.  `q24` is 24 divided by the square of the
+    pixel size, for the second order correction.
+    """
+    vx = fxx * dx + fxy * dy
+    vy = fyy * dy + fxy * dx
+    H = 1.0
+    root_det = 1.0
+    if second_order:
+        H = 1 + (vx*vx + vy*vy - fxx - fyy) / q24
+    if use_det:
+        root_det = np.sqrt(fxx * fyy - fxy * fxy)
+    return a * Gp * H * root_det
+
+
+def _gauss_derivs(a, dx, dy, fxx, fxy, fyy, Gp, second_order, use_det, q24,
+                  shape=True):
+    """The derivatives of the counts of a single gaussian at offset (dx, dy)
+    from its center with respect to its amplitude, center, and precision
+    matrix, given the exponential `Gp`.  If `shape` is False the precision
+    matrix derivatives are not computed, and are returned as zero.
+    """
+    vx = fxx * dx + fxy * dy
+    vy = fyy * dy + fxy * dx
+    H = 1.0
+    root_det = 1.0
+    if second_order:
+        H = 1 + (vx*vx + vy*vy - fxx - fyy) / q24
+    if use_det:
+        root_det = np.sqrt(fxx * fyy - fxy * fxy)
+    dC_dA = Gp * H * root_det
+    C = a * dC_dA
+    dC_dx = C*vx
+    dC_dy = C*vy
+    if second_order:
+        c_h = C / H
+        q12 = 0.5 * q24
+        dC_dx -= c_h * (fxx*vx + fxy*vy) / q12
+        dC_dy -= c_h * (fyy*vy + fxy*vx) / q12
+    if not shape:
+        return dC_dA, dC_dx, dC_dy, 0., 0., 0.
+    dC_dfx = -0.5*C*dx*dx
+    dC_dfy = -0.5*C*dy*dy
+    dC_dfxy = -1.0*C*dx*dy
+    if second_order:
+        dC_dfx -= c_h * (1. - 2.*dx*vx) / q24
+        dC_dfy -= c_h * (1. - 2.*dy*vy) / q24
+        dC_dfxy += c_h * (dy*vx + dx*vy) / q12
+    if use_det:
+        c_d = C / (root_det * root_det)
+        dC_dfx += 0.5 * c_d * fyy
+        dC_dfy += 0.5 * c_d * fxx
+        dC_dfxy -= c_d * fxy
+    return dC_dA, dC_dx, dC_dy, dC_dfx, dC_dfy, dC_dfxy
+
+
+if numba is not None:
+    fast_exp = numba.njit(cache=True)(fast_exp)
+    _gauss_exp = numba.njit(cache=True)(_gauss_exp)
+    _gauss_value = numba.njit(cache=True)(_gauss_value)
+    _gauss_derivs = numba.njit(cache=True)(_gauss_derivs)
+    _fused_loop_jit = numba.njit(cache=True)(_fused_loop)
+    _fused_rows_jit = numba.njit(cache=True)(_fused_rows)
+else:
+    _fused_loop_jit = None
+    _fused_rows_jit = None
@@ -1,26 +1,53 @@
+import warnings
 import numpy as np
-from .gaussmodel import convert_to_gaussians, get_gaussian_gradients, compute_gaussian
+from .gaussmodel import convert_to_gaussian_batch, apply_jacobian, set_footprints
+from .gaussmodel import source_gradients, compress_batch, BatchCache, free_parameters
+from .gaussmodel import undersampled
+from .templates import get_templates
+from .kernels import compute_gaussian_batch, compute_gaussian_sums, fused_lnlike
+from .kernels import compute_source_fisher, _gaussian_block
+from .fourier import fourier_lnlike, fourier_image, render_costs
+from .worklist import WorkList, worklist_lnlike, worklist_image
+from . import kernels
 
 
-__all__ = ["WorkPlan", "make_workplans", "make_image",
+__all__ = ["WorkPlan", "FastWorkPlan", "make_workplans", "make_image",
            "negative_lnlike_multistamp"]
 
 
-def negative_lnlike_multistamp(Theta, scene=None, stamps=None):
+def negative_lnlike_multistamp(Theta, scene=None, stamps=None, plan_type=None,
+                               compute_gradient=True):
+    """
+    :param compute_gradient: (optional, default: True)
+        If False, no Jacobians or derivatives are computed, and only the
+        negative ln-likelihood is returned, e.g. for line searches.
+
+    :returns nll:
+        The negative ln-likelihood
 
+    :returns nll_grad:
+        The gradient of the negative ln-likelihood with respect to Theta.
+        Only returned if `compute_gradient` is True.
+    """
     lnp = 0.0
     lnp_grad = np.zeros(len(Theta))
-    plans, indices = make_workplans(Theta, scene, stamps)
+    plans, indices = make_workplans(Theta, scene, stamps, plan_type=plan_type,
+                                    compute_gradient=compute_gradient)
     for wp, inds in zip(plans, indices):
+        if not compute_gradient:
+            lnp += wp.lnlike(compute_gradient=False)
+            continue
         lnp_stamp, lnp_stamp_grad = wp.lnlike()
         lnp += lnp_stamp
         # TODO: test that flatten does the right thing here
         lnp_grad[inds] += lnp_stamp_grad[:, scene.use_gradients].flatten()
 
+    if not compute_gradient:
+        return -lnp
     return -lnp, -lnp_grad
 
 
-def make_workplans(Theta, scene, stamps):
+def make_workplans(Theta, scene, stamps, plan_type=None, compute_gradient=True):
     """
     :param Theta:
         The global theta vector
@@ -31,37 +58,77 @@ def make_workplans(Theta, scene, stamps):
     :param stamps:
         A list of stamp objects
 
+    :param plan_type: (optional)
+        The class of the plans, e.g. FastWorkPlan.  Defaults to WorkPlan.
+
+    :param compute_gradient: (optional, default: True)
+        If False, the Jacobians of the gaussians are not computed, so the
+        plans can only be used with ``lnlike(compute_gradient=False)``.  The
+        cached Jacobians of the sources that changed are recomputed by the
+        next call with gradients.
+
     Assumption: No two sources in a single stamp contribute to the same Theta parameter
+
+    Only the derivatives with respect to the parameters in
+    `scene.use_gradients` are computed; the gradients of the other parameters
+    are zero.
+
+    The WorkPlan of each stamp is kept in its `workplan` attribute and reused
+    by later calls with the same scene, with only the source gaussians
+    updated, so that options set on the plans persist and their buffers are
+    not reallocated.
+
+    If the scene has a `fixed_sources` list, those sources are not varied and
+    have no gradients.  Their model (with their current parameters) is
+    subtracted from the data of each stamp once, and only recomputed when the
+    list or their parameters change.
     """
     plans = []
     param_indices = []
+    # One conversion cache shared by all the stamps, so that stamps with the
+    # same PSF and scale share the shapes of the image gaussians
+    caches = [s.batch_cache for s in stamps if s.batch_cache is not None]
+    cache = caches[0] if len(caches) else BatchCache()
     for k, stamp in enumerate(stamps):
-        # Create the workplan
-        active = []
-        inds = []
-        for source in scene.sources:
-            sourceinds = scene.param_indices(source.id, stamp.filter)
-            scene.set_source_params(Theta[sourceinds], source, stamp.filter)
-            gig = convert_to_gaussians(source, stamp)
-            gig = get_gaussian_gradients(source, stamp, gig)
-            active.append(gig)
-            inds += sourceinds
-        assert len(np.unique(inds)) == len(inds)
-        # TODO: don't reintialize the workplan every call
-        plans.append(WorkPlan(stamp, active))
-        param_indices.append(inds)
-        
+        if stamp.batch_cache is None:
+            stamp.batch_cache = cache
+        plan = stamp.workplan
+        if plan_type is None:
+            plan_type = WorkPlan
+        if ((plan is None) or (type(plan) is not plan_type) or
+            (plan.scene is not scene) or (plan.stamp is not stamp)):
+            plan = plan_type(stamp, scene=scene)
+            stamp.workplan = plan
+        param_indices.append(plan.update(Theta, compute_gradient=compute_gradient))
+        plans.append(plan)
+
     return plans, param_indices
 
 
 def make_image(Theta, scene, stamp, use_sources=slice(None)):
     """This only works with WorkPlan object, not FastWorkPlan
+
+    :returns im:
+        The model image of the sources, ndarray of shape (nx, ny)
+
+    :returns grad:
+        The images of the derivatives of the model image (of `use_sources`)
+        with respect to the parameters of the stamp, ndarray of shape
+        (len(inds), npix), where row ``j`` is the derivative with respect to
+        ``Theta[inds[j]]`` and `inds` are the parameter indices returned by
+        `make_workplans` for the stamp.  The per-source images are given by
+        `WorkPlan.image_gradients`.
     """
     plans, indices = make_workplans(Theta, scene, [stamp])
     wp, inds = plans[0], indices[0]
-    wp.process_pixels()
-    im = -wp.residual[use_sources].sum(axis=0).reshape(stamp.nx, stamp.ny)
-    grad = wp.gradients[use_sources].sum(axis=0)[inds, :]
+    im = wp.make_image(use_sources)
+    gradients = wp.image_gradients()
+    use = np.zeros(wp.nactive, dtype=bool)
+    use[use_sources] = True
+    gradients[~use] = 0
+    free = getattr(scene, "use_gradients", slice(None))
+    grad = gradients[:, free, :].reshape(-1, stamp.npix)
+    assert len(grad) == len(inds)
 
     return im, grad
 
@@ -69,96 +136,679 @@ def make_image(Theta, scene, stamp, use_sources=slice(None)):
 class WorkPlan(object):
 
     """This is a stand-in for a C++ WorkPlan.  It takes a PostageStamp and
-    lists of active and fixed GaussianImageGalaxies
+    GaussianBatches of the active and fixed sources, or a Scene from which
+    they are made by `update`.  The `residual` and `gradient_sums` buffers,
+    and the chi and weight scratch buffers of the pixel-space paths, are
+    allocated once and reused by every call.  The returned gradients are new
+    arrays.
+
+    As in `WorkPlan::ProcessPixel` the fixed sources are evaluated once and
+    subtracted from the pixel data, and later calls only evaluate the active
+    sources.  The cached data minus fixed model is recomputed if the fixed
+    batch is replaced (see `set_fixed`), or if the pixel data array or the
+    kernel options change.  After changing the pixel values in place, call
+    `set_fixed` again.
     """
     
-    # options for gaussmodel.compute_gaussians
+    # options for kernels.compute_gaussian_batch
     compute_keywords = {}
     nparam = 7 # number of parameters per source
+    # If not None, each gaussian is only evaluated within the box where it
+    # exceeds this fraction of the smallest pixel uncertainty.
+    footprint_tolerance = None
+    # The precision of the pixel data, model and derivative images.  Sums over
+    # pixels are always accumulated in double precision.
+    dtype = np.float64
+    # The pixel kernel.  "numpy" uses the blocked array kernels, first for the
+    # residual and then for the chi-weighted sums of the derivatives of each
+    # gaussian; "numba" uses the compiled fused loop over pixels (falling
+    # back to "numpy" if numba is not installed).  Both store the residual
+    # (data minus model) image in `residual`.
+    backend = "numpy"
+    # Use the fast approximate exponential in the "numba" backend.  This and
+    # `recurrence` are an error for any other path (see `check_fused_options`)
+    fast_exp = False
+    # Integrate gaussians with minor axis dispersions below `oversample_sigma`
+    # pixels over an `oversample` x `oversample` grid of sub-pixels.
+    oversample = 1
+    oversample_sigma = 1.0
+    # If > 1, the "numba" backend computes the exponentials along pixel rows
+    # by recurrence, exactly re-evaluating them every `recurrence` pixels.
+    recurrence = 0
+    # "pixel" renders the gaussians in pixel space with `backend`, "fourier"
+    # sums their transforms and inverse FFTs once (see `fourier.py`), and
+    # "auto" chooses for each stamp whichever has the lower estimated cost.
+    renderer = "pixel"
+    # If > 0, point sources are rendered by interpolating pixelized PSF
+    # templates made on a grid of `star_templates` sub-pixel shifts per pixel
+    # (see `templates.py`) instead of evaluating their gaussians.
+    star_templates = 0
+    # If not None, the gaussians of the active sources are compressed on
+    # construction, with this tolerance on the relative integrated squared
+    # error of each source image.  See `gaussmodel.compress_batch`.
+    compression_tolerance = None
+    # If not None, the (sx, sy) size of superpixels.  The pixel kernels then
+    # only evaluate the pairs of superpixels and overlapping sources listed in
+    # a WorkList (see `worklist.py`), instead of using `backend`.  The source
+    # footprints are set by `footprint_tolerance`; if it is None every source
+    # overlaps every superpixel.
+    superpixel_tile = None
+    # If True, `lnlike` also accumulates the Fisher matrix of the active
+    # sources in the gradient pass, and stores it in `fisher`.  This always
+    # uses the numpy pixel kernels, whatever the `renderer` and `backend`.
+    compute_fisher = False
 
-    def __init__(self, stamp, active, fixed=None):
+    def __init__(self, stamp, active=None, fixed=None, scene=None):
         self.stamp = stamp
+        self.scene = scene
+        self.residual = None
+        self.gradient_sums = None
+        self._fixed_versions = None
+        self._worklist = None
+        self.set_fixed(fixed)
+        if active is not None:
+            self.set_active(active)
+
+    def set_active(self, active):
+        """Set the GaussianBatch of the active sources, compressing it if
+        `compression_tolerance` is not None.
+        """
         self.active = active
+        self.nactive = self.active.nsource
+        if self.compression_tolerance is not None:
+            self.compress(self.compression_tolerance)
+        self.reset()
+
+    def set_fixed(self, fixed):
+        """Set the GaussianBatch of the fixed sources (or None), and invalidate
+        the cached data minus fixed model.
+        """
         self.fixed = fixed
-        self.nactive = len(self.active)
+        self._fixed_data = None
+        self._fixed_key = None
+        self._fixed_pixels = None
+
+    def fixed_residual(self):
+        """The pixel data minus the model of the fixed sources, computed on the
+        first call after the fixed sources, data or kernel options change.
+
+        :returns data:
+            ndarray of shape (npix,) and type `dtype`.  This should not be
+            modified.
+        """
+        data = np.asarray(self.stamp.pixel_values, dtype=self.dtype).reshape(-1)
+        if (self.fixed is None) or (len(self.fixed) == 0):
+            return data
+        # the fixed sources are rendered in the same way as the active sources
+        fourier = self.use_fourier()
+        key = (np.dtype(self.dtype).str, fourier, self.oversample,
+               self.oversample_sigma, self.footprint_tolerance, self.superpixel_tile,
+               tuple(sorted(self.compute_keywords.items())))
+        # the pixel array itself is kept, since its id could be reused
+        if ((self._fixed_data is None) or (key != self._fixed_key) or
+            (self._fixed_pixels is not self.stamp.pixel_values)):
+            stamp = self.stamp
+            if fourier:
+                kwargs = {k: v for k, v in self.compute_keywords.items()
+                          if k in ["use_det"]}
+                model = stamp.from_image(fourier_image(self.fixed, stamp.to_image(stamp.xpix),
+                                                       stamp.to_image(stamp.ypix), **kwargs))
+            else:
+                kwargs = self.kernel_keywords(self.fixed)[0]
+                if self.superpixel_tile is None:
+                    model = compute_gaussian_batch(self.fixed, stamp.xpix.flat,
+                                                   stamp.ypix.flat, compute_deriv=False,
+                                                   dtype=self.dtype, **kwargs)
+                else:
+                    if kwargs.pop("bbox", None) is None:
+                        self.fixed.bbox = None
+                    worklist = self.get_worklist()
+                    worklist.set_fixed(self.fixed)
+                    model = worklist_image(worklist, self.fixed, stamp.xpix.flat,
+                                           stamp.ypix.flat, kind="fixed",
+                                           dtype=self.dtype, **kwargs)
+            self._fixed_data = (data - model).astype(self.dtype)
+            self._fixed_key = key
+            self._fixed_pixels = self.stamp.pixel_values
+        return self._fixed_data
+
+    def update(self, theta, compute_gradient=True):
+        """Set the parameters of the scene sources for the filter of this stamp
+        from the global parameter vector, and refresh the active gaussians.
+        Only the sources whose parameters have changed are reconverted (see
+        `gaussmodel.BatchCache`).
+
+        :param theta:
+            The global theta vector
+
+        :param compute_gradient: (optional, default: True)
+            If False, the Jacobians are not computed, as for no free
+            parameters.
+
+        :returns inds:
+            The indices in `theta` of the parameters of the sources, in the
+            order of the rows of the gradients returned by `lnlike`
+        """
+        scene, stamp = self.scene, self.stamp
+        inds = []
+        for source in scene.sources:
+            sourceinds = scene.param_indices(source.id, stamp.filter)
+            scene.set_source_params(theta[sourceinds], source, stamp.filter)
+            inds += sourceinds
+        assert len(np.unique(inds)) == len(inds)
+        if stamp.batch_cache is None:
+            stamp.batch_cache = BatchCache()
+        free = free_parameters(getattr(scene, "use_gradients", None))
+        if not compute_gradient:
+            free[:] = False
+        self.set_active(stamp.batch_cache.get_batch(scene.sources, stamp, free=free))
+
+        # Only reconvert the fixed sources if they or their parameters change,
+        # e.g. when a fixed source is made active
+        fixed = list(getattr(scene, "fixed_sources", []))
+        versions = [(id(s), getattr(s, "version", None)) for s in fixed]
+        if any([v is None for i, v in versions]):
+            versions = None
+        if (versions is None) or (versions != self._fixed_versions):
+            if len(fixed):
+                self.set_fixed(convert_to_gaussian_batch(fixed, stamp))
+            else:
+                self.set_fixed(None)
+        self._fixed_versions = versions
+        return inds
+
+    def compress(self, tolerance):
+        """Replace the active gaussians with a compressed set, and store the
+        achieved relative integrated squared error of each source in the
+        `compression_error` attribute.
+
+        :param tolerance:
+            Scalar or ndarray of shape (nactive,), the tolerance on the relative
+            integrated squared error of each source image.
+        """
+        self.active, self.compression_error = compress_batch(self.active,
+                                                             self.stamp.psf.ngauss,
+                                                             tolerance)
         self.reset()
 
     def reset(self):
-        self.residual = np.zeros([self.nactive, self.stamp.npix])
-        self.gradients = np.zeros([self.nactive, self.nparam, self.stamp.npix])
-        
+        """Zero the residual and gradient buffers, reallocating them only if
+        the number of pixels or gaussians or the dtype have changed.
+        """
+        self.residual = self._buffer("residual", self.stamp.npix, self.dtype)
+        self.gradient_sums = self._buffer("gradient_sums", (len(self.active), 6))
+
+    def _buffer(self, name, shape, dtype=np.float64):
+        """Get a zeroed buffer attribute of the given shape and type.
+        """
+        shape = tuple(np.atleast_1d(shape))
+        buf = getattr(self, name, None)
+        if (buf is None) or (buf.shape != shape) or (buf.dtype != dtype):
+            buf = np.zeros(shape, dtype=dtype)
+            setattr(self, name, buf)
+        else:
+            buf[:] = 0
+        return buf
+
+    def kernel_keywords(self, batch=None):
+        """Collect the keywords for the pixel kernels, setting the footprints
+        of the active gaussians (or of `batch`, if given) if
+        `footprint_tolerance` is not None.
+
+        :returns kwargs:
+            A dictionary of keywords for the pixel kernels.
+
+        :returns flux_error:
+            ndarray of shape (nsource,), an upper limit on the flux of each
+            source of the batch neglected by truncating the gaussians to their
+            footprints, or None if `footprint_tolerance` is None.
+        """
+        if batch is None:
+            batch = self.active
+        kwargs = dict(oversample=self.oversample,
+                      oversample_sigma=self.oversample_sigma)
+        kwargs.update({k: v for k, v in self.compute_keywords.items()
+                       if k in ["second_order", "use_det"]})
+        flux_error = None
+        if self.footprint_tolerance is not None:
+            set_footprints(batch, self.stamp, self.footprint_tolerance)
+            kwargs.update(bbox=batch.bbox, pixel_index=self.stamp.pixel_index)
+            flux_error = np.bincount(batch.source, weights=batch.flux_error,
+                                     minlength=batch.nsource)
+        return kwargs, flux_error
+
     def process_pixels(self, blockID=None, threadID=None):
-        """Here we are doing all pixels at once instead of one superpixel at a
+        """Compute the residual (data minus model) of all the active gaussians.
+        Here we are doing all pixels at once instead of one superpixel at a
         time (like on a GPU)
         """
-        for i, gig in enumerate(self.active):
-            for j, g in enumerate(gig.gaussians.flat):
-                # get the image counts and gradients for each Gaussian in a GaussianGalaxy
-                I, dI_dphi = compute_gaussian(g, self.stamp.xpix.flat, self.stamp.ypix.flat,
-                                              **self.compute_keywords)
-                # Store the residual.  In reality we will want to sum over
-                # sources here (and divide by error) to compute chi directly
-                # and avoid huge storage.
-                self.residual[i, ...] -= I
-                # Accumulate the *image* derivatives w.r.t. theta from each gaussian
-                # This matrix multiply can be optimized (many zeros in g.derivs)
-                # In reality we will want to multiply by chi and sum over pixels *HERE* to avoid storage
-                self.gradients[i, :, :] += np.matmul(g.derivs, dI_dphi)
-
-    def lnlike(self, active=None, fixed=None):
+        kwargs, self.flux_error = self.kernel_keywords()
+        # the model is computed in the residual buffer, then subtracted from the data
+        compute_gaussian_batch(self.active, self.stamp.xpix.flat,
+                               self.stamp.ypix.flat, compute_deriv=False,
+                               dtype=self.dtype, out=self.residual, **kwargs)
+        np.subtract(self.fixed_residual(), self.residual, out=self.residual)
+
+    def process_gradients(self, weights):
+        """Sum the derivatives of each active gaussian over pixels with the
+        given weights, then apply the Jacobians.
+
+        :param weights:
+            ndarray of shape (npix,), e.g. chi * ierr
+
+        :returns grad:
+            ndarray of shape (nactive, nparam)
+        """
+        kwargs, self.flux_error = self.kernel_keywords()
+        compute_gaussian_sums(self.active, self.stamp.xpix.flat,
+                              self.stamp.ypix.flat, weights, dtype=self.dtype,
+                              out=self.gradient_sums, **kwargs)
+        return source_gradients(self.active, self.gradient_sums)
+
+    def lnlike(self, active=None, fixed=None, compute_gradient=True):
         """Returns a ch^2 value and a chi^2 gradient array of shape (nsource, nparams)
+
+        :param active: (optional)
+            A new GaussianBatch of the active sources.
+
+        :param fixed: (optional)
+            A new GaussianBatch of the fixed sources.  If not given, the cached
+            model of the current fixed sources is used.
+
+        :param compute_gradient: (optional, default: True)
+            If False, no derivatives are computed and only the ln-likelihood is
+            returned.  The active batch need not have Jacobians.
         """
-        self.reset()
         if active is not None:
-            self.active = active
-        self.fixed = fixed
+            self.set_active(active)
+        else:
+            self.reset()
+        if fixed is not None:
+            self.set_fixed(fixed)
+        if self.compute_fisher and compute_gradient:
+            path = "fisher"
+        elif self.use_fourier():
+            path = "fourier"
+        elif self.star_templates and self.active.stars.any():
+            path = "templates"
+        elif self.superpixel_tile is not None:
+            path = "worklist"
+        elif self.backend == "numba":
+            path = "fused" if kernels.numba is not None else "numpy"
+        else:
+            path = "numpy"
+        self.check_fused_options(path)
+
+        if path == "fisher":
+            return self.lnlike_fisher()
+        if path == "fourier":
+            return self.lnlike_fourier(compute_gradient=compute_gradient)
+        if path == "templates":
+            return self.lnlike_templates(compute_gradient=compute_gradient)
+        if path == "worklist":
+            return self.lnlike_worklist(compute_gradient=compute_gradient)
+        if path == "fused":
+            return self.lnlike_fused(compute_gradient=compute_gradient)
+
         self.process_pixels()
-        # Do all the sums over pixels (and sources) here.  This is super inefficient.
-        chi = (self.stamp.pixel_values.flatten() + self.residual.sum(axis=0)) * self.stamp.ierr
+        ierr = np.asarray(self.stamp.ierr, dtype=self.dtype).reshape(-1)
+        chi = self._buffer("chi", self.stamp.npix, self.dtype)
+        weights = self._buffer("weights", self.stamp.npix, self.dtype)
+        np.multiply(self.residual, ierr, out=chi)
+        # The sums over pixels are pairwise, in double precision
+        chisq = np.sum(np.multiply(chi, chi, out=weights), axis=-1, dtype=np.float64)
+        if not compute_gradient:
+            return -0.5 * chisq
+        lnp_grad = self.process_gradients(np.multiply(chi, ierr, out=weights))
 
-        return -0.5 * np.sum(chi*chi, axis=-1), np.sum(chi * self.stamp.ierr * self.gradients, axis=-1)
+        return -0.5 * chisq, lnp_grad
 
+    def check_fused_options(self, path):
+        """Make sure that `fast_exp` and `recurrence` are only set when the
+        fused numba loop is used.  If the "numba" backend was chosen but numba
+        is not installed, the numpy kernels are used with a warning;
+        otherwise a ValueError is raised.
 
-    def make_image(self, use_sources=slice(None)):
+        :param path:
+            The name of the path that `lnlike` will take, e.g. "fused".
+        """
+        if path == "fused":
+            return
+        options = [k for k, v in [("fast_exp", self.fast_exp),
+                                  ("recurrence", self.recurrence > 1)] if v]
+        if not len(options):
+            return
+        if (path == "numpy") and (self.backend == "numba"):
+            warnings.warn("numba is not installed, so the options {} "
+                          "have no effect".format(options))
+        else:
+            raise ValueError("The options {} only apply to the numba backend, "
+                             "but the {} path is used".format(options, path))
+
+    def lnlike_fused(self, jit=True, compute_gradient=True):
+        """Compute the ln-likelihood and its gradients with the fused per-pixel
+        loop of `kernels.fused_lnlike`.
+        """
+        batch = self.active
+        kwargs, self.flux_error = self.kernel_keywords()
+        kwargs.pop("pixel_index", None)
+        if kwargs.pop("bbox", None) is None:
+            batch.bbox = None
+        lnp_grad = None
+        if compute_gradient:
+            lnp_grad = np.zeros([batch.nsource, self.nparam])
+        chisq, lnp_grad, _ = fused_lnlike(batch, self.stamp.xpix.flat,
+                                          self.stamp.ypix.flat,
+                                          self.fixed_residual(),
+                                          self.stamp.ierr,
+                                          fast_exp=self.fast_exp,
+                                          recurrence=self.recurrence,
+                                          dtype=self.dtype, jit=jit,
+                                          out=(self.residual, lnp_grad),
+                                          compute_gradient=compute_gradient,
+                                          **kwargs)
+        if not compute_gradient:
+            return -0.5 * chisq
+        return -0.5 * chisq, lnp_grad
+
+    def lnlike_fisher(self):
+        """Compute the ln-likelihood and its gradients with the numpy pixel
+        kernels, and accumulate the Fisher matrix of the active sources,
+        ``sum(ivar * dI/dtheta_i * dI/dtheta_j)``, in the same pass over the
+        pixels as the gradients.  The matrix is stored in the `fisher`
+        attribute, an ndarray of shape (nactive, nparam, nactive, nparam).
+        Its inverse is the covariance matrix of the parameters near the
+        maximum of the likelihood.  The `gradient_sums` are not computed.
+        """
         self.process_pixels()
-        return self.residual[use_source, ...].sum(axis=0).reshape(self.stamp.nx, self.stamp.ny)
+        ierr = np.asarray(self.stamp.ierr, dtype=self.dtype).reshape(-1)
+        chi = self._buffer("chi", self.stamp.npix, self.dtype)
+        weights = self._buffer("weights", self.stamp.npix, self.dtype)
+        np.multiply(self.residual, ierr, out=chi)
+        chisq = np.sum(np.multiply(chi, chi, out=weights), axis=-1, dtype=np.float64)
+        np.multiply(chi, ierr, out=weights)
+        kwargs, self.flux_error = self.kernel_keywords()
+        lnp_grad, self.fisher = compute_source_fisher(self.active, self.stamp.xpix.flat,
+                                                      self.stamp.ypix.flat, weights,
+                                                      ierr * ierr, dtype=self.dtype,
+                                                      **kwargs)
+        return -0.5 * chisq, lnp_grad
+
+    def get_worklist(self):
+        """Get the WorkList of the stamp for `superpixel_tile`, making a new
+        one if the tile size or the pixel layout of the stamp have changed.
+        """
+        key = (tuple(self.superpixel_tile), id(self.stamp.pixel_order))
+        if (self._worklist is None) or (self._worklist[0] != key):
+            self._worklist = key, WorkList(self.stamp, tile=self.superpixel_tile)
+        return self._worklist[1]
+
+    def lnlike_worklist(self, compute_gradient=True):
+        """Compute the ln-likelihood and its gradients with the numpy pixel
+        kernels, only evaluating the pairs of superpixels and active sources in
+        the WorkList, which is rebuilt from the footprints on every call.
+        """
+        batch, stamp = self.active, self.stamp
+        kwargs, self.flux_error = self.kernel_keywords()
+        kwargs.pop("pixel_index", None)
+        if kwargs.pop("bbox", None) is None:
+            batch.bbox = None
+        data = self.fixed_residual()
+        worklist = self.get_worklist()
+        worklist.set_active(batch)
+        ierr = np.asarray(stamp.ierr, dtype=self.dtype).reshape(-1)
+        chisq, sums, _ = worklist_lnlike(worklist, batch, stamp.xpix.flat,
+                                         stamp.ypix.flat, data, ierr,
+                                         dtype=self.dtype,
+                                         out=(self.residual, self.gradient_sums),
+                                         compute_gradient=compute_gradient,
+                                         **kwargs)
+        if not compute_gradient:
+            return -0.5 * chisq
+        return -0.5 * chisq, source_gradients(batch, sums)
+
+    def lnlike_templates(self, compute_gradient=True):
+        """Compute the ln-likelihood and its gradients with the point sources
+        rendered from interpolated PSF templates, and the other sources with
+        the numpy pixel kernels.  The `gradient_sums` of the point source
+        gaussians are not computed.
+        """
+        batch, stamp = self.active, self.stamp
+        stars = np.where(batch.stars)[0]
+        others = np.where(~batch.stars)[0]
+        kw = {k: v for k, v in self.compute_keywords.items()
+              if k in ["second_order", "use_det"]}
+        templates = get_templates(stamp, nshift=self.star_templates, **kw)
+        xcen, ycen, flux = templates.star_parameters(batch, stars)
+        model = stamp.from_image(templates.render(xcen, ycen, flux, stamp.nx, stamp.ny))
+        model = model.astype(self.dtype)
+        if len(others):
+            galaxies = batch.select(others)
+            kwargs, flux_error = self.kernel_keywords(galaxies)
+            model += compute_gaussian_batch(galaxies, stamp.xpix.flat, stamp.ypix.flat,
+                                            compute_deriv=False, dtype=self.dtype,
+                                            **kwargs)
+            if flux_error is not None:
+                # the point sources are not truncated
+                self.flux_error = np.zeros(self.nactive)
+                self.flux_error[others] = flux_error
+        np.subtract(self.fixed_residual(), model, out=self.residual)
+        ierr = np.asarray(stamp.ierr, dtype=self.dtype).reshape(-1)
+        chi = self._buffer("chi", stamp.npix, self.dtype)
+        weights = self._buffer("weights", stamp.npix, self.dtype)
+        np.multiply(self.residual, ierr, out=chi)
+        chisq = np.sum(np.multiply(chi, chi, out=weights), axis=-1, dtype=np.float64)
+        if not compute_gradient:
+            return -0.5 * chisq
+
+        np.multiply(chi, ierr, out=weights)
+        lnp_grad = np.zeros([self.nactive, self.nparam])
+        sums = templates.sums(xcen, ycen, flux, stamp.to_image(weights))
+        # position derivatives through dx/dra, dx/ddec, dy/dra, dy/ddec
+        D = batch.derivs[batch.offsets[stars], 5:9]
+        lnp_grad[stars, 0] = sums[:, 0]
+        lnp_grad[stars, 1] = sums[:, 1] * D[:, 0] + sums[:, 2] * D[:, 2]
+        lnp_grad[stars, 2] = sums[:, 1] * D[:, 1] + sums[:, 2] * D[:, 3]
+        # the gradients of parameters that are not free are zero
+        lnp_grad[stars] *= free_parameters(getattr(self.scene, "use_gradients", None))
+        if len(others):
+            gsums = compute_gaussian_sums(galaxies, stamp.xpix.flat, stamp.ypix.flat,
+                                          weights, dtype=self.dtype, **kwargs)
+            lnp_grad[others] = source_gradients(galaxies, gsums)
+            self.gradient_sums[~batch.stars[batch.source]] = gsums
+        return -0.5 * chisq, lnp_grad
+
+    def use_fourier(self):
+        """Decide whether to render this stamp in Fourier space.
+        """
+        if self.renderer == "auto":
+            if self.footprint_tolerance is not None:
+                set_footprints(self.active, self.stamp, self.footprint_tolerance)
+            pixel_cost, fourier_cost = render_costs(self.active, self.stamp)
+            return fourier_cost < pixel_cost
+        return self.renderer == "fourier"
+
+    def lnlike_fourier(self, compute_gradient=True):
+        """Compute the ln-likelihood and its gradients by rendering the stamp in
+        Fourier space with `fourier.fourier_lnlike`.  The gaussians are
+        integrated exactly over pixels, so `second_order` and `oversample` do
+        not apply.
+        """
+        kwargs = {k: v for k, v in self.compute_keywords.items()
+                  if k in ["use_det"]}
+        stamp = self.stamp
+        if not compute_gradient:
+            model = fourier_image(self.active, stamp.to_image(stamp.xpix),
+                                  stamp.to_image(stamp.ypix), **kwargs)
+            np.subtract(self.fixed_residual(), stamp.from_image(model), out=self.residual)
+            ierr = np.asarray(stamp.ierr, dtype=self.dtype).reshape(-1)
+            chi = self._buffer("chi", stamp.npix, self.dtype)
+            np.multiply(self.residual, ierr, out=chi)
+            return -0.5 * np.sum(chi*chi, axis=-1, dtype=np.float64)
+        chisq, lnp_grad, residual = fourier_lnlike(self.active, stamp.to_image(stamp.xpix),
+                                                   stamp.to_image(stamp.ypix),
+                                                   stamp.to_image(self.fixed_residual()),
+                                                   stamp.to_image(stamp.ierr), **kwargs)
+        self.residual[:] = stamp.from_image(residual)
+        return -0.5 * chisq, lnp_grad
+
+    def make_image(self, use_sources=slice(None)):
+        """Make the model image of (some of) the active sources.
+        """
+        kwargs, self.flux_error = self.kernel_keywords()
+        images = compute_gaussian_batch(self.active, self.stamp.xpix.flat,
+                                        self.stamp.ypix.flat, compute_deriv=False,
+                                        offsets=self.active.offsets, dtype=self.dtype,
+                                        **kwargs)
+        return self.stamp.to_image(images[use_sources].sum(axis=0))
+
+    def image_gradients(self):
+        """Make the images of the derivatives of each active source with respect
+        to its parameters.  This stores nactive * nparam images, and is only
+        for diagnostics; the likelihood uses `process_gradients`.
+
+        :returns gradients:
+            ndarray of shape (nactive, nparam, npix)
+        """
+        batch = self.active
+        kwargs, self.flux_error = self.kernel_keywords()
+        _, dI_dphi = compute_gaussian_batch(batch, self.stamp.xpix.flat,
+                                            self.stamp.ypix.flat, dtype=self.dtype,
+                                            **kwargs)
+        gradients = np.zeros([self.nactive, self.nparam, self.stamp.npix], dtype=self.dtype)
+        for i in range(self.nactive):
+            sl = batch.source_slice(i)
+            gradients[i] = apply_jacobian(batch.derivs[sl], dI_dphi[sl]).sum(axis=0)
+        return gradients
 
 
 class FastWorkPlan(WorkPlan):
-    """Like WorkPlan, but we cumulate the residuals over sources once, and cumulate chisq gradients
+    """Like WorkPlan, but the pixels are streamed in chunks of `chunk_size`.
+    The model of all the active sources is first accumulated chunk by chunk
+    into the single residual vector, and then the chi-weighted sums of the
+    derivatives of each gaussian are accumulated chunk by chunk and
+    multiplied by the Jacobians.  Only one chunk of pixels is evaluated at a
+    time, for at most `gauss_block` gaussians, so no per-source or
+    per-gaussian images are stored and the memory use scales with npix.  If
+    `footprint_tolerance` is set, only the gaussians that overlap each chunk
+    are evaluated for it.
+
+    The pixel-space options of WorkPlan (`dtype`, `oversample`,
+    `footprint_tolerance`, `compression_tolerance` and `compute_keywords`)
+    apply, but the other renderers and kernels do not; `lnlike` raises a
+    ValueError if any of the `unsupported` options differ from their WorkPlan
+    defaults.
     """
-    
-    def reset(self):
-        self.residual = self.stamp.pixel_values.flatten()
-        self.gradients = np.zeros([self.nsource, self.nparam])
-        
-    def process_pixels(self, blockID=None, threadID=None):
-        """Here we are doing all pixels at once instead of one superpixel at a
-        time (like on a GPU).
-        """
-        for i, gig in enumerate(self.active):
-            for j, g in enumerate(gig.gaussians.flat):
-                # get the image counts for each Gaussian in a GaussianGalaxy
-                self.compute_keywords['compute_deriv'] = False
-                self.residual -= compute_gaussian(g, self.stamp.xpix.flat, self.stamp.ypix.flat,
-                                                  **self.compute_keywords)
-                # Store the residual.
-                self.residual -= I
-        for i, gig in enumerate(self.active):
-            for j, g in enumerate(gig.gaussians.flat):
-                self.compute_keywords['compute_deriv'] = True
-                # get the image gradients for each Gaussian in a GaussianGalaxy
-                I, dI_dphi = compute_gaussian(g, self.stamp.xpix.flat, self.stamp.ypix.flat,
-                                              **self.compute_keywords)
-                # Accumulate the *chisq* derivatives w.r.t. theta from each gaussian
-                # This matrix multiply can be optimized (many zeros in g.derivs)
-                self.gradients[i, :] += (self.residual * self.ivar * np.matmul(g.derivs, dI_dphi)).sum(axis=-1)
-
-    def lnlike(self, active, fixed=None):
-        self.reset()
-        self.active = active
-        self.fixed = fixed
+
+    chunk_size = 4096
+    gauss_block = 32
+    unsupported = ["backend", "fast_exp", "recurrence", "renderer", "star_templates",
+                   "superpixel_tile", "compute_fisher"]
+
+    def lnlike(self, active=None, fixed=None, compute_gradient=True):
+        """Returns a ch^2 value and a chi^2 gradient array of shape (nsource, nparams)
+
+        :param active: (optional)
+            A new GaussianBatch of the active sources.
+
+        :param fixed: (optional)
+            A new GaussianBatch of the fixed sources.
+
+        :param compute_gradient: (optional, default: True)
+            If False, only the ln-likelihood is computed and returned.
+        """
+        changed = [k for k in self.unsupported
+                   if getattr(self, k) != getattr(WorkPlan, k)]
+        if len(changed):
+            raise ValueError("FastWorkPlan does not support the options {}".format(changed))
+        if active is not None:
+            self.set_active(active)
+        else:
+            self.reset()
+        if fixed is not None:
+            self.set_fixed(fixed)
         self.process_pixels()
-        chi = self.residual * self.stamp.ierr
+        ierr = np.asarray(self.stamp.ierr, dtype=self.dtype).reshape(-1)
+        chi = self.residual * ierr
+        chisq = np.sum(chi*chi, axis=-1, dtype=np.float64)
+        if not compute_gradient:
+            return -0.5 * chisq
+        lnp_grad = self.process_gradients(chi * ierr)
+
+        return -0.5 * chisq, lnp_grad
+
+    def process_pixels(self, blockID=None, threadID=None):
+        """Accumulate the residual (data minus model) of all the active
+        gaussians, one chunk of pixels at a time.
+        """
+        self.residual[:] = self.fixed_residual()
+        for ps, gs, C, dC in self._chunk_terms(compute_deriv=False):
+            self.residual[ps] -= C.sum(axis=0)
+
+    def process_gradients(self, weights):
+        """Accumulate the sums of the derivatives of each active gaussian over
+        pixels with the given weights, one chunk of pixels at a time, then
+        apply the Jacobians.
+
+        :param weights:
+            ndarray of shape (npix,), e.g. chi * ierr
+
+        :returns grad:
+            ndarray of shape (nactive, nparam)
+        """
+        sums = self.gradient_sums
+        sums[:] = 0
+        for ps, gs, C, dC in self._chunk_terms(compute_deriv=True):
+            w = weights[ps]
+            for k, d in enumerate(dC):
+                if d is not None:
+                    sums[gs, k] += np.sum(d * w, axis=-1, dtype=np.float64)
+        return source_gradients(self.active, sums)
+
+    def _chunk_terms(self, compute_deriv=True):
+        """Generate the counts (and derivatives) of blocks of the active
+        gaussians that overlap each chunk of pixels.
+
+        :returns ps, gs, C, dC:
+            The slice of the pixels in the chunk, the indices of a block of
+            gaussians, and their counts and derivatives on the chunk (see
+            `kernels._block_terms`).
+        """
+        batch, stamp = self.active, self.stamp
+        kwargs, self.flux_error = self.kernel_keywords()
+        bbox, pixel_index = kwargs.pop("bbox", None), kwargs.pop("pixel_index", None)
+        oversample, osigma = kwargs.pop("oversample"), kwargs.pop("oversample_sigma")
+        xpix = np.asarray(stamp.xpix, dtype=self.dtype).reshape(-1)
+        ypix = np.asarray(stamp.ypix, dtype=self.dtype).reshape(-1)
+        npix, ngauss = len(xpix), len(batch)
+        params = [np.asarray(p, dtype=self.dtype) for p in
+                  [batch.amp, batch.xcen, batch.ycen, batch.fxx, batch.fxy, batch.fyy]]
+        if bbox is not None:
+            # the image indices of the stored pixels
+            ix, iy = np.zeros(npix, dtype=int), np.zeros(npix, dtype=int)
+            ix[pixel_index], iy[pixel_index] = np.indices(pixel_index.shape)
+            valid = (bbox[:, 1] > bbox[:, 0]) & (bbox[:, 3] > bbox[:, 2])
+        under = np.zeros(ngauss, dtype=bool)
+        if oversample > 1:
+            under = undersampled(batch, osigma)
+        allg = np.arange(ngauss)
 
-        return -0.5 * np.sum(chi*chi, axis=-1), self.gradients
+        for p0 in range(0, npix, self.chunk_size):
+            ps = slice(p0, min(p0 + self.chunk_size, npix))
+            bx, by, box = None, None, None
+            gs = allg
+            if bbox is not None:
+                bx, by = ix[ps], iy[ps]
+                gs = allg[valid & (bbox[:, 0] <= bx.max()) & (bbox[:, 1] > bx.min()) &
+                          (bbox[:, 2] <= by.max()) & (bbox[:, 3] > by.min())]
+            for g, nsub in [(gs[~under[gs]], 1), (gs[under[gs]], oversample)]:
+                for g0 in range(0, len(g), self.gauss_block):
+                    gb = g[g0:g0 + self.gauss_block]
+                    if bbox is not None:
+                        box = bbox[gb]
+                    shape = compute_deriv and bool(np.any(batch.derivs[gb, 9:] != 0))
+                    C, dC = _gaussian_block([p[gb, None] for p in params],
+                                            xpix[ps], ypix[ps], nsub=nsub, box=box,
+                                            bx=bx, by=by, compute_deriv=compute_deriv,
+                                            shape=shape, dtype=self.dtype, **kwargs)
+                    yield ps, gb, C, dC
@@ -0,0 +1,167 @@
+# Look up the amplitudes of the gaussian mixture approximations to Sersic
+# profiles, as fit by `mixtures.gaussian_galaxy.fit_profiles` on a grid of
+# Sersic index and half-light radius.  The amplitudes of every component are
+# interpolated with a bicubic Hermite spline, with analytic derivatives, for
+# many galaxies at once.
+
+import os
+import numpy as np
+
+try:
+    import h5py
+except(ImportError):
+    h5py = None
+
+__all__ = ["AmplitudeTable", "load_amplitude_table"]
+
+
+# AmplitudeTable instances, keyed by absolute filename
+_TABLES = {}
+
+
+def load_amplitude_table(filename, normalize=True):
+    """Get the AmplitudeTable for an HDF5 file produced by `fit_profiles`.
+    Each file is only read once per process.
+
+    :param filename:
+        The name of the HDF5 file, with `nsersic`, `rh`, `amplitudes` and
+        `radii` datasets.
+
+    :param normalize: (optional, default: True)
+        Whether to normalize the amplitudes at each grid point to sum to one.
+
+    :returns table:
+        An AmplitudeTable instance.
+    """
+    key = (os.path.abspath(filename), normalize)
+    if key not in _TABLES:
+        if h5py is None:
+            raise ImportError("h5py is required to read amplitude tables")
+        with h5py.File(filename, "r") as dat:
+            nsersic, rh = np.array(dat["nsersic"]), np.array(dat["rh"])
+            amplitudes, radii = np.array(dat["amplitudes"]), np.array(dat["radii"])
+        _TABLES[key] = AmplitudeTable.from_rows(nsersic, rh, amplitudes, radii,
+                                                normalize=normalize)
+    return _TABLES[key]
+
+
+class AmplitudeTable(object):
+    """The amplitudes of the gaussian components of Sersic profile
+    approximations on a rectilinear grid of Sersic index and half-light
+    radius, with a bicubic Hermite spline interpolant.  The slopes at the grid
+    points are estimated by finite differences.  Outside the grid the
+    parameters are clipped to the grid edges, so the amplitude derivatives
+    there are zero.
+    """
+
+    def __init__(self, nsersic, rh, amplitudes, radii):
+        """
+        :param nsersic:
+            ndarray of shape (nn,), the increasing grid of Sersic indices.
+
+        :param rh:
+            ndarray of shape (nr,), the increasing grid of half-light radii.
+
+        :param amplitudes:
+            ndarray of shape (nn, nr, ngauss)
+
+        :param radii:
+            ndarray of shape (ngauss,), the dispersions of the components.
+        """
+        self.nsersic = np.asarray(nsersic, dtype=float)
+        self.rh = np.asarray(rh, dtype=float)
+        self.amplitudes = np.asarray(amplitudes, dtype=float)
+        self.radii = np.asarray(radii, dtype=float)
+        nn, nr = len(self.nsersic), len(self.rh)
+        assert self.amplitudes.shape[:2] == (nn, nr)
+        assert (nn > 1) and (nr > 1)
+        # slopes at the grid points
+        en, er = min(nn - 1, 2), min(nr - 1, 2)
+        self.da_dn = np.gradient(self.amplitudes, self.nsersic, axis=0, edge_order=en)
+        self.da_dr = np.gradient(self.amplitudes, self.rh, axis=1, edge_order=er)
+        self.d2a_dndr = np.gradient(self.da_dn, self.rh, axis=1, edge_order=er)
+
+    @classmethod
+    def from_rows(cls, nsersic, rh, amplitudes, radii, normalize=True):
+        """Make a table from one row per grid point, in any order, as written
+        by `fit_profiles`.
+
+        :param nsersic, rh:
+            ndarrays of shape (nrow,)
+
+        :param amplitudes:
+            ndarray of shape (nrow, ngauss)
+        """
+        amplitudes = np.asarray(amplitudes, dtype=float)
+        if normalize:
+            amplitudes = amplitudes / amplitudes.sum(axis=-1, keepdims=True)
+        ngrid, rgrid = np.unique(nsersic), np.unique(rh)
+        if len(ngrid) * len(rgrid) != len(amplitudes):
+            raise ValueError("The amplitude table is not a complete grid")
+        order = np.lexsort((rh, nsersic))
+        amps = amplitudes[order].reshape(len(ngrid), len(rgrid), -1)
+        return cls(ngrid, rgrid, amps, radii)
+
+    @property
+    def ngauss(self):
+        return len(self.radii)
+
+    def evaluate(self, nsersic, rh):
+        """Interpolate the amplitudes and their derivatives.
+
+        :param nsersic:
+            ndarray of shape (ngal,) giving the Sersic index of each galaxy.
+
+        :param rh:
+            ndarray of shape (ngal,) giving the half-light radius of each
+            galaxy.
+
+        :returns amplitudes, damplitude_dsersic, damplitude_drh:
+            ndarrays of shape (ngal, ngauss)
+        """
+        i, t, dn, inside_n = _locate(self.nsersic, nsersic)
+        j, u, dr, inside_r = _locate(self.rh, rh)
+        ht, dht = _hermite(t)
+        hu, dhu = _hermite(u)
+        a = np.zeros((len(t), self.ngauss))
+        da_dt, da_du = np.zeros_like(a), np.zeros_like(a)
+        for di, dj in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+            ii, jj = i + di, j + dj
+            # value, d/dt, d/du and d2/dtdu of the spline at this corner
+            corner = [self.amplitudes[ii, jj], self.da_dn[ii, jj] * dn[:, None],
+                      self.da_dr[ii, jj] * dr[:, None],
+                      self.d2a_dndr[ii, jj] * (dn * dr)[:, None]]
+            for c, (bt, bu) in zip(corner, [(0, 0), (1, 0), (0, 1), (1, 1)]):
+                wt, wu = ht[2 * bt + di][:, None], hu[2 * bu + dj][:, None]
+                a += wt * wu * c
+                da_dt += dht[2 * bt + di][:, None] * wu * c
+                da_du += wt * dhu[2 * bu + dj][:, None] * c
+        da_dn = np.where(inside_n[:, None], da_dt / dn[:, None], 0.)
+        da_dr = np.where(inside_r[:, None], da_du / dr[:, None], 0.)
+        return a, da_dn, da_dr
+
+
+def _locate(grid, values):
+    """Find the grid cell of each value, clipping to the grid.
+
+    :returns i, t, dx, inside:
+        The index of the lower grid point of the cell, the fractional position
+        in the cell, the cell width, and whether the value was in the grid.
+    """
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    inside = (values >= grid[0]) & (values <= grid[-1])
+    x = np.clip(values, grid[0], grid[-1])
+    i = np.clip(np.searchsorted(grid, x, side="right") - 1, 0, len(grid) - 2)
+    dx = grid[i + 1] - grid[i]
+    return i, (x - grid[i]) / dx, dx, inside
+
+
+def _hermite(t):
+    """The cubic Hermite basis functions h00, h01, h10, h11 (ordered as value
+    at the lower point, value at the upper point, slope at the lower point,
+    slope at the upper point) and their derivatives.
+    """
+    t2, t3 = t * t, t * t * t
+    h = [2 * t3 - 3 * t2 + 1, -2 * t3 + 3 * t2, t3 - 2 * t2 + t, t3 - t2]
+    dh = [6 * t2 - 6 * t, -6 * t2 + 6 * t, 3 * t2 - 4 * t + 1, 3 * t2 - 2 * t]
+    return h, dh
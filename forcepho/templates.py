@@ -0,0 +1,245 @@
+# Pixelized PSF templates for point sources.  The image of a point source is
+# the PSF mixture rendered at a sub-pixel offset and scaled by the flux, so
+# for a fixed PSF the pixel-integrated image and its derivatives with respect
+# to the center can be rendered once on a fine grid of sub-pixel shifts.  Each
+# star is then a bilinear interpolation between the templates of the nearest
+# shifts, added into the image on a small stencil of pixels.
+
+import numpy as np
+from .gaussmodel import ImageGaussian, compute_gaussian, psf_terms, shape_signature
+
+__all__ = ["StarTemplates", "get_templates"]
+
+
+# StarTemplates instances, keyed by stamp shape signature and template options
+_TEMPLATES = {}
+
+
+def get_templates(stamp, nshift=32, **kwargs):
+    """Get the (cached) star templates for the PSF and scale of a stamp.
+
+    :param stamp:
+        A PostageStamp instance with a valid PointSpreadFunction.
+
+    :param nshift: (optional, default: 32)
+        The number of sub-pixel shifts per pixel in each direction.
+
+    :param kwargs:
+        Extra keywords for `StarTemplates`, e.g. `second_order` or `use_det`.
+
+    :returns templates:
+        A StarTemplates instance.
+    """
+    key = (shape_signature(stamp), nshift, tuple(sorted(kwargs.items())))
+    templates = _TEMPLATES.get(key, None)
+    # the templates hold on to the PSF so that its id is not reused
+    if (templates is None) or (templates.psf is not stamp.psf):
+        templates = StarTemplates(stamp.psf, nshift=nshift, **kwargs)
+        _TEMPLATES[key] = templates
+    return templates
+
+
+class StarTemplates(object):
+    """The pixel-integrated image of a unit flux point source and its
+    derivatives with respect to the center, on a grid of (nshift + 1) x
+    (nshift + 1) sub-pixel shifts.  The images are (2 * radius + 1) pixels on a
+    side, and the star is at pixel (radius + sx, radius + sy) for shifts sx,
+    sy in [0, 1].  As in `set_footprints` it is assumed that the pixel
+    coordinates of the stamp are the pixel indices.
+    """
+
+    def __init__(self, psf, nshift=32, radius=None, nsigma=5.,
+                 second_order=True, use_det=False):
+        """
+        :param psf:
+            A PointSpreadFunction instance.
+
+        :param nshift: (optional, default: 32)
+            The number of sub-pixel shifts per pixel in each direction.
+
+        :param radius: (optional)
+            The half-width of the template images in pixels.  If not given,
+            this is `nsigma` times the largest dispersion of any PSF component
+            plus the largest offset of any component.
+
+        :param second_order: (optional, default: True)
+            Whether to use the 2nd order correction to the integral of the
+            gaussians within a pixel.
+
+        :param use_det: (optional, default: False)
+            Whether to include the determinant of the covariance matrix when
+            normalizing the counts.
+        """
+        self.psf = psf
+        self.nshift = nshift
+        self.second_order = second_order
+        self.use_det = use_det
+        if radius is None:
+            cov = psf.covariances
+            lmax = (0.5 * (cov[:, 0, 0] + cov[:, 1, 1]) +
+                    np.hypot(0.5 * (cov[:, 0, 0] - cov[:, 1, 1]), cov[:, 0, 1]))
+            offset = np.abs(psf.means).max() if len(psf.means) else 0.
+            radius = int(np.ceil(nsigma * np.sqrt(lmax.max()) + offset))
+        self.radius = radius
+        self.shifts = np.arange(nshift + 1) / float(nshift)
+
+        size = 2 * radius + 1
+        shape = (nshift + 1, nshift + 1, size, size)
+        self.values = np.zeros(shape)
+        self.dx = np.zeros(shape)
+        self.dy = np.zeros(shape)
+        upix, vpix = np.meshgrid(np.arange(size), np.arange(size), indexing="ij")
+        fxx, fyy, fxy, norm = psf_terms(psf)
+        for j in range(psf.ngauss):
+            g = ImageGaussian()
+            g.amp, g.fxx, g.fyy, g.fxy = norm[j], fxx[j], fyy[j], fxy[j]
+            g.xcen = (radius + psf.means[j, 0] + self.shifts)[:, None, None, None]
+            g.ycen = (radius + psf.means[j, 1] + self.shifts)[None, :, None, None]
+            C, dC = compute_gaussian(g, upix, vpix, second_order=second_order,
+                                     use_det=use_det)
+            self.values += C
+            self.dx += dC[1]
+            self.dy += dC[2]
+
+    @property
+    def size(self):
+        return 2 * self.radius + 1
+
+    def interpolate(self, xcen, ycen):
+        """Interpolate the templates to the given star centers.
+
+        :param xcen:
+            ndarray of shape (nstar,) giving the x pixel coordinates of the
+            stars.
+
+        :param ycen:
+            ndarray of shape (nstar,) giving the y pixel coordinates of the
+            stars.
+
+        :returns xlo, ylo:
+            Integer ndarrays of shape (nstar,) giving the pixel indices of the
+            first pixel of each star's stencil.
+
+        :returns values, dx, dy:
+            ndarrays of shape (nstar, size, size) giving the counts of a unit
+            flux star in each stencil pixel and their derivatives with respect
+            to the center.
+        """
+        xcen, ycen = np.atleast_1d(xcen), np.atleast_1d(ycen)
+        ix, iy = np.floor(xcen).astype(int), np.floor(ycen).astype(int)
+        sx, sy = (xcen - ix) * self.nshift, (ycen - iy) * self.nshift
+        i0 = np.clip(np.floor(sx).astype(int), 0, self.nshift - 1)
+        j0 = np.clip(np.floor(sy).astype(int), 0, self.nshift - 1)
+        tx, ty = (sx - i0)[:, None, None], (sy - j0)[:, None, None]
+        weights = [((1 - tx) * (1 - ty), 0, 0), (tx * (1 - ty), 1, 0),
+                   ((1 - tx) * ty, 0, 1), (tx * ty, 1, 1)]
+        out = []
+        for arr in [self.values, self.dx, self.dy]:
+            out.append(sum([w * arr[i0 + di, j0 + dj] for w, di, dj in weights]))
+        return (ix - self.radius, iy - self.radius) + tuple(out)
+
+    def render(self, xcen, ycen, flux, nx, ny):
+        """Render stars into an image.
+
+        :param xcen, ycen, flux:
+            ndarrays of shape (nstar,) giving the star centers in pixels and
+            their fluxes (in the units of the source flux).
+
+        :returns image:
+            ndarray of shape (nx, ny)
+        """
+        xlo, ylo, values = self.interpolate(xcen, ycen)[:3]
+        index, valid = self._stencil_index(xlo, ylo, nx, ny)
+        values = np.asarray(flux)[:, None, None] * values
+        image = np.bincount(index[valid], weights=values[valid], minlength=nx * ny)
+        return image.reshape(nx, ny)
+
+    def sums(self, xcen, ycen, flux, weights):
+        """Sum the derivatives of the star images with respect to flux and
+        center over pixels, with the given weights.
+
+        :param xcen, ycen, flux:
+            ndarrays of shape (nstar,) giving the star centers in pixels and
+            their fluxes.
+
+        :param weights:
+            ndarray of shape (nx, ny), e.g. chi * ierr as an image.
+
+        :returns sums:
+            ndarray of shape (nstar, 3) with the weighted sums of
+            dcounts/dflux, dcounts/dx and dcounts/dy.
+        """
+        nx, ny = weights.shape
+        xlo, ylo, values, dx, dy = self.interpolate(xcen, ycen)
+        index, valid = self._stencil_index(xlo, ylo, nx, ny)
+        w = np.where(valid, weights.reshape(-1)[np.where(valid, index, 0)], 0.)
+        flux = np.asarray(flux)
+        sums = np.zeros([len(flux), 3])
+        sums[:, 0] = (w * values).sum(axis=(-2, -1))
+        sums[:, 1] = flux * (w * dx).sum(axis=(-2, -1))
+        sums[:, 2] = flux * (w * dy).sum(axis=(-2, -1))
+        return sums
+
+    def star_parameters(self, batch, stars):
+        """Get the pixel centers and fluxes of point sources in a GaussianBatch
+        that was made with the PSF of these templates.
+
+        :param batch:
+            A GaussianBatch instance.
+
+        :param stars:
+            Integer ndarray of the indices of the point sources in the batch.
+
+        :returns xcen, ycen, flux:
+            ndarrays of shape (nstar,)
+        """
+        first = batch.offsets[stars]
+        norm = psf_terms(self.psf)[-1]
+        flux = np.add.reduceat(batch.amp, batch.offsets[:-1])[stars] / norm.sum()
+        xcen = batch.xcen[first] - self.psf.means[0, 0]
+        ycen = batch.ycen[first] - self.psf.means[0, 1]
+        return xcen, ycen, flux
+
+    def interpolation_error(self, nstar=100, seed=None):
+        """Compare the interpolated templates to the images of the PSF
+        gaussians computed directly with `compute_gaussian`, for stars at
+        random sub-pixel positions, over the template stencil.
+
+        :returns err_value:
+            The largest absolute error in the counts, relative to the peak
+            counts of the star.
+
+        :returns err_deriv:
+            The largest absolute error in the center derivatives, relative to
+            the largest derivative.
+        """
+        rng = np.random.RandomState(seed)
+        xcen, ycen = rng.uniform(0, 1, nstar), rng.uniform(0, 1, nstar)
+        _, _, values, dx, dy = self.interpolate(xcen, ycen)
+        r = self.radius
+        upix, vpix = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1),
+                                 indexing="ij")
+        exact = np.zeros((3,) + values.shape)
+        fxx, fyy, fxy, norm = psf_terms(self.psf)
+        for j in range(self.psf.ngauss):
+            g = ImageGaussian()
+            g.amp, g.fxx, g.fyy, g.fxy = norm[j], fxx[j], fyy[j], fxy[j]
+            g.xcen = (xcen + self.psf.means[j, 0])[:, None, None]
+            g.ycen = (ycen + self.psf.means[j, 1])[:, None, None]
+            C, dC = compute_gaussian(g, upix, vpix, second_order=self.second_order,
+                                     use_det=self.use_det)
+            exact += np.array([C, dC[1], dC[2]])
+        err_value = np.abs(values - exact[0]).max() / np.abs(exact[0]).max()
+        err_deriv = (max(np.abs(dx - exact[1]).max(), np.abs(dy - exact[2]).max()) /
+                     np.abs(exact[1:]).max())
+        return err_value, err_deriv
+
+    def _stencil_index(self, xlo, ylo, nx, ny):
+        """The flattened image index of each stencil pixel, and whether it is
+        in the image.
+        """
+        u = np.arange(self.size)
+        x = xlo[:, None, None] + u[None, :, None]
+        y = ylo[:, None, None] + u[None, None, :]
+        valid = (x >= 0) & (x < nx) & (y >= 0) & (y < ny)
+        return x * ny + y, valid
@@ -0,0 +1,296 @@
+# Superpixel work lists, like the WorkList of `src/gaussian.cpp`.  The stamp
+# is cut into rectangular superpixels, and each superpixel is paired with the
+# active and fixed sources whose footprints overlap it, by binning the
+# bounding boxes of the sources onto the superpixel grid.  The pairs are kept
+# in flat arrays with per-superpixel offsets and counts (`start_Active`,
+# `nActive`, ...), so that only the listed pairs are evaluated and the same
+# lists can be handed to a compiled kernel.
+
+import numpy as np
+from .gaussmodel import undersampled
+from .kernels import _gaussian_block
+
+__all__ = ["WorkList", "worklist_lnlike", "worklist_image"]
+
+
+class WorkList(object):
+    """The superpixels of a stamp and the sources that overlap each of them.
+    All the arrays are indexed by superpixel number ``i * nsy + j`` for the
+    superpixel in the i-th row and j-th column of superpixels.  As in
+    `set_footprints` it is assumed that the pixel coordinates of the stamp are
+    the pixel indices.
+
+    The stored positions of the pixels of superpixel s are
+    ``pixels[start_Pixel[s]:start_Pixel[s] + nPixel[s]]``, and the indices in
+    the active batch of the sources that overlap it are
+    ``worklist_Active[start_Active[s]:start_Active[s] + nActive[s]]``, and
+    likewise for the fixed sources.
+    """
+
+    def __init__(self, stamp, tile=(8, 8)):
+        """
+        :param stamp:
+            A PostageStamp instance.
+
+        :param tile: (optional, default: (8, 8))
+            The size of the superpixels in x and y.
+        """
+        self.tile = tuple(tile)
+        self.nx, self.ny = stamp.nx, stamp.ny
+        sx, sy = self.tile
+        self.nsx, self.nsy = -(-self.nx // sx), -(-self.ny // sy)
+        i, j = np.indices((self.nx, self.ny)).reshape(2, -1)
+        sp = (i // sx) * self.nsy + j // sy
+        order = np.argsort(sp, kind="stable")
+        # The stored positions and image indices of the pixels, by superpixel
+        self.pixels = np.asarray(stamp.pixel_index).reshape(-1)[order]
+        self.pixel_x, self.pixel_y = i[order], j[order]
+        self.nPixel = np.bincount(sp, minlength=self.nsuper)
+        self.start_Pixel = np.cumsum(self.nPixel) - self.nPixel
+        # The image indices of the first pixel of each superpixel
+        si, sj = np.divmod(np.arange(self.nsuper), self.nsy)
+        self.x0, self.y0 = si * sx, sj * sy
+        self.set_active(None)
+        self.set_fixed(None)
+
+    @property
+    def nsuper(self):
+        return self.nsx * self.nsy
+
+    @property
+    def superpixel(self):
+        """The superpixels with any active or fixed sources, i.e. the items of
+        work.
+        """
+        return np.where((self.nActive + self.nFixed) > 0)[0]
+
+    def set_active(self, batch):
+        """Bin the sources of a batch of active gaussians onto the superpixels.
+
+        :param batch:
+            A GaussianBatch instance, or None.  If the batch has no `bbox`
+            every source overlaps every superpixel.
+        """
+        self.start_Active, self.nActive, self.worklist_Active = self._bin(batch)
+
+    def set_fixed(self, batch):
+        """Bin the sources of a batch of fixed gaussians onto the superpixels.
+        """
+        self.start_Fixed, self.nFixed, self.worklist_Fixed = self._bin(batch)
+
+    def _bin(self, batch):
+        """Find the superpixels that overlap the union of the bounding boxes
+        of the gaussians of each source.
+
+        :returns start, count, sources:
+            The offsets and numbers of sources of each superpixel, and the
+            concatenated source indices.
+        """
+        count = np.zeros(self.nsuper, dtype=int)
+        if (batch is None) or (batch.nsource == 0):
+            return np.zeros_like(count), count, np.zeros(0, dtype=int)
+        nsource, first = batch.nsource, batch.offsets[:-1]
+        bbox = getattr(batch, "bbox", None)
+        if bbox is None:
+            xlo, ylo = np.zeros(nsource, dtype=int), np.zeros(nsource, dtype=int)
+            xhi, yhi = np.full(nsource, self.nx), np.full(nsource, self.ny)
+        else:
+            valid = (bbox[:, 1] > bbox[:, 0]) & (bbox[:, 3] > bbox[:, 2])
+            big = max(self.nx, self.ny)
+            xlo = np.minimum.reduceat(np.where(valid, bbox[:, 0], big), first)
+            ylo = np.minimum.reduceat(np.where(valid, bbox[:, 2], big), first)
+            xhi = np.maximum.reduceat(np.where(valid, bbox[:, 1], 0), first)
+            yhi = np.maximum.reduceat(np.where(valid, bbox[:, 3], 0), first)
+        sx, sy = self.tile
+        ilo, jlo = xlo // sx, ylo // sy
+        ni = np.clip((xhi - 1) // sx + 1 - ilo, 0, None)
+        nj = np.clip((yhi - 1) // sy + 1 - jlo, 0, None)
+        npair = ni * nj
+        # one (superpixel, source) pair for each superpixel in each source box
+        src = np.repeat(np.arange(nsource), npair)
+        k = np.arange(npair.sum()) - np.repeat(np.cumsum(npair) - npair, npair)
+        sp = (ilo[src] + k // nj[src]) * self.nsy + jlo[src] + k % nj[src]
+        order = np.argsort(sp, kind="stable")
+        count = np.bincount(sp, minlength=self.nsuper)
+        return np.cumsum(count) - count, count, src[order]
+
+    def blocks(self, batch, kind="active", oversample=1, oversample_sigma=1.0):
+        """Generate the listed pairs of superpixels and gaussians.  Only the
+        gaussians of the listed sources whose own bounding box overlaps the
+        superpixel are included.
+
+        :param batch:
+            The GaussianBatch that was binned with `set_active` or `set_fixed`.
+
+        :param kind: (optional, default: "active")
+            "active" or "fixed"
+
+        :returns s, gs, nsub:
+            The superpixel, the indices of the gaussians, and the number of
+            sub-pixels per axis to use for them.  Undersampled gaussians are
+            yielded separately if `oversample` > 1.
+        """
+        if kind == "active":
+            start, count, sources = self.start_Active, self.nActive, self.worklist_Active
+        else:
+            start, count, sources = self.start_Fixed, self.nFixed, self.worklist_Fixed
+        offsets, bbox = batch.offsets, getattr(batch, "bbox", None)
+        under = None
+        if oversample > 1:
+            under = undersampled(batch, oversample_sigma)
+        sx, sy = self.tile
+        for s in np.where(count > 0)[0]:
+            srcs = sources[start[s]:start[s] + count[s]]
+            ng = offsets[srcs + 1] - offsets[srcs]
+            gs = (np.repeat(offsets[srcs] - np.cumsum(ng) + ng, ng) +
+                  np.arange(ng.sum()))
+            if bbox is not None:
+                box = bbox[gs]
+                x0, y0 = self.x0[s], self.y0[s]
+                overlap = ((box[:, 0] < x0 + sx) & (box[:, 1] > x0) &
+                           (box[:, 2] < y0 + sy) & (box[:, 3] > y0) &
+                           (box[:, 1] > box[:, 0]) & (box[:, 3] > box[:, 2]))
+                gs = gs[overlap]
+            if under is None:
+                groups = [(gs, 1)]
+            else:
+                groups = [(gs[~under[gs]], 1), (gs[under[gs]], oversample)]
+            for g, nsub in groups:
+                if len(g):
+                    yield s, g, nsub
+
+
+def _superpixel_terms(worklist, batch, xpix, ypix, kind="active", second_order=True,
+                      compute_deriv=True, use_det=False, dtype=np.float64,
+                      oversample=1, oversample_sigma=1.0, skip_shape=False):
+    """Generate the counts and derivatives of the listed gaussians on the
+    pixels of each superpixel.
+
+    :returns ps, gs, C, dC:
+        The stored positions of the pixels of the superpixel, the indices of
+        the gaussians, and their counts and derivatives as in `_block_terms`.
+    """
+    params = [np.asarray(p, dtype=dtype) for p in
+              [batch.amp, batch.xcen, batch.ycen, batch.fxx, batch.fxy, batch.fyy]]
+    bbox = getattr(batch, "bbox", None)
+    derivs = getattr(batch, "derivs", None)
+    for s, gs, nsub in worklist.blocks(batch, kind, oversample, oversample_sigma):
+        sl = slice(worklist.start_Pixel[s], worklist.start_Pixel[s] + worklist.nPixel[s])
+        ps = worklist.pixels[sl]
+        shape = True
+        if skip_shape and (derivs is not None):
+            shape = bool(np.any(derivs[gs, 9:] != 0))
+        box = None if bbox is None else bbox[gs]
+        C, dC = _gaussian_block([p[gs, None] for p in params], xpix[ps], ypix[ps],
+                                nsub=nsub, box=box, bx=worklist.pixel_x[sl],
+                                by=worklist.pixel_y[sl], second_order=second_order,
+                                compute_deriv=compute_deriv, use_det=use_det,
+                                shape=shape, dtype=dtype)
+        yield ps, gs, C, dC
+
+
+def worklist_image(worklist, batch, xpix, ypix, kind="active", second_order=True,
+                   use_det=False, dtype=np.float64, oversample=1,
+                   oversample_sigma=1.0, **extras):
+    """Compute the model image of the gaussians of a batch, evaluating only
+    the pairs of superpixels and sources in a WorkList.
+
+    :param worklist:
+        A WorkList instance, with the sources of `batch` binned by `set_active`
+        (or by `set_fixed` if `kind` is "fixed").
+
+    :param xpix, ypix:
+        The x and y coordinates of the pixels, ndarrays of shape (npix,)
+
+    :returns image:
+        ndarray of shape (npix,)
+
+    See `kernels.compute_gaussian_batch` for the other parameters.
+    """
+    xpix = np.asarray(xpix, dtype=dtype).reshape(-1)
+    ypix = np.asarray(ypix, dtype=dtype).reshape(-1)
+    image = np.zeros(len(xpix), dtype=dtype)
+    terms = _superpixel_terms(worklist, batch, xpix, ypix, kind=kind,
+                              second_order=second_order, compute_deriv=False,
+                              use_det=use_det, dtype=dtype, oversample=oversample,
+                              oversample_sigma=oversample_sigma)
+    for ps, gs, C, dC in terms:
+        image[ps] += C.sum(axis=0)
+    return image
+
+
+def worklist_lnlike(worklist, batch, xpix, ypix, data, ierr, second_order=True,
+                    use_det=False, dtype=np.float64, oversample=1,
+                    oversample_sigma=1.0, out=None, compute_gradient=True, **extras):
+    """Compute the residual, chi^2 and the chi-weighted sums of the gaussian
+    derivatives for the active gaussians of a batch, evaluating only the
+    pairs of superpixels and sources in a WorkList.  Superpixels without any
+    active sources only contribute their data to the residual.
+
+    :param worklist:
+        A WorkList instance, with the sources of `batch` binned by
+        `set_active`.
+
+    :param xpix, ypix:
+        The x and y coordinates of the pixels, ndarrays of shape (npix,)
+
+    :param data:
+        The pixel values (minus the model of any fixed sources), ndarray of
+        shape (npix,)
+
+    :param ierr:
+        The inverse uncertainties of the pixels, ndarray of shape (npix,)
+
+    :param out: (optional)
+        A tuple of ndarrays (residual, sums) of shape (npix,) and type `dtype`,
+        and of shape (ngauss, 6) and type float64, in which to store the
+        outputs.  They are overwritten.
+
+    :param compute_gradient: (optional, default: True)
+        If False, only the residual and chi^2 are computed, and `sums` is None.
+
+    :returns chisq:
+        The chi^2 summed over pixels.
+
+    :returns sums:
+        The sums over pixels of chi * ierr * dI/dphi for each gaussian,
+        ndarray of shape (ngauss, 6), or None.  See
+        `kernels.compute_gaussian_sums`.
+
+    :returns residual:
+        The data minus the model, ndarray of shape (npix,)
+
+    See `kernels.compute_gaussian_batch` for the other parameters.
+    """
+    xpix = np.asarray(xpix, dtype=dtype).reshape(-1)
+    ypix = np.asarray(ypix, dtype=dtype).reshape(-1)
+    data = np.asarray(data, dtype=dtype).reshape(-1)
+    ierr = np.asarray(ierr, dtype=dtype).reshape(-1)
+    if out is None:
+        residual, sums = np.zeros(len(xpix), dtype=dtype), np.zeros([len(batch), 6])
+    else:
+        residual, sums = out
+        sums[:] = 0
+    kwargs = dict(second_order=second_order, use_det=use_det, dtype=dtype,
+                  oversample=oversample, oversample_sigma=oversample_sigma)
+
+    residual[:] = data
+    for ps, gs, C, dC in _superpixel_terms(worklist, batch, xpix, ypix,
+                                           compute_deriv=False, **kwargs):
+        residual[ps] -= C.sum(axis=0)
+    chi = residual * ierr
+    # The sums over pixels are pairwise, in double precision
+    chisq = np.sum(chi * chi, dtype=np.float64)
+    if not compute_gradient:
+        return chisq, None, residual
+    weights = chi * ierr
+
+    for ps, gs, C, dC in _superpixel_terms(worklist, batch, xpix, ypix,
+                                           compute_deriv=True, skip_shape=True,
+                                           **kwargs):
+        w = weights[ps]
+        for k, d in enumerate(dC):
+            if d is not None:
+                sums[gs, k] += np.sum(d * w, axis=-1, dtype=np.float64)
+
+    return chisq, sums, residual
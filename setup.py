@@ -31,4 +31,5 @@ setup(
     scripts=glob.glob("scripts/*.py"),
     include_package_data=True,
     install_requires=["numpy"],
+    extras_require={"jit": ["numba"]},
 )
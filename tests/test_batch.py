@@ -0,0 +1,257 @@
+# ------------
+# Tests that the vectorized GaussianBatch conversion reproduces the
+# per-source convert_to_gaussians and get_gaussian_gradients
+# ------------
+
+import numpy as np
+
+from forcepho import gaussmodel as gm
+from forcepho.data import PostageStamp
+from forcepho.psf import PointSpreadFunction
+
+
+def make_stamp(nx=30, ny=30):
+    stamp = PostageStamp()
+    stamp.nx, stamp.ny = nx, ny
+    stamp.npix = nx * ny
+    stamp.ypix, stamp.xpix = np.meshgrid(np.arange(ny), np.arange(nx))
+    stamp.scale = np.array([[1.1, 0.1], [-0.05, 0.9]])
+    stamp.crval = np.zeros(2)
+    stamp.crpix = np.zeros(2)
+
+    psf = PointSpreadFunction()
+    psf.ngauss = 3
+    psf.covariances = np.array([[[1.0, 0.1], [0.1, 1.5]],
+                                [[2.0, -0.3], [-0.3, 2.5]],
+                                [[4.0, 0.0], [0.0, 4.0]]])
+    psf.means = np.array([[0.0, 0.0], [0.1, -0.2], [-0.3, 0.1]])
+    psf.amplitudes = np.array([0.6, 0.3, 0.1])
+    stamp.psf = psf
+    return stamp
+
+
+def make_sources():
+    galaxy = gm.Galaxy()
+    galaxy.id = 0
+    galaxy.ngauss = 4
+    galaxy.radii = np.arange(galaxy.ngauss) * 0.5 + 0.5
+    galaxy.flux, galaxy.ra, galaxy.dec = 100., 12.3, 14.1
+    galaxy.q, galaxy.pa = 0.7, np.deg2rad(30.)
+
+    star = gm.Star()
+    star.id = 1
+    star.flux, star.ra, star.dec = 50., 20.2, 8.7
+    return [galaxy, star]
+
+
+def test_batch_matches_gig():
+    stamp = make_stamp()
+    sources = make_sources()
+    batch = gm.convert_to_gaussian_batch(sources, stamp)
+    batch = gm.get_gaussian_batch_gradients(sources, stamp, batch)
+    assert batch.nsource == len(sources)
+    assert len(batch) == sum([s.ngauss for s in sources]) * stamp.psf.ngauss
+
+    for i, source in enumerate(sources):
+        gig = gm.convert_to_gaussians(source, stamp)
+        gig = gm.get_gaussian_gradients(source, stamp, gig)
+        sl = batch.source_slice(i)
+        assert np.all(batch.source[sl] == i)
+        for k, g in zip(range(sl.start, sl.stop), gig.gaussians.flat):
+            bg = batch[k]
+            for attr in ["amp", "xcen", "ycen", "fxx", "fxy", "fyy"]:
+                assert np.allclose(getattr(bg, attr), getattr(g, attr))
+            assert np.allclose(bg.derivs, g.derivs)
+
+
+def test_compact_jacobian_numerical(dp=1e-6):
+    """Compare the closed-form jacobians to finite differences of the gaussian
+    parameters with respect to the scene parameters.
+    """
+    stamp = make_stamp()
+    sources = make_sources()
+    batch = gm.convert_to_gaussian_batch(sources, stamp)
+    batch = gm.get_gaussian_batch_gradients(sources, stamp, batch)
+    jac = gm.expand_jacobian(batch.derivs)
+    assert batch.derivs.shape == (len(batch), gm.NDERIV)
+
+    pnames = ["flux", "ra", "dec", "q", "pa"]
+    phi = ["amp", "xcen", "ycen", "fxx", "fyy", "fxy"]
+    for i, source in enumerate(sources):
+        sl = batch.source_slice(i)
+        for j, p in enumerate(pnames):
+            v = getattr(source, p)
+            setattr(source, p, v + dp)
+            hi = gm.convert_to_gaussian_batch(sources, stamp)
+            setattr(source, p, v - dp)
+            lo = gm.convert_to_gaussian_batch(sources, stamp)
+            setattr(source, p, v)
+            for k, a in enumerate(phi):
+                num = (getattr(hi, a)[sl] - getattr(lo, a)[sl]) / (2 * dp)
+                assert np.allclose(jac[sl, j, k], num, rtol=1e-5, atol=1e-7)
+
+
+def test_apply_jacobian():
+    stamp = make_stamp()
+    sources = make_sources()
+    batch = gm.convert_to_gaussian_batch(sources, stamp)
+    batch = gm.get_gaussian_batch_gradients(sources, stamp, batch)
+    dI_dphi = np.random.normal(size=(len(batch), 6, 20))
+    dense = np.matmul(gm.expand_jacobian(batch.derivs), dI_dphi)
+    assert np.allclose(gm.apply_jacobian(batch.derivs, dI_dphi), dense)
+    assert np.allclose(gm.apply_jacobian(batch.derivs[3], dI_dphi[3]), dense[3])
+
+
+def test_source_versions():
+    galaxy, star = make_sources()
+    v = galaxy.version
+    galaxy.ra = galaxy.ra
+    assert galaxy.version == v
+    galaxy.ra += 1.0
+    assert galaxy.version == v + 1
+    # profile quantities are memoized until a profile parameter changes
+    amps = galaxy.amplitudes
+    assert galaxy.amplitudes is amps
+    galaxy.q = 0.5
+    assert galaxy.amplitudes is amps
+    galaxy.rh = galaxy.rh + 0.1
+    assert galaxy.amplitudes is not amps
+
+
+def test_batch_cache():
+    stamp = make_stamp()
+    sources = make_sources()
+    cache = gm.BatchCache()
+    cache.get_batch(sources, stamp)
+    assert cache.last_converted == [0, 1]
+    cache.get_batch(sources, stamp)
+    assert cache.last_converted == []
+
+    # the fluxes are applied to the cached shapes without reconversion
+    sources[0].flux *= 3
+    batch = cache.get_batch(sources, stamp)
+    assert cache.last_converted == []
+    fresh = gm.convert_to_gaussian_batch(sources, stamp)
+    assert np.allclose(batch.amp, fresh.amp)
+
+    # as are the positions
+    sources[0].ra += 0.2
+    sources[1].dec -= 0.4
+    batch = cache.get_batch(sources, stamp)
+    assert cache.last_converted == []
+    fresh = gm.convert_to_gaussian_batch(sources, stamp)
+    assert np.allclose(batch.xcen, fresh.xcen) and np.allclose(batch.ycen, fresh.ycen)
+
+    sources[0].q *= 0.9
+    sources[1].ra += 0.3
+    sources[1].flux *= 2
+    batch = cache.get_batch(sources, stamp)
+    assert cache.last_converted == [0]
+    fresh = gm.convert_to_gaussian_batch(sources, stamp)
+    fresh = gm.get_gaussian_batch_gradients(sources, stamp, fresh)
+    for attr in ["amp", "xcen", "ycen", "fxx", "fxy", "fyy", "derivs"]:
+        assert np.allclose(getattr(batch, attr), getattr(fresh, attr))
+
+    # a new PSF forces full reconversion
+    stamp.psf = make_stamp().psf
+    cache.get_batch(sources, stamp)
+    assert cache.last_converted == [0, 1]
+
+
+def test_shared_shapes():
+    # dithers share the PSF and scale, only the centers differ
+    stamp = make_stamp()
+    dither = make_stamp()
+    dither.psf = stamp.psf
+    dither.crpix = np.array([3.2, -1.7])
+    sources = make_sources()
+    cache = gm.BatchCache()
+    cache.get_batch(sources, stamp)
+    batch = cache.get_batch(sources, dither)
+    assert cache.last_converted == []
+    fresh = gm.convert_to_gaussian_batch(sources, dither)
+    fresh = gm.get_gaussian_batch_gradients(sources, dither, fresh)
+    for attr in ["amp", "xcen", "ycen", "fxx", "fxy", "fyy", "derivs"]:
+        assert np.allclose(getattr(batch, attr), getattr(fresh, attr))
+
+
+def test_star_fast_path():
+    # A one component galaxy with zero radius goes through the general path
+    stamp = make_stamp()
+    galaxy, star = make_sources()
+    point = gm.Galaxy()
+    point.ngauss, point.radii = 1, np.zeros(1)
+    point.flux, point.ra, point.dec = star.flux, star.ra, star.dec
+    point.q, point.pa = 0.8, 0.3
+    batches = []
+    for sources in [[galaxy, star], [galaxy, point]]:
+        batch = gm.convert_to_gaussian_batch(sources, stamp)
+        batches.append(gm.get_gaussian_batch_gradients(sources, stamp, batch))
+    for attr in ["amp", "xcen", "ycen", "fxx", "fxy", "fyy", "derivs"]:
+        assert np.allclose(getattr(batches[0], attr), getattr(batches[1], attr))
+
+
+def test_star_templates():
+    from forcepho.templates import get_templates
+    stamp = make_stamp()
+    templates = get_templates(stamp, nshift=16)
+    assert get_templates(stamp, nshift=16) is templates
+    err_value, err_deriv = templates.interpolation_error(seed=1)
+    assert err_value < 1e-3
+    assert err_deriv < 2e-3
+    # a rendered star matches the pixel kernels, and has the right flux
+    star = make_sources()[1]
+    batch = gm.convert_to_gaussian_batch([star], stamp)
+    xcen, ycen, flux = templates.star_parameters(batch, [0])
+    assert np.allclose(flux, star.flux)
+    image = templates.render(xcen, ycen, flux, stamp.nx, stamp.ny)
+    from forcepho.kernels import compute_gaussian_batch
+    exact = compute_gaussian_batch(batch, stamp.xpix.flat, stamp.ypix.flat,
+                                   compute_deriv=False)
+    assert np.abs(image.flatten() - exact).max() < 1e-3 * exact.max()
+
+
+def test_compress_batch():
+    stamp = make_stamp()
+    sources = make_sources()
+    galaxy = sources[0]
+    galaxy.ngauss, galaxy.radii = 6, np.array([0.1, 0.3, 1., 2., 4., 8.])
+    npsf = stamp.psf.ngauss
+
+    def compressed(tol=1e-3):
+        batch = gm.convert_to_gaussian_batch(sources, stamp)
+        batch = gm.get_gaussian_batch_gradients(sources, stamp, batch)
+        return batch, gm.compress_batch(batch, npsf, tol)
+
+    batch, (small, error) = compressed()
+    ngauss = np.diff(small.offsets)
+    assert ngauss[0] < np.diff(batch.offsets)[0]
+    # point sources are never compressed
+    assert ngauss[1] == npsf
+    assert error[1] == 0
+
+    # the achieved error is an upper limit on the exact error
+    def members(b, sl):
+        det = b.fxx[sl] * b.fyy[sl] - b.fxy[sl]**2
+        return (2 * np.pi * b.amp[sl] / np.sqrt(det), b.xcen[sl], b.ycen[sl],
+                b.fyy[sl] / det, b.fxx[sl] / det, -b.fxy[sl] / det)
+    a, b = members(batch, batch.source_slice(0)), members(small, small.source_slice(0))
+    a, b = [tuple(m[None, :] for m in g) for g in (a, b)]
+    ise = gm._overlap(a, a) - 2 * gm._overlap(a, b) + gm._overlap(b, b)
+    assert ise[0] / gm._overlap(a, a)[0] <= error[0] * (1 + 1e-6) + 1e-12
+    assert error[0] <= 1e-3
+
+    # the Jacobians of the merged gaussians are exact
+    sl = small.source_slice(0)
+    jac = gm.expand_jacobian(small.derivs[sl])
+    for k, par in enumerate(["flux", "ra", "dec", "q", "pa"]):
+        value = getattr(galaxy, par)
+        step = 1e-6 * max(abs(value), 1)
+        setattr(galaxy, par, value + step)
+        hi = compressed()[1][0]
+        setattr(galaxy, par, value - step)
+        lo = compressed()[1][0]
+        setattr(galaxy, par, value)
+        num = np.array([(getattr(hi, a)[sl] - getattr(lo, a)[sl]) / (2 * step)
+                        for a in ["amp", "xcen", "ycen", "fxx", "fyy", "fxy"]]).T
+        assert np.allclose(num, jac[:, k], atol=1e-6 * np.abs(num).max())
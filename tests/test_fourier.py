@@ -0,0 +1,83 @@
+# ------------
+# Tests of the Fourier space renderer
+# ------------
+
+import numpy as np
+
+from forcepho import gaussmodel as gm
+from forcepho import fourier
+from forcepho.kernels import compute_gaussian_batch
+
+from test_batch import make_stamp, make_sources
+from test_likelihood import setup_scene, lnlike
+
+
+def get_batch(nx=40, ny=36):
+    stamp = make_stamp(nx, ny)
+    sources = make_sources()
+    batch = gm.convert_to_gaussian_batch(sources, stamp)
+    batch = gm.get_gaussian_batch_gradients(sources, stamp, batch)
+    return batch, stamp, sources
+
+
+def test_fft_size():
+    for n in [1, 7, 11, 97, 101, 127, 129]:
+        m = fourier.fft_size(n)
+        assert m >= n
+        for p in [2, 3, 5]:
+            while m % p == 0:
+                m //= p
+        assert m == 1
+    assert fourier.fft_size(97) == 100
+
+
+def test_fourier_image():
+    batch, stamp, sources = get_batch()
+    xpix, ypix = stamp.xpix.flatten(), stamp.ypix.flatten()
+    # finely oversampled pixel integral as the reference
+    ref = compute_gaussian_batch(batch, xpix, ypix, compute_deriv=False,
+                                 oversample=8, oversample_sigma=100.)
+    ref = ref.reshape(stamp.nx, stamp.ny)
+    image = fourier.fourier_image(batch, stamp.xpix, stamp.ypix)
+    assert image.shape == (stamp.nx, stamp.ny)
+    assert np.abs(image - ref).max() < 1e-4 * ref.max()
+    # shifting the pixel grid shifts the image
+    image = fourier.fourier_image(batch, stamp.xpix[5:, 3:], stamp.ypix[5:, 3:])
+    assert np.abs(image - ref[5:, 3:]).max() < 1e-4 * ref.max()
+
+
+def test_fourier_gradients(dp=1e-6):
+    batch, stamp, sources = get_batch()
+    data = np.random.normal(size=(stamp.nx, stamp.ny))
+    ierr = np.random.uniform(1, 2, size=stamp.npix)
+    args = (stamp.xpix, stamp.ypix, data, ierr)
+    chisq, grad, resid = fourier.fourier_lnlike(batch, *args)
+    pnames = ["flux", "ra", "dec", "q", "pa"]
+    for i, source in enumerate(sources):
+        for j, p in enumerate(pnames):
+            v = getattr(source, p)
+            setattr(source, p, v + dp)
+            hi = fourier.fourier_lnlike(gm.convert_to_gaussian_batch(sources, stamp),
+                                        *args, compute_deriv=False)[0]
+            setattr(source, p, v - dp)
+            lo = fourier.fourier_lnlike(gm.convert_to_gaussian_batch(sources, stamp),
+                                        *args, compute_deriv=False)[0]
+            setattr(source, p, v)
+            num = -0.5 * (hi - lo) / (2 * dp)
+            assert np.allclose(grad[i, j], num, rtol=1e-5, atol=1e-5)
+
+
+def test_renderer_choice():
+    scene, stamp, theta = setup_scene()
+    lnp, grad = lnlike(theta, scene, stamp)
+    lnp_f, grad_f = lnlike(theta, scene, stamp, renderer="fourier")
+    assert np.allclose(lnp_f, lnp, rtol=1e-3)
+    assert np.allclose(grad_f, grad, rtol=1e-2, atol=1e-2 * np.abs(grad).max())
+
+    batch, stamp, sources = get_batch()
+    stamp.ierr = np.ones(stamp.npix)
+    pixel_cost, fourier_cost = fourier.render_costs(batch, stamp)
+    assert (pixel_cost > 0) and (fourier_cost > 0)
+    # truncated pixel footprints make pixel rendering cheaper
+    gm.set_footprints(batch, stamp, 1e-1)
+    assert fourier.render_costs(batch, stamp)[0] < pixel_cost
@@ -0,0 +1,206 @@
+# ------------
+# Tests that the batched pixel kernels reproduce compute_gaussian
+# ------------
+
+from itertools import product
+import numpy as np
+
+from forcepho import gaussmodel as gm
+from forcepho import kernels
+from forcepho.kernels import compute_gaussian_batch, fused_lnlike
+
+from test_batch import make_stamp, make_sources
+
+
+def get_batch():
+    stamp = make_stamp(23, 17)
+    sources = make_sources()
+    batch = gm.convert_to_gaussian_batch(sources, stamp)
+    return batch, stamp
+
+
+def test_batch_kernel_exact():
+    batch, stamp = get_batch()
+    xpix, ypix = stamp.xpix.flatten(), stamp.ypix.flatten()
+    for second_order, use_det in product([True, False], [True, False]):
+        kw = dict(second_order=second_order, use_det=use_det)
+        image, grad = compute_gaussian_batch(batch, xpix, ypix, block_size=50,
+                                             gauss_block=5, offsets=batch.offsets,
+                                             **kw)
+        assert image.shape == (batch.nsource, stamp.npix)
+        total = np.zeros(stamp.npix)
+        for k in range(len(batch)):
+            I, dI = gm.compute_gaussian(batch[k], xpix, ypix, **kw)
+            # per-gaussian terms are bit-for-bit identical
+            assert np.array_equal(dI, grad[k])
+            total += I
+        assert np.allclose(image.sum(axis=0), total, rtol=1e-12, atol=0)
+
+        image = compute_gaussian_batch(batch, xpix, ypix, compute_deriv=False, **kw)
+        assert image.shape == (stamp.npix,)
+        assert np.allclose(image, total, rtol=1e-12, atol=0)
+
+
+def test_footprints():
+    batch, stamp = get_batch()
+    stamp.ierr = np.ones(stamp.npix)
+    xpix, ypix = stamp.xpix.flatten(), stamp.ypix.flatten()
+    kw = dict(second_order=False, offsets=batch.offsets)
+    full, gfull = compute_gaussian_batch(batch, xpix, ypix, **kw)
+    for tol in [1e-1, 1e-3]:
+        batch = gm.set_footprints(batch, stamp, tolerance=tol)
+        box = batch.bbox
+        assert np.all(box[:, 1] >= box[:, 0]) and np.all(box[:, 3] >= box[:, 2])
+        trunc, gtrunc = compute_gaussian_batch(batch, xpix, ypix, block_size=30,
+                                               bbox=box, pixel_index=stamp.pixel_index,
+                                               **kw)
+        # each gaussian is below the threshold outside its box
+        assert np.abs(full - trunc).max() <= tol * len(batch)
+        # the flux error bound holds for each source
+        for i in range(batch.nsource):
+            sl = batch.source_slice(i)
+            lost = np.abs(full[i] - trunc[i]).sum()
+            assert lost <= batch.flux_error[sl].sum()
+        # within the box the gaussians are unchanged
+        for k in range(len(batch)):
+            x0, x1, y0, y1 = box[k]
+            inbox = ((xpix >= x0) & (xpix < x1) & (ypix >= y0) & (ypix < y1))
+            assert np.array_equal(gtrunc[k][:, inbox], gfull[k][:, inbox])
+            assert np.all(gtrunc[k][:, ~inbox] == 0)
+
+
+def test_fused_lnlike():
+    batch, stamp = get_batch()
+    stamp.nx, stamp.ny = 12, 9
+    stamp.npix = stamp.nx * stamp.ny
+    stamp.ypix, stamp.xpix = np.meshgrid(np.arange(stamp.ny) + 8, np.arange(stamp.nx) + 6)
+    batch = gm.get_gaussian_batch_gradients(make_sources(), stamp, batch)
+    xpix, ypix = stamp.xpix.flatten(), stamp.ypix.flatten()
+    data = np.random.normal(size=stamp.npix) + 1.0
+    ierr = np.random.uniform(1, 2, size=stamp.npix)
+
+    # brute force with compute_gaussian
+    model = np.zeros(stamp.npix)
+    dmodel = np.zeros([batch.nsource, gm.NPARAM, stamp.npix])
+    for k in range(len(batch)):
+        g = batch[k]
+        I, dI = gm.compute_gaussian(g, xpix, ypix)
+        model += I
+        dmodel[batch.source[k]] += gm.apply_jacobian(g.derivs, dI)
+    chi = (data - model) * ierr
+    lnp_grad = np.sum(chi * ierr * dmodel, axis=-1)
+
+    jits = [False] + [True] * (kernels.numba is not None)
+    for jit in jits:
+        chisq, grad, resid = fused_lnlike(batch, xpix, ypix, data, ierr, jit=jit)
+        assert np.allclose(resid, data - model, rtol=1e-12, atol=1e-12)
+        assert np.allclose(chisq, np.sum(chi**2), rtol=1e-12)
+        assert np.allclose(grad, lnp_grad, rtol=1e-10, atol=1e-12)
+        fast = fused_lnlike(batch, xpix, ypix, data, ierr, jit=jit, fast_exp=True)
+        assert np.allclose(fast[2], data - model, rtol=0, atol=kernels.FASTEXP_RTOL * model.max())
+        assert np.allclose(fast[1], lnp_grad, rtol=1e-8, atol=1e-8)
+
+
+def test_fast_exp():
+    x = np.concatenate([-np.random.uniform(0, 50, 10000), -np.logspace(-12, 2.5, 100),
+                        [0., -1e-300, -699.9]])
+    fast = np.array([kernels.fast_exp(v) for v in x])
+    assert np.all(np.abs(fast / np.exp(x) - 1) < kernels.FASTEXP_RTOL)
+    assert kernels.fast_exp(-800.) == 0.
+    assert kernels.fast_exp(0.5) == np.exp(0.5)
+
+
+def test_oversample():
+    from scipy.special import erf
+    batch, stamp = get_batch()
+    # make one narrow round gaussian to compare to the exact pixel integral
+    sigma, xc, yc = 0.42, 10.3, 7.8
+    g = gm.GaussianBatch()
+    for k in ["amp", "xcen", "ycen", "fxx", "fxy", "fyy", "source"]:
+        setattr(g, k, np.atleast_1d(getattr(batch, k)[0]).copy())
+    g.amp[:], g.xcen[:], g.ycen[:] = 1.0, xc, yc
+    g.fxx[:], g.fyy[:], g.fxy[:] = sigma**-2, sigma**-2, 0.
+    xpix, ypix = stamp.xpix.flatten(), stamp.ypix.flatten()
+
+    def pixint(p, c):
+        s = np.sqrt(2) * sigma
+        return 0.5 * (erf((p + 0.5 - c) / s) - erf((p - 0.5 - c) / s))
+    # amplitude is the peak of the (unnormalized) gaussian
+    exact = pixint(xpix, xc) * pixint(ypix, yc) * 2 * np.pi * sigma**2
+
+    single = compute_gaussian_batch(g, xpix, ypix, compute_deriv=False)
+    over = compute_gaussian_batch(g, xpix, ypix, compute_deriv=False,
+                                  oversample=4, oversample_sigma=1.0)
+    err1, err4 = np.abs(single - exact).max(), np.abs(over - exact).max()
+    assert err4 < 1e-3
+    assert err4 < 0.1 * err1
+
+    # mixed batches match the oversampled single gaussian evaluation
+    batch.fxx[::3] *= 10
+    batch.fyy[::3] *= 10
+    under = gm.undersampled(batch, 1.0)
+    assert np.any(under) and not np.all(under)
+    image, grad = compute_gaussian_batch(batch, xpix, ypix, block_size=50,
+                                         gauss_block=5, oversample=3)
+    for k in range(len(batch)):
+        I, dI = gm.compute_gaussian(batch[k], xpix, ypix, oversample=3 if under[k] else 1)
+        assert np.allclose(dI, grad[k], rtol=1e-10, atol=1e-14)
+
+    # and the fused loop agrees with the array kernel
+    batch = gm.get_gaussian_batch_gradients(make_sources(), stamp, batch)
+    batch.fxx[::3] *= 10
+    batch.fyy[::3] *= 10
+    data = np.random.normal(size=stamp.npix)
+    ierr = np.ones(stamp.npix)
+    image, grad = compute_gaussian_batch(batch, xpix, ypix, oversample=3,
+                                         offsets=batch.offsets)
+    residual = data - image.sum(axis=0)
+    lnp_grad = np.array([gm.apply_jacobian(batch.derivs[batch.source_slice(i)],
+                                           grad[batch.source_slice(i)]).sum(0)
+                         for i in range(batch.nsource)])
+    lnp_grad = (residual * lnp_grad).sum(-1)
+    for jit in [False, True]:
+        chisq, g, r = fused_lnlike(batch, xpix, ypix, data, ierr, oversample=3, jit=jit)
+        assert np.allclose(r, residual, rtol=1e-10)
+        assert np.allclose(chisq, (residual**2).sum(), rtol=1e-10)
+        assert np.allclose(g, lnp_grad, rtol=1e-8)
+
+
+def test_recurrence():
+    batch, stamp = get_batch()
+    stamp.ierr = np.ones(stamp.npix)
+    batch = gm.get_gaussian_batch_gradients(make_sources(), stamp, batch)
+    xpix, ypix = stamp.xpix.flatten(), stamp.ypix.flatten()
+    assert kernels._row_length(xpix, ypix) == stamp.ny
+    assert kernels._row_length(xpix[::-1], ypix[::-1]) == 0
+    data = np.random.normal(size=stamp.npix)
+    ierr = np.random.uniform(1, 2, size=stamp.npix)
+    for tol, nsub in [(None, 1), (1e-3, 1), (1e-3, 3)]:
+        if tol is None:
+            batch.bbox = None
+        else:
+            batch = gm.set_footprints(batch, stamp, tolerance=tol)
+        kw = dict(oversample=nsub)
+        chisq, grad, resid = fused_lnlike(batch, xpix, ypix, data, ierr, **kw)
+        for jit, rec in product([False, True], [2, 7]):
+            c, g, r = fused_lnlike(batch, xpix, ypix, data, ierr, recurrence=rec,
+                                   jit=jit, **kw)
+            assert np.allclose(r, resid, rtol=1e-12, atol=1e-14)
+            assert np.allclose(c, chisq, rtol=1e-12)
+            assert np.allclose(g, grad, rtol=1e-10, atol=1e-12)
+
+
+def test_gaussian_sums():
+    batch, stamp = get_batch()
+    stamp.ierr = np.ones(stamp.npix)
+    xpix, ypix = stamp.xpix.flatten(), stamp.ypix.flatten()
+    weights = np.random.normal(size=stamp.npix)
+    for tol, nsub in [(None, 1), (1e-3, 1), (1e-3, 3)]:
+        kw = dict(oversample=nsub, block_size=50, gauss_block=5)
+        if tol is not None:
+            batch = gm.set_footprints(batch, stamp, tolerance=tol)
+            kw.update(bbox=batch.bbox, pixel_index=stamp.pixel_index)
+        image, grad = compute_gaussian_batch(batch, xpix, ypix, **kw)
+        sums = kernels.compute_gaussian_sums(batch, xpix, ypix, weights, **kw)
+        assert sums.shape == (len(batch), 6)
+        assert np.allclose(sums, (grad * weights).sum(-1), rtol=1e-12, atol=1e-12)
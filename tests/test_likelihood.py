@@ -0,0 +1,384 @@
+# ------------
+# Tests of the WorkPlan likelihood and gradients
+# ------------
+
+import numpy as np
+import pytest
+
+from forcepho import gaussmodel as gm
+from forcepho import kernels
+
+from forcepho.likelihood import WorkPlan, FastWorkPlan, make_workplans, make_image
+from forcepho.likelihood import negative_lnlike_multistamp
+
+from test_batch import make_stamp, make_sources
+
+
+class Scene(object):
+    """A minimal scene, with all 7 parameters for every source.
+    """
+
+    use_gradients = slice(0, 7)
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def param_indices(self, sourceid, filterid):
+        return list(range(7 * sourceid, 7 * sourceid + 7))
+
+    def set_source_params(self, theta, source, filterid=None):
+        (source.flux, source.ra, source.dec, source.q, source.pa,
+         source.sersic, source.rh) = theta
+
+
+class BandScene(Scene):
+    """A scene with a flux in each of two filters for every source.
+    """
+
+    def param_indices(self, sourceid, filterid):
+        start = 8 * sourceid
+        return [start + filterid] + list(range(start + 2, start + 8))
+
+
+def setup_scene(n=40, seed=1):
+    rng = np.random.RandomState(seed)
+    stamp = make_stamp(n, n)
+    sources = make_sources()
+    scene = Scene(sources)
+    theta = np.concatenate([[s.flux, s.ra, s.dec, s.q, s.pa, s.sersic, s.rh]
+                            for s in sources])
+    stamp.pixel_values = rng.normal(0, 1, (n, n)) + 1.
+    stamp.ierr = np.ones(stamp.npix) * 2.
+    return scene, stamp, theta
+
+
+def lnlike(theta, scene, stamp, **plan_kwargs):
+    # a new plan, so that options set in earlier calls do not persist
+    stamp.workplan = None
+    plans, inds = make_workplans(theta, scene, [stamp])
+    wp = plans[0]
+    for k, v in plan_kwargs.items():
+        setattr(wp, k, v)
+    return wp.lnlike()
+
+
+def test_shared_psf_bands():
+    # two bands with the same PSF object and scale share the cached shapes,
+    # but not the fluxes
+    scene, stamp, theta = setup_scene()
+    band = make_stamp(40, 40)
+    band.psf, band.filter = stamp.psf, 1
+    band.pixel_values, band.ierr = 0.5 * stamp.pixel_values, stamp.ierr
+    scene = BandScene(scene.sources)
+    theta = np.concatenate([np.insert(t, 1, 0.6 * t[0]) for t in theta.reshape(-1, 7)])
+    nll, nll_grad = negative_lnlike_multistamp(theta, scene=scene, stamps=[stamp, band])
+    assert stamp.batch_cache is band.batch_cache
+    # only the fluxes differ between the bands, so nothing is reconverted
+    negative_lnlike_multistamp(theta, scene=scene, stamps=[stamp, band])
+    assert stamp.batch_cache.last_converted == []
+    nll_sep, grad_sep = 0, np.zeros(len(theta))
+    for s in [stamp, band]:
+        s.workplan, s.batch_cache = None, None
+        n, g = negative_lnlike_multistamp(theta, scene=scene, stamps=[s])
+        nll_sep, grad_sep = nll_sep + n, grad_sep + g
+    assert np.allclose(nll, nll_sep, rtol=1e-12)
+    assert np.allclose(nll_grad, grad_sep, rtol=1e-10, atol=1e-10)
+
+
+def test_single_precision():
+    scene, stamp, theta = setup_scene()
+    lnp, grad = lnlike(theta, scene, stamp)
+    stamp.set_dtype(np.float32)
+    plans, inds = make_workplans(theta, scene, [stamp])
+    wp = plans[0]
+    wp.dtype = np.float32
+    lnp32, grad32 = wp.lnlike()
+    assert wp.residual.dtype == np.float32
+    assert wp.gradient_sums.dtype == np.float64
+    assert lnp32.dtype == np.float64
+    assert np.allclose(lnp32, lnp, rtol=1e-6)
+    assert np.allclose(grad32, grad, rtol=1e-4, atol=1e-4 * np.abs(grad).max())
+
+
+def test_backends():
+    scene, stamp, theta = setup_scene()
+    lnp, grad = lnlike(theta, scene, stamp)
+    for tol, nsub in [(None, 1), (1e-3, 1), (1e-3, 3)]:
+        lnp_f, grad_f = lnlike(theta, scene, stamp, backend="numba",
+                               footprint_tolerance=tol, oversample=nsub)
+        lnp_n, grad_n = lnlike(theta, scene, stamp, footprint_tolerance=tol,
+                               oversample=nsub)
+        assert np.allclose(lnp_f, lnp_n, rtol=1e-12)
+        assert np.allclose(grad_f, grad_n, rtol=1e-10, atol=1e-10)
+        lnp_r, grad_r = lnlike(theta, scene, stamp, backend="numba", recurrence=16,
+                               footprint_tolerance=tol, oversample=nsub)
+        assert np.allclose(lnp_r, lnp_n, rtol=1e-12)
+        assert np.allclose(grad_r, grad_n, rtol=1e-10, atol=1e-10)
+    assert np.allclose(lnp_f, lnp, rtol=1e-4)
+
+
+def test_fused_options(monkeypatch):
+    scene, stamp, theta = setup_scene()
+    for kw in [dict(fast_exp=True), dict(recurrence=8),
+               dict(backend="numba", recurrence=8, renderer="fourier")]:
+        with pytest.raises(ValueError):
+            lnlike(theta, scene, stamp, **kw)
+    # without numba the numpy kernels are used
+    lnp, grad = lnlike(theta, scene, stamp)
+    monkeypatch.setattr(kernels, "numba", None)
+    with pytest.warns(UserWarning):
+        lnp_n, grad_n = lnlike(theta, scene, stamp, backend="numba", fast_exp=True)
+    assert np.allclose(lnp_n, lnp, rtol=1e-12)
+
+
+def test_image_gradients():
+    scene, stamp, theta = setup_scene()
+    plans, inds = make_workplans(theta, scene, [stamp])
+    wp = plans[0]
+    lnp, grad = wp.lnlike()
+    image = wp.make_image()
+    chi = (stamp.pixel_values - image).flatten() * stamp.ierr
+    assert np.allclose(-0.5 * np.sum(chi**2), lnp)
+    dI = wp.image_gradients()
+    assert np.allclose((chi * stamp.ierr * dI).sum(-1), grad)
+    # one image per parameter of the stamp, in the order of the indices
+    im, dI_dtheta = make_image(theta, scene, stamp, use_sources=[1])
+    assert dI_dtheta.shape == (len(inds[0]), stamp.npix)
+    assert np.allclose(dI_dtheta[7:14], dI[1])
+    assert np.all(dI_dtheta[:7] == 0)
+    assert np.allclose(im, wp.make_image([1]))
+
+
+def test_pixel_layouts():
+    scene, stamp, theta = setup_scene(n=40)
+    image = stamp.pixel_values.copy()
+    results = {}
+    for layout in ["superpixel", "morton", "image"]:
+        stamp.set_layout(layout, tile=(8, 4))
+        assert np.array_equal(stamp.to_image(stamp.pixel_values), image)
+        assert np.array_equal(stamp.from_image(image), stamp.pixel_values.reshape(-1))
+        # the index map points at the stored pixels
+        index = stamp.pixel_index
+        assert np.array_equal(stamp.xpix.flat[index.flat], np.indices(image.shape)[0].flat)
+        for kw in [dict(), dict(footprint_tolerance=1e-3),
+                   dict(backend="numba", recurrence=4), dict(renderer="fourier")]:
+            stamp.workplan = None
+            plans, inds = make_workplans(theta, scene, [stamp])
+            wp = plans[0]
+            for k, v in kw.items():
+                setattr(wp, k, v)
+            lnp, grad = wp.lnlike()
+            if "renderer" not in kw:
+                assert np.allclose(stamp.to_image(wp.residual), image - wp.make_image())
+            key = tuple(kw.items())
+            if key in results:
+                assert np.allclose(lnp, results[key][0], rtol=1e-12)
+                assert np.allclose(grad, results[key][1], rtol=1e-10, atol=1e-10)
+            results[key] = lnp, grad
+    assert stamp.pixel_values.shape == image.shape
+
+
+def test_star_templates():
+    scene, stamp, theta = setup_scene()
+    for tol in [None, 1e-3]:
+        lnp, grad = lnlike(theta, scene, stamp, footprint_tolerance=tol)
+        lnp_t, grad_t = lnlike(theta, scene, stamp, star_templates=32,
+                               footprint_tolerance=tol)
+        assert np.allclose(lnp_t, lnp, rtol=1e-5)
+        assert np.allclose(grad_t, grad, rtol=1e-3, atol=1e-3 * np.abs(grad[1]).max())
+
+
+def test_persistent_workplans():
+    scene, stamp, theta = setup_scene()
+    wp = make_workplans(theta, scene, [stamp])[0][0]
+    lnp, grad = wp.lnlike()
+    residual, sums = wp.residual, wp.gradient_sums
+    # a changed shape parameter of the last source
+    theta1 = theta.copy()
+    theta1[-4] *= 0.9
+    for backend in ["numpy", "numba"]:
+        wp.backend = backend
+        plans, inds = make_workplans(theta1, scene, [stamp])
+        assert plans[0] is wp
+        if backend == "numpy":
+            assert stamp.batch_cache.last_converted == [len(scene.sources) - 1]
+        lnp1, grad1 = wp.lnlike()
+        assert (wp.residual is residual) and (wp.gradient_sums is sums)
+        lnp_new, grad_new = lnlike(theta1, scene, stamp, backend=backend)
+        assert np.allclose(lnp1, lnp_new, rtol=1e-12)
+        assert np.allclose(grad1, grad_new, rtol=1e-10, atol=1e-10)
+        stamp.workplan = wp
+    # back to the original parameters
+    plans, inds = make_workplans(theta, scene, [stamp])
+    assert np.allclose(plans[0].lnlike()[0], lnp, rtol=1e-12)
+    # every path writes into the same residual buffer
+    wp.backend = "numpy"
+    for k, v in [("renderer", "fourier"), ("star_templates", 32),
+                 ("superpixel_tile", (8, 8)), ("compute_fisher", True)]:
+        setattr(wp, k, v)
+        wp.lnlike()
+        assert wp.residual is residual
+        setattr(wp, k, getattr(WorkPlan, k))
+
+
+def test_fixed_sources():
+    scene, stamp, theta = setup_scene()
+    sources = scene.sources
+    for kw in [dict(), dict(backend="numba"), dict(renderer="fourier"),
+               dict(footprint_tolerance=1e-3)]:
+        scene.sources, scene.fixed_sources = sources, []
+        lnp, grad = lnlike(theta, scene, stamp, **kw)
+        # hold the last source fixed
+        scene.sources, scene.fixed_sources = sources[:-1], sources[-1:]
+        lnp_f, grad_f = lnlike(theta, scene, stamp, **kw)
+        assert np.allclose(lnp_f, lnp, rtol=1e-10)
+        assert np.allclose(grad_f, grad[:-1], rtol=1e-8, atol=1e-8 * np.abs(grad).max())
+
+    wp = make_workplans(theta, scene, [stamp])[0][0]
+    fixed_data = wp.fixed_residual()
+    wp.lnlike()
+    assert wp.fixed_residual() is fixed_data
+    # a new pixel array invalidates the fixed model
+    pixels = stamp.pixel_values
+    stamp.pixel_values = pixels + 1.
+    assert np.allclose(wp.fixed_residual(), fixed_data + 1.)
+    stamp.pixel_values = pixels
+    fixed_data = wp.fixed_residual()
+    # changing a parameter of the fixed source invalidates the fixed model
+    sources[-1].flux *= 2
+    make_workplans(theta, scene, [stamp])
+    assert wp.fixed_residual() is not fixed_data
+    sources[-1].flux /= 2
+    # promoting the fixed source to active
+    scene.sources, scene.fixed_sources = sources, []
+    lnp_a, grad_a = make_workplans(theta, scene, [stamp])[0][0].lnlike()
+    assert wp.fixed is None
+    assert np.allclose(lnp_a, lnp, rtol=1e-12)
+    assert np.allclose(grad_a, grad, rtol=1e-10)
+
+
+def test_free_parameters():
+    scene, stamp, theta = setup_scene()
+    results = {}
+    for use in [slice(0, 7), slice(0, 5), slice(0, 3), [0, 5, 6], slice(1, 3)]:
+        scene.use_gradients = use
+        free = np.zeros(7, dtype=bool)
+        free[use] = True
+        for kw in [dict(), dict(backend="numba"), dict(renderer="fourier"),
+                   dict(star_templates=32)]:
+            lnp, grad = lnlike(theta, scene, stamp, **kw)
+            key = tuple(kw.items())
+            if key not in results:
+                results[key] = lnp, grad
+            assert np.allclose(lnp, results[key][0], rtol=1e-12)
+            assert np.allclose(grad[:, free], results[key][1][:, free], rtol=1e-10)
+            assert np.all(grad[:, ~free] == 0)
+
+
+def test_compression():
+    scene, stamp, theta = setup_scene()
+    lnp, grad = lnlike(theta, scene, stamp)
+    plans, inds = make_workplans(theta, scene, [stamp])
+    wp = plans[0]
+    ngauss = len(wp.active)
+    wp.compress(1e-4)
+    assert len(wp.active) <= ngauss
+    assert np.all(wp.compression_error <= 1e-4)
+    lnp_c, grad_c = wp.lnlike()
+    assert np.allclose(lnp_c, lnp, rtol=1e-3)
+
+
+def test_fisher():
+    scene, stamp, theta = setup_scene()
+    for kw in [dict(), dict(footprint_tolerance=1e-3, oversample=3)]:
+        lnp, grad = lnlike(theta, scene, stamp, **kw)
+        plans, inds = make_workplans(theta, scene, [stamp])
+        wp = plans[0]
+        wp.compute_fisher = True
+        lnp_f, grad_f = wp.lnlike()
+        assert np.allclose(lnp_f, lnp, rtol=1e-12)
+        assert np.allclose(grad_f, grad, rtol=1e-10, atol=1e-10)
+        dI = wp.image_gradients()
+        fisher = np.einsum("iap,jbp->iajb", dI * stamp.ierr**2, dI)
+        assert wp.fisher.shape == fisher.shape
+        assert np.allclose(wp.fisher, fisher, rtol=1e-10, atol=1e-12 * np.abs(fisher).max())
+
+
+def test_fast_workplan():
+    scene, stamp, theta = setup_scene()
+    for kw in [dict(), dict(footprint_tolerance=1e-3, oversample=3),
+               dict(chunk_size=100, gauss_block=5)]:
+        lnp, grad = lnlike(theta, scene, stamp, **{k: v for k, v in kw.items()
+                                                   if k in ["footprint_tolerance", "oversample"]})
+        stamp.workplan = None
+        wp = make_workplans(theta, scene, [stamp], plan_type=FastWorkPlan)[0][0]
+        assert isinstance(wp, FastWorkPlan)
+        for k, v in kw.items():
+            setattr(wp, k, v)
+        lnp_f, grad_f = wp.lnlike()
+        assert np.allclose(lnp_f, lnp, rtol=1e-12)
+        assert np.allclose(grad_f, grad, rtol=1e-10, atol=1e-10)
+        assert np.allclose(wp.residual, stamp.pixel_values.flatten() - wp.make_image().flatten())
+    # the options of the other WorkPlan paths are not silently ignored
+    wp.renderer = "fourier"
+    with pytest.raises(ValueError):
+        wp.lnlike()
+
+
+def test_likelihood_only():
+    scene, stamp, theta = setup_scene()
+    lnp0 = lnlike(theta, scene, stamp)[0]
+    for kw in [dict(), dict(backend="numba"), dict(renderer="fourier"),
+               dict(footprint_tolerance=1e-3, superpixel_tile=(8, 8)),
+               dict(star_templates=32)]:
+        lnp, grad = lnlike(theta, scene, stamp, **kw)
+        stamp.workplan, stamp.batch_cache = None, None
+        wp = make_workplans(theta, scene, [stamp], compute_gradient=False)[0][0]
+        # no Jacobians were computed
+        assert wp.active.derivs is None
+        for k, v in kw.items():
+            setattr(wp, k, v)
+        lnp_n = wp.lnlike(compute_gradient=False)
+        assert np.allclose(lnp_n, lnp, rtol=1e-12)
+
+    stamp.workplan = None
+    wp = make_workplans(theta, scene, [stamp], plan_type=FastWorkPlan)[0][0]
+    assert np.allclose(wp.lnlike(compute_gradient=False), lnp0, rtol=1e-12)
+
+    # compression of batches without Jacobians
+    stamp.workplan, stamp.batch_cache = None, None
+    wp = WorkPlan(stamp, scene=scene)
+    wp.compression_tolerance = 1e-3
+    stamp.workplan = wp
+    lnp_c = make_workplans(theta, scene, [stamp])[0][0].lnlike()[0]
+    make_workplans(theta, scene, [stamp], compute_gradient=False)
+    assert wp.active.derivs is None
+    assert np.allclose(wp.lnlike(compute_gradient=False), lnp_c, rtol=1e-12)
+
+
+def test_line_search(monkeypatch):
+    scene, stamp, theta = setup_scene()
+    calls = []
+    jacobians = gm.get_gaussian_batch_gradients
+
+    def spy(sources, *args, **kwargs):
+        calls.append(len(sources))
+        return jacobians(sources, *args, **kwargs)
+
+    monkeypatch.setattr(gm, "get_gaussian_batch_gradients", spy)
+    nll, nll_grad = negative_lnlike_multistamp(theta, scene=scene, stamps=[stamp])
+    assert calls == [len(scene.sources)]
+    # a step that changes the last source, without gradients
+    theta1 = theta.copy()
+    theta1[-4] += 0.1
+    nll1 = negative_lnlike_multistamp(theta1, scene=scene, stamps=[stamp],
+                                      compute_gradient=False)
+    assert calls == [len(scene.sources)]
+    assert stamp.batch_cache.last_converted == [len(scene.sources) - 1]
+    # the stale Jacobians are recomputed by the next gradient call
+    nll1_g, grad1 = negative_lnlike_multistamp(theta1, scene=scene, stamps=[stamp])
+    assert calls == [len(scene.sources), 1]
+    assert np.allclose(nll1_g, nll1, rtol=1e-12)
+    stamp.workplan, stamp.batch_cache = None, None
+    fresh, fresh_grad = negative_lnlike_multistamp(theta1, scene=scene, stamps=[stamp])
+    assert np.allclose(grad1, fresh_grad, rtol=1e-12)
@@ -0,0 +1,110 @@
+# ------------
+# Tests of the interpolated Sersic amplitude tables
+# ------------
+
+import numpy as np
+import pytest
+
+from forcepho import gaussmodel as gm
+from forcepho.sersic import AmplitudeTable, load_amplitude_table
+from forcepho.likelihood import make_workplans
+
+from test_batch import make_stamp
+from test_likelihood import Scene
+
+
+def quadratic_table(ngauss=4):
+    ngrid, rgrid = np.arange(1.0, 5.5, 1.0), np.arange(0.5, 4.25, 0.5)
+    n, r = np.meshgrid(ngrid, rgrid, indexing="ij")
+    k = np.arange(ngauss)
+    amps = 1 + 0.1 * (k + 1) * n[..., None]**2 - 0.05 * r[..., None] * n[..., None] + 0.02 * k * r[..., None]**2
+    radii = np.arange(ngauss) * 0.5 + 0.3
+    return ngrid, rgrid, amps, radii
+
+
+def test_interpolation():
+    ngrid, rgrid, amps, radii = quadratic_table()
+    # rows in shuffled order, as from fit_profiles
+    n, r = np.meshgrid(ngrid, rgrid, indexing="ij")
+    order = np.random.RandomState(2).permutation(n.size)
+    table = AmplitudeTable.from_rows(n.flat[order], r.flat[order],
+                                     amps.reshape(n.size, -1)[order], radii,
+                                     normalize=False)
+    assert np.allclose(table.amplitudes, amps)
+
+    rng = np.random.RandomState(0)
+    nq, rq = rng.uniform(1, 5, 50), rng.uniform(0.5, 4, 50)
+    k = np.arange(len(radii))
+    a, da_dn, da_dr = table.evaluate(nq, rq)
+    nq, rq = nq[:, None], rq[:, None]
+    # quadratics are interpolated exactly
+    assert np.allclose(a, 1 + 0.1 * (k + 1) * nq**2 - 0.05 * rq * nq + 0.02 * k * rq**2)
+    assert np.allclose(da_dn, 0.2 * (k + 1) * nq - 0.05 * rq)
+    assert np.allclose(da_dr, -0.05 * nq + 0.04 * k * rq)
+
+    # clipped outside the grid
+    a, da_dn, da_dr = table.evaluate([0.5, 6.0], [2.0, 5.0])
+    assert np.allclose(a, table.evaluate([1.0, 5.0], [2.0, 4.0])[0])
+    assert np.all(da_dn == 0) and np.all(da_dr[1] == 0)
+
+
+def test_galaxy_gradients():
+    ngrid, rgrid, amps, radii = quadratic_table()
+    table = AmplitudeTable(ngrid, rgrid, amps / amps.sum(-1, keepdims=True), radii)
+    stamp = make_stamp(40, 40)
+    stamp.pixel_values = np.random.RandomState(1).normal(0, 1, (40, 40))
+    stamp.ierr = np.ones(stamp.npix)
+    sources = []
+    for i in range(3):
+        galaxy = gm.Galaxy()
+        galaxy.id = i
+        galaxy.ngauss, galaxy.radii = len(radii), radii
+        galaxy.amplitude_table = table
+        sources.append(galaxy)
+    scene = Scene(sources)
+    theta = np.concatenate([[100., 10 + 8 * i, 20., 0.8, 0.3, 2.2 + i, 1.3 + 0.4 * i]
+                            for i in range(3)])
+
+    def lnlike(theta):
+        wp = make_workplans(theta, scene, [stamp])[0][0]
+        return wp.lnlike()
+
+    lnp, grad = lnlike(theta)
+    assert np.allclose(sources[1].amplitudes, table.evaluate([3.2], [1.7])[0][0])
+    for i in [5, 6, 12, 20]:
+        step = np.zeros_like(theta)
+        step[i] = 1e-5
+        num = (lnlike(theta + step)[0] - lnlike(theta - step)[0]) / 2e-5
+        assert np.allclose(grad.flat[i], num, rtol=1e-5, atol=1e-6)
+
+
+def test_table_radii():
+    ngrid, rgrid, amps, radii = quadratic_table()
+    table = AmplitudeTable(ngrid, rgrid, amps, radii)
+    galaxy = gm.Galaxy()
+    galaxy.ngauss, galaxy.sersic, galaxy.rh = len(radii), 2.0, 1.0
+    galaxy.amplitude_table = table
+    # the default radii were not the ones the table was fit with
+    with pytest.raises(ValueError):
+        galaxy.amplitudes
+    galaxy.radii = radii
+    assert np.allclose(galaxy.amplitudes, table.evaluate([2.0], [1.0])[0][0])
+
+
+def test_load_table(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    ngrid, rgrid, amps, radii = quadratic_table()
+    n, r = np.meshgrid(ngrid, rgrid, indexing="ij")
+    filename = str(tmp_path / "amplitudes.h5")
+    with h5py.File(filename, "w") as out:
+        out.create_dataset("nsersic", data=n.flatten())
+        out.create_dataset("rh", data=r.flatten())
+        out.create_dataset("amplitudes", data=amps.reshape(n.size, -1))
+        out.create_dataset("radii", data=radii)
+    table = load_amplitude_table(filename)
+    # the file is only read once
+    assert load_amplitude_table(filename) is table
+    rows = AmplitudeTable.from_rows(n.flatten(), r.flatten(), amps.reshape(n.size, -1),
+                                    radii)
+    for attr in ["nsersic", "rh", "amplitudes", "radii"]:
+        assert np.allclose(getattr(table, attr), getattr(rows, attr))
@@ -0,0 +1,55 @@
+# ------------
+# Tests of the superpixel work lists
+# ------------
+
+import numpy as np
+
+from forcepho import gaussmodel as gm
+from forcepho.worklist import WorkList
+
+from test_batch import make_stamp, make_sources
+from test_likelihood import setup_scene, lnlike
+
+
+def test_binning():
+    stamp = make_stamp(60, 56)
+    stamp.ierr = np.ones(stamp.npix)
+    sources = make_sources()
+    batch = gm.convert_to_gaussian_batch(sources, stamp)
+    gm.set_footprints(batch, stamp, 1e-1)
+    worklist = WorkList(stamp, tile=(8, 5))
+    worklist.set_active(batch)
+    assert worklist.nPixel.sum() == stamp.npix
+    assert np.array_equal(np.sort(worklist.pixels), np.arange(stamp.npix))
+    for i in range(batch.nsource):
+        box = batch.bbox[batch.source_slice(i)]
+        lo, hi = box[:, [0, 2]].min(axis=0), box[:, [1, 3]].max(axis=0)
+        for s in range(worklist.nsuper):
+            listed = worklist.worklist_Active[worklist.start_Active[s]:
+                                              worklist.start_Active[s] + worklist.nActive[s]]
+            overlap = ((worklist.x0[s] < hi[0]) & (worklist.x0[s] + 8 > lo[0]) &
+                       (worklist.y0[s] < hi[1]) & (worklist.y0[s] + 5 > lo[1]))
+            assert (i in listed) == overlap
+    # empty sky is not in the work list
+    assert 0 < len(worklist.superpixel) < worklist.nsuper
+
+
+def test_worklist_lnlike():
+    scene, stamp, theta = setup_scene()
+    for kw in [dict(), dict(footprint_tolerance=1e-3),
+               dict(footprint_tolerance=1e-3, oversample=3)]:
+        lnp, grad = lnlike(theta, scene, stamp, **kw)
+        for tile in [(8, 8), (5, 16)]:
+            lnp_w, grad_w = lnlike(theta, scene, stamp, superpixel_tile=tile, **kw)
+            assert np.allclose(lnp_w, lnp, rtol=1e-12)
+            assert np.allclose(grad_w, grad, rtol=1e-10, atol=1e-10)
+
+    # with a fixed source and the superpixel pixel layout
+    stamp.set_layout("superpixel", tile=(8, 8))
+    sources = scene.sources
+    scene.sources, scene.fixed_sources = sources[:-1], sources[-1:]
+    lnp, grad = lnlike(theta, scene, stamp, footprint_tolerance=1e-3)
+    lnp_w, grad_w = lnlike(theta, scene, stamp, footprint_tolerance=1e-3,
+                           superpixel_tile=(8, 8))
+    assert np.allclose(lnp_w, lnp, rtol=1e-12)
+    assert np.allclose(grad_w, grad, rtol=1e-10, atol=1e-10)